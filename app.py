@@ -1,23 +1,49 @@
 import os
-import sqlite3
+import json
+import time
 import uuid
+import threading
 import shutil
 import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 import mimetypes
-from PIL import Image
-import magic
-import pillow_heif  # HEIC画像サポート
 from functools import wraps
 from dotenv import load_dotenv
 
 # .envファイルを読み込み
 load_dotenv()
 
-from flask import Flask, request, jsonify, send_file, render_template, Response, redirect, url_for, session, flash
+from flask import Flask, request, jsonify, send_file, render_template, Response, redirect, url_for, session, flash, g
 from flask_cors import CORS
 
+import db
+import logs
+import metrics
+import migrations
+import profiling
+import cleanup
+import derivatives
+import duplicates
+import hls
+import hot_tier
+import imaging
+import library_index
+import similarity
+import storage_roots
+import thumbnails
+import transcode
+from jobs import JobManager
+from metadata_cache import FileMeta, MetadataCache
+from file_serving import send_buffer, send_media
+from zipstream import StreamingZip, unique_names
+
+# 起動時間の計測（このモジュールの読み込み開始から各段階までの秒数）
+APP_LOAD_STARTED = time.perf_counter()
+startup_times = {}
+
 app = Flask(__name__)
 CORS(app)
 
@@ -29,66 +55,162 @@ app.config['SESSION_PERMANENT'] = False
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'password')
 
-# HEIC画像サポートを有効化
-pillow_heif.register_heif_opener()
-
 # 設定
 STORAGE_DIR = Path("storage")
 STORAGE_DIR.mkdir(exist_ok=True)
 
-THUMBNAILS_DIR = Path("storage/thumbnails")
-THUMBNAILS_DIR.mkdir(exist_ok=True)
+# 動画のサムネイルの保存先（HDD を使う場合は SSD などのローカルディスクを指定すると一覧が速い）
+# パスは thumbnails モジュールで決める（ID のハッシュで2段に分けたディレクトリ）
+THUMBNAILS_DIR = thumbnails.THUMBNAILS_DIR
+THUMBNAILS_DIR.mkdir(parents=True, exist_ok=True)
+
+# ライブラリのルート（STORAGE_ROOTS で複数のディスクを指定、未設定なら EXTERNAL_STORAGE_PATH の1つ）
+# ルートごとに専用のI/Oワーカーがあり、ディスクごとに1本の順次読み込みでスキャン・削除などを行う
+storage = storage_roots.StorageRoots()
+for _root in storage:
+    _root.path.mkdir(exist_ok=True)
+
+# 先頭のルート（単一ルートの場合は外部HDDストレージのパス）
+EXTERNAL_STORAGE_DIR = storage.primary.path
+
+DATABASE_PATH = db.DATABASE_PATH
+
+# サポートする拡張子
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.heic', '.heif'}
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v'}
+
+# 構造化ログ（キュー経由で別スレッドが書き込む）
+logs.setup()
+request_log = logs.get_logger('request')
+upload_log = logs.get_logger('upload')
+phash_log = logs.get_logger('phash')
+derivative_log = logs.get_logger('derivative')
+delete_log = logs.get_logger('delete')
+
+def client_fields():
+    """ログに付けるクライアント情報"""
+    return {
+        "client_ip": request.headers.get('X-Forwarded-For', request.remote_addr),
+        "user_agent": request.headers.get('User-Agent', 'Unknown')
+    }
+
+# クリーンアップなどのバックグラウンドジョブ（状態はデータベースに保存し、すべてのワーカーで共有）
+job_manager = JobManager(DATABASE_PATH)
+# サムネイルの移行ジョブの種類（実行中はクリーンアップが孤立サムネイルを扱わない）
+THUMBNAIL_MIGRATION_JOB = 'thumbnail_migration'
+
+# クリーンアップ時にファイルの存在確認を並列に行うスレッド数
+CLEANUP_WORKERS = int(os.environ.get('CLEANUP_WORKERS', '8'))
+
+# ファイル削除などのディスクI/Oをリクエストスレッドから切り離すためのスレッドプール
+io_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('IO_WORKERS', '4')),
+    thread_name_prefix='file-io'
+)
+
+# スレッドごとに再利用するSQLite接続プール
+db_pool = db.ConnectionPool(DATABASE_PATH)
+
+def get_db():
+    """現在のスレッドのデータベース接続を取得（リクエスト終了時にプールへ返却される）"""
+    return db_pool.acquire()
+
+@app.teardown_appcontext
+def release_db(exception=None):
+    """リクエスト終了時に接続をプールへ返却"""
+    db_pool.release()
+
+# 知覚ハッシュによる類似画像検索のインデックス（初回の検索時に読み込む）
+near_duplicates = similarity.NearDuplicateIndex(db_pool)
+
+# 大きな動画のHLS配信（HLS_ENABLED=1 のときのみ）
+hls_packager = hls.HlsPackager() if hls.HLS_ENABLED else None
+
+# HEIC の表示用派生画像のキャッシュ（HEIC_MODE=lazy のとき使う）
+derivative_cache = derivatives.DerivativeCache()
+
+# よく表示される元ファイルを高速なディスクにコピーするホット層（HOT_TIER_DIR を設定したときのみ）
+# （コピーは元ファイルのあるディスクのI/Oワーカーで行う）
+hot_store = hot_tier.HotTier(submit=storage.submit) if hot_tier.HOT_TIER_DIR else None
+
+# 一覧表示用のメモリ上のインデックス（LIBRARY_INDEX=1 のときのみ、読み込みが終わるまではデータベースで処理）
+files_index = library_index.LibraryIndex(DATABASE_PATH) if library_index.LIBRARY_INDEX_ENABLED else None
 
-# 外部HDDストレージのパス（環境変数から取得、デフォルトはstorageディレクトリ）
-EXTERNAL_STORAGE_DIR = Path(os.environ.get('EXTERNAL_STORAGE_PATH', 'storage'))
-EXTERNAL_STORAGE_DIR.mkdir(exist_ok=True)
+# ファイルID → メタデータのキャッシュ（全スレッドで共有、他のワーカーでの変更はデータベースの変更履歴で無効化）
+metadata_cache = MetadataCache(int(os.environ.get('METADATA_CACHE_SIZE', '10000')), DATABASE_PATH)
 
-DATABASE_PATH = "image_syncer.db"
+def _load_file_meta(file_id):
+    cursor = get_db().cursor()
+    cursor.execute(db.SQL_FILE_META_BY_ID, (file_id,))
+    row = cursor.fetchone()
+    return FileMeta(*row) if row else None
+
+def forget_files(file_ids):
+    """削除した行をキャッシュとメモリ上のインデックスから除く"""
+    for file_id in file_ids:
+        metadata_cache.invalidate(file_id)
+    near_duplicates.remove(file_ids)
+    if files_index:
+        files_index.remove(file_ids)
+
+def get_file_meta(file_id):
+    """ファイルのパス・MIMEタイプ・サムネイルを取得（キャッシュ優先）"""
+    return metadata_cache.get_or_load(file_id, _load_file_meta)
+
+# URLのバージョン（?v=）に使うハッシュの長さ
+URL_VERSION_LENGTH = 16
+
+# バージョン付きURLは内容が変わらないので永続キャッシュさせる
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# バージョンなし（または古いバージョン）のURLは毎回再検証させる
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+def file_version(file_hash):
+    """元ファイルのURLバージョン（内容のハッシュの先頭）"""
+    return file_hash[:URL_VERSION_LENGTH] if file_hash else None
+
+def thumbnail_version(file_type, file_hash, thumbnail_hash):
+    """サムネイルのURLバージョン（画像は元画像そのものを返すので元ファイルと同じ）"""
+    if file_type != 'image' and thumbnail_hash:
+        return thumbnail_hash[:URL_VERSION_LENGTH]
+    return file_version(file_hash)
+
+def versioned_url(path, version):
+    return f"{path}?v={version}" if version else path
+
+def cache_control_for(version):
+    """リクエストの ?v= が現在のバージョンと一致すれば immutable で返す"""
+    requested = request.args.get('v')
+    if version and requested == version:
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
 
 # データベース初期化
 def init_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS files (
-            id TEXT PRIMARY KEY,
-            original_name TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            file_path TEXT NOT NULL,
-            relative_path TEXT,
-            date_folder TEXT,
-            thumbnail_path TEXT,
-            file_type TEXT NOT NULL,
-            mime_type TEXT,
-            file_size INTEGER NOT NULL,
-            file_hash TEXT,
-            taken_date TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # 新しいカラムが存在しない場合は追加
-    cursor.execute("PRAGMA table_info(files)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    if 'file_hash' not in columns:
-        cursor.execute("ALTER TABLE files ADD COLUMN file_hash TEXT")
-    if 'relative_path' not in columns:
-        cursor.execute("ALTER TABLE files ADD COLUMN relative_path TEXT")
-    if 'date_folder' not in columns:
-        cursor.execute("ALTER TABLE files ADD COLUMN date_folder TEXT")
-    if 'taken_date' not in columns:
-        cursor.execute("ALTER TABLE files ADD COLUMN taken_date TIMESTAMP")
-    
-    # インデックスを作成
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hash ON files(file_hash)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_date_folder ON files(date_folder)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_taken_date ON files(taken_date)")
-    
-    conn.commit()
-    conn.close()
+    """スキーママイグレーションを適用（インデックス作成は書き込みロックを持つので配信の前に終える）"""
+    migrations.migrate(DATABASE_PATH)
+
+_initialized = False
+
+def create_app():
+    """アプリケーションを初期化して返す（開発サーバー・WSGIサーバー共通のエントリポイント）
+
+    gunicorn ではワーカープロセスごとに呼ばれる。マイグレーションはワーカーの起動前にマスタープロセスで
+    適用済み（gunicorn.conf.py の on_starting）なので、ここでは確認だけで終わる。
+    """
+    global _initialized
+    if not _initialized:
+        init_db()
+        _initialized = True
+        resume_live_photo_conversions()
+        # 他のワーカーの /metrics で集計できるよう、このプロセスの値を定期的に書き出す
+        metrics.REGISTRY.start_flusher()
+        # 他のワーカーでの変更をバックグラウンドでキャッシュに反映する
+        metadata_cache.start_sync()
+        if files_index:
+            files_index.start_loading()
+        startup_times['ready'] = time.perf_counter() - APP_LOAD_STARTED
+    return app
 
 # 認証関連の関数
 def login_required(f):
@@ -106,13 +228,13 @@ def check_credentials(username, password):
     """認証情報をチェック"""
     return username == ADMIN_USERNAME and password == ADMIN_PASSWORD
 
+@metrics.timed('exif')
 def get_image_taken_date(file_path):
     """画像の撮影日時を取得（EXIF情報から）"""
     try:
-        from PIL import Image
         from PIL.ExifTags import TAGS
         
-        with Image.open(file_path) as img:
+        with imaging.pil().open(file_path) as img:
             exifdata = img.getexif()
             for tag_id in exifdata:
                 tag = TAGS.get(tag_id, tag_id)
@@ -133,6 +255,7 @@ def get_image_taken_date(file_path):
     except:
         return datetime.now()
 
+@metrics.timed('ffprobe')
 def get_video_taken_date(file_path):
     """動画の撮影日時を取得（メタデータから）"""
     try:
@@ -192,38 +315,93 @@ def get_date_folder_name(taken_date):
     """撮影日時からフォルダ名を生成（YYYYMM形式）"""
     return taken_date.strftime("%Y%m")
 
-def ensure_date_folder(taken_date):
-    """撮影日時に対応するフォルダが存在することを確認し、なければ作成"""
+def ensure_date_folder(taken_date, root=None):
+    """撮影日時に対応するフォルダが存在することを確認し、なければ作成（root 省略時は先頭のルート）"""
     folder_name = get_date_folder_name(taken_date)
-    folder_path = EXTERNAL_STORAGE_DIR / folder_name
+    folder_path = (root or storage.primary).path / folder_name
     folder_path.mkdir(exist_ok=True)
     return folder_path, folder_name
 
+class ScanProgress:
+    """複数のルートを並行してスキャンするときに共有する追加件数（max_files の判定用）"""
+
+    def __init__(self, max_files=None):
+        self.max_files = max_files
+        self.added = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.added += 1
+
+    def reached(self):
+        return bool(self.max_files) and self.added >= self.max_files
+
 def scan_external_storage(force_rescan=False, max_files=None):
     """外部ストレージの既存ファイルをスキャンしてデータベースに登録
     
+    ルートが複数ある場合は、各ルートのI/Oキューで並行してスキャンする（ディスクごとに1本）。
+    
     Args:
         force_rescan (bool): Trueの場合、既存のファイルも再処理する
         max_files (int): 処理するファイルの最大数（テスト用）
     """
-    print(f"[SCAN] 外部ストレージをスキャン中: {EXTERNAL_STORAGE_DIR}")
+    print(f"[SCAN] 外部ストレージをスキャン中: {', '.join(str(root.path) for root in storage)}")
     if force_rescan:
         print("[SCAN] 強制再スキャンモード: 既存ファイルも再処理します")
     if max_files:
         print(f"[SCAN] テストモード: 最大{max_files}ファイルまで処理します")
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    progress = ScanProgress(max_files)
+    with profiling.span('scan', 'scan', force_rescan=force_rescan):
+        futures = [
+            (root, root.submit_scan(_scan_root, root, force_rescan, progress))
+            for root in storage
+        ]
+        scanned_count = added_count = 0
+        errors = []
+        for root, future in futures:
+            try:
+                scanned, added = future.result()
+            except Exception as e:
+                print(f"[SCAN] {root.name} のスキャンに失敗: {e}")
+                errors.append(e)
+                continue
+            scanned_count += scanned
+            added_count += added
+    if errors and len(errors) == len(futures):
+        raise errors[0]
+    if len(futures) > 1:
+        print(f"[SCAN] 全ルートのスキャン完了: {scanned_count}件スキャン, {added_count}件新規追加")
+    return scanned_count, added_count
+
+def _scan_root(root, force_rescan, progress):
+    """1つのルートのスキャン（ルートのI/Oキューで実行し、所要時間をルートの統計に記録）"""
+    started = time.perf_counter()
+    try:
+        with db_pool.connection() as conn:
+            scanned_count, added_count = _scan_external_storage(conn, root, force_rescan, progress)
+    except Exception as e:
+        root.record_scan(0, 0, time.perf_counter() - started, error=str(e))
+        raise
+    root.record_scan(scanned_count, added_count, time.perf_counter() - started)
+    return scanned_count, added_count
+
+def _scan_external_storage(conn, root, force_rescan, progress):
+    """1つのルートのスキャンの本体（接続の取得・返却は呼び出し側）"""
     cursor = conn.cursor()
     
-    # サポートする拡張子
-    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.heic', '.heif'}
-    video_extensions = {'.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v'}
+    image_extensions = IMAGE_EXTENSIONS
+    video_extensions = VIDEO_EXTENSIONS
     
     scanned_count = 0
     added_count = 0
+    max_files = progress.max_files
+    # コミット後に変換キューへ送る Live Photos 動画 (file_id, パス)
+    pending_conversions = []
     
     # フォルダをスキャン
-    for folder_path in EXTERNAL_STORAGE_DIR.iterdir():
+    for folder_path in root.path.iterdir():
         if not folder_path.is_dir():
             continue
             
@@ -239,17 +417,22 @@ def scan_external_storage(force_rescan=False, max_files=None):
         print(f"[SCAN] フォルダをスキャン中: {folder_name}")
         
         # 最大ファイル数チェック（フォルダレベルでも）
-        if max_files and added_count >= max_files:
+        if progress.reached():
             print(f"[SCAN] テスト制限に達しました: {max_files}ファイル処理完了")
             break
         # フォルダ内のファイルをスキャン
         for file_path in folder_path.rglob('*'):
+            # 前のファイルのコミット後に、このディスクに積まれた削除やコピーを先に実行する
+            root.run_pending()
             if not file_path.is_file():
                 continue
                 
             file_ext = file_path.suffix.lower()
             if file_ext not in image_extensions and file_ext not in video_extensions:
                 continue
+            # 変換中の一時ファイル
+            if file_path.name.endswith(transcode.TEMP_SUFFIX):
+                continue
                 
             scanned_count += 1
             
@@ -258,6 +441,7 @@ def scan_external_storage(force_rescan=False, max_files=None):
                 file_hash = get_file_hash(str(file_path))
             except Exception as e:
                 print(f"[ERROR] ハッシュ計算エラー: {file_path}, {e}")
+                metrics.SCAN_FILES.inc(result='error')
                 continue
             
             # 既にデータベースに存在するかチェック（強制再スキャンでない場合のみ）
@@ -270,16 +454,17 @@ def scan_external_storage(force_rescan=False, max_files=None):
                 
                 # ハッシュまたはファイルパスで既存チェック
                 for check_path in check_paths:
-                    cursor.execute("SELECT id FROM files WHERE file_hash = ? OR file_path = ?", (file_hash, check_path))
+                    cursor.execute(db.SQL_FIND_BY_HASH_OR_PATH, (file_hash, check_path))
                     existing_file = cursor.fetchone()
                     if existing_file:
                         break
                 
                 if existing_file:
+                    metrics.SCAN_FILES.inc(result='skipped')
                     continue  # 既に存在する
             
             # 最大ファイル数チェック（テスト用）
-            if max_files and added_count >= max_files:
+            if progress.reached():
                 print(f"[SCAN] テスト制限に達しました: {max_files}ファイル処理完了")
                 break
             
@@ -302,14 +487,19 @@ def scan_external_storage(force_rescan=False, max_files=None):
                         taken_date = datetime.now()
                 
                 # 相対パスを計算
-                relative_path = str(file_path.relative_to(EXTERNAL_STORAGE_DIR))
+                relative_path = str(file_path.relative_to(root.path))
                 
                 # HEICファイルの場合はJPEGに変換
                 final_file_path = file_path
                 final_filename = file_path.name
                 final_mime_type = mime_type
                 
-                if file_ext.lower() in {'.heic', '.heif'}:
+                source_format = derivatives.source_format_for(file_path.name)
+                derivative = derivatives.derivative_for(source_format)
+                if derivative:
+                    # lazy モード: HEIC のまま保存し、表示時に派生画像を作る
+                    final_mime_type = mime_type or f"image/{source_format}"
+                elif file_ext.lower() in {'.heic', '.heif'}:
                     print(f"[SCAN] HEIC変換中: {file_path.name}")
                     # 変換後のファイルパス（同じディレクトリにJPEG版を作成）
                     jpeg_filename = file_path.stem + '.jpg'
@@ -328,74 +518,66 @@ def scan_external_storage(force_rescan=False, max_files=None):
                     else:
                         print(f"[SCAN] HEIC変換失敗、元ファイルを使用: {file_path.name}")
                 
-                # データベースに追加
+                # 類似画像検索用の知覚ハッシュ（派生画像を作る HEIC は表示時に計算する）
+                phash = compute_phash(final_file_path) if file_type == 'image' and not derivative else None
+                
+                # 動画は ffprobe と ffmpeg（サムネイル作成）を書き込みの前に済ませ、
+                # その間に他のルートのスキャンやアップロードが書き込みロックを待たないようにする
                 file_id = str(uuid.uuid4())
+                live_photo = False
+                thumbnail_temp = thumbnail_hash = None
+                if file_type == 'video':
+                    live_photo = is_live_photo_video(str(final_file_path))
+                    thumbnail_temp, thumbnail_hash = render_video_thumbnail(file_id, final_file_path)
+                    if not thumbnail_temp:
+                        print(f"[SCAN] 動画サムネイル作成失敗: {final_filename}")
+                # 画像ファイルの場合はサムネイル作成をスキップ
+                
+                # データベースに追加
+                thumbnail_path = thumbnails.save(conn, file_id, thumbnail_temp) if thumbnail_temp else None
                 cursor.execute("""
                     INSERT INTO files (
                         id, original_name, filename, file_path, relative_path, 
-                        date_folder, file_type, mime_type, file_size, file_hash, taken_date
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        date_folder, file_type, mime_type, file_size, file_hash, taken_date, phash,
+                        source_format, derivative, thumbnail_path, thumbnail_hash
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     file_id, file_path.name, final_filename, str(final_file_path),
-                    relative_path, folder_name, file_type, final_mime_type, file_size, file_hash, taken_date
+                    relative_path, folder_name, file_type, final_mime_type, file_size, file_hash, taken_date,
+                    phash, source_format, derivative, thumbnail_path, thumbnail_hash
                 ))
-                
-                # サムネイル作成（動画のみ）
-                if file_type == 'video':
-                    # Live Photos動画の場合は互換形式に変換
-                    if is_live_photo_video(str(final_file_path)):
-                        print(f"[SCAN] Live Photos動画を検出: {final_filename}")
-                        
-                        # MP4に変換したファイルパス
-                        converted_path = final_file_path.with_suffix('.mp4')
-                        
-                        if convert_live_photo_video(str(final_file_path), str(converted_path)):
-                            # 変換成功時は元ファイルを削除し、データベースパスを更新
-                            import os
-                            os.remove(str(final_file_path))
-                            final_file_path = converted_path
-                            relative_path = str(final_file_path.relative_to(EXTERNAL_STORAGE_DIR))
-                            final_mime_type = 'video/mp4'
-                            
-                            # データベースのファイル情報を更新
-                            cursor.execute("""
-                                UPDATE files SET file_path = ?, mime_type = ? WHERE id = ?
-                            """, (relative_path, final_mime_type, file_id))
-                            
-                            print(f"[SCAN] Live Photos動画変換完了: {final_filename} -> {converted_path.name}")
-                    
-                    thumbnail_path = THUMBNAILS_DIR / f"{file_id}.jpg"
-                    thumbnail_created = create_video_thumbnail(str(final_file_path), str(thumbnail_path))
-                    
-                    if thumbnail_created:
-                        # サムネイルパスをデータベースに更新
-                        cursor.execute("""
-                            UPDATE files SET thumbnail_path = ? WHERE id = ?
-                        """, (str(thumbnail_path), file_id))
-                        print(f"[SCAN] 動画サムネイル作成完了: {file_id}")
-                    else:
-                        print(f"[SCAN] 動画サムネイル作成失敗: {final_filename}")
-                # 画像ファイルの場合はサムネイル作成をスキップ
+                if live_photo:
+                    # Live Photos動画の場合は互換形式への変換を予約（コミット後に変換キューへ）
+                    print(f"[SCAN] Live Photos動画を検出: {final_filename}")
+                    reserve_live_photo_conversion(conn, pending_conversions, file_id, final_file_path)
                 
                 added_count += 1
+                progress.add()
+                metrics.SCAN_FILES.inc(result='added')
+                # 他のルートのスキャンやアップロードが書き込みロックを長く待たないよう、1件ごとにコミット
+                conn.commit()
                 
                 if added_count % 100 == 0:
-                    print(f"[SCAN] {added_count}件のファイルを追加済み...")
-                    conn.commit()
+                    print(f"[SCAN] {root.name}: {added_count}件のファイルを追加済み...")
+                    schedule_live_photo_conversions(pending_conversions)
                     
             except Exception as e:
                 print(f"[ERROR] ファイル処理エラー: {file_path}, {e}")
+                metrics.SCAN_FILES.inc(result='error')
+                # 途中まで書き込んだ行を次のファイルのコミットで残さない
+                conn.rollback()
                 continue
     
     conn.commit()
-    conn.close()
+    schedule_live_photo_conversions(pending_conversions)
     
-    print(f"[SCAN] スキャン完了: {scanned_count}件スキャン, {added_count}件新規追加")
+    print(f"[SCAN] スキャン完了（{root.name}）: {scanned_count}件スキャン, {added_count}件新規追加")
     return scanned_count, added_count
 
 def create_thumbnail(file_path, thumbnail_path, size=(200, 200)):
     """画像のサムネイルを作成"""
     try:
+        Image = imaging.pil()
         with Image.open(file_path) as img:
             # EXIF情報を考慮して回転
             img = img.convert('RGB')
@@ -406,6 +588,19 @@ def create_thumbnail(file_path, thumbnail_path, size=(200, 200)):
         print(f"サムネイル作成エラー: {e}")
         return False
 
+@metrics.timed('thumbnail')
+def render_video_thumbnail(file_id, video_path):
+    """動画のサムネイルを一時ファイルに作成（(一時ファイルのパス, ハッシュ)、失敗時は (None, None)）
+
+    ffmpeg の実行中に書き込みロックを持たないよう、データベースに書き込む前に呼び、
+    行を追加するときに thumbnails.save() で保存する。
+    """
+    temp_path = thumbnails.temp_path(file_id)
+    if not create_video_thumbnail(str(video_path), str(temp_path)):
+        unlink_quietly(temp_path)
+        return None, None
+    return temp_path, get_file_hash(str(temp_path))
+
 def create_video_thumbnail(video_path, thumbnail_path):
     """動画の最初のフレームからサムネイルを作成（Live Photos対応）"""
     try:
@@ -449,9 +644,14 @@ def create_video_thumbnail(video_path, thumbnail_path):
         print(f"動画サムネイル作成エラー: {e}")
         return False
 
+@metrics.timed('magic')
+def detect_mime_type(file_path):
+    """ファイルの内容から MIME タイプを判定（libmagic）"""
+    return imaging.mime_type(file_path)
+
 def get_file_type(file_path):
     """ファイルタイプを判定"""
-    mime = magic.from_file(str(file_path), mime=True)
+    mime = detect_mime_type(file_path)
     if mime.startswith('image/'):
         return 'image'
     elif mime.startswith('video/'):
@@ -459,6 +659,7 @@ def get_file_type(file_path):
     else:
         return 'other'
 
+@metrics.timed('ffprobe')
 def is_live_photo_video(file_path):
     """Live Photos動画かどうかを判定"""
     try:
@@ -496,36 +697,109 @@ def is_live_photo_video(file_path):
         print(f"Live Photos判定エラー: {e}")
         return False
 
+# Live Photos 動画の変換キュー（同時実行数と ffmpeg の優先度を制限）
+transcode_queue = transcode.TranscodeQueue()
+
+@metrics.timed('transcode')
 def convert_live_photo_video(input_path, output_path):
-    """Live Photos動画をブラウザ互換形式に変換"""
+    """Live Photos動画をブラウザ互換形式に変換（コーデックが互換ならコンテナの詰め替えのみ）"""
+    method = transcode.convert_to_mp4(input_path, output_path)
+    if method:
+        print(f"[INFO] Live Photos動画変換成功（{method}）: {output_path}")
+    return method is not None
+
+def _convert_live_photo(file_id, source_path):
+    """変換キューで実行: 変換後のファイルに差し替えてデータベースを更新（終われば予約を消す）"""
     try:
-        import subprocess
-        
-        # MP4形式に変換してブラウザ互換性を向上
-        command = [
-            'ffmpeg',
-            '-i', str(input_path),
-            '-c:v', 'libx264',      # H.264エンコーダ
-            '-c:a', 'aac',          # AACオーディオ
-            '-movflags', '+faststart',  # ストリーミング最適化
-            '-pix_fmt', 'yuv420p',  # 互換性の高いピクセル形式
-            '-crf', '23',           # 品質設定
-            '-preset', 'medium',    # エンコード速度と品質のバランス
-            '-y',                   # 上書き
-            str(output_path)
-        ]
-        
-        result = subprocess.run(command, capture_output=True, text=True)
-        if result.returncode == 0:
-            print(f"[INFO] Live Photos動画変換成功: {output_path}")
-            return True
-        else:
-            print(f"動画変換エラー: {result.stderr}")
-            return False
-    except Exception as e:
-        print(f"Live Photos動画変換エラー: {e}")
+        _replace_live_photo(file_id, source_path)
+    finally:
+        with db_pool.connection() as conn:
+            conn.execute("DELETE FROM live_photo_conversions WHERE file_id = ?", (file_id,))
+            conn.commit()
+
+def _replace_live_photo(file_id, source_path):
+    with db_pool.connection() as conn:
+        row = conn.execute("SELECT file_path FROM files WHERE id = ?", (file_id,)).fetchone()
+    if row is None or row[0] != str(source_path):
+        # 予約の後に削除された、または前のワーカーが差し替えまで終えていた
+        return
+    source = Path(source_path)
+    temp_path = source.with_name(source.stem + transcode.TEMP_SUFFIX)
+    final_path = source.with_suffix('.mp4')
+    if final_path != source and final_path.exists():
+        # 同じ名前の別のファイルを上書きしない
+        final_path = source.with_name(f"{source.stem}_{file_id[:8]}.mp4")
+
+    if not convert_live_photo_video(source, temp_path):
+        unlink_quietly(temp_path)
+        return
+    os.replace(temp_path, final_path)
+
+    relative_path = storage.relative_path(final_path)
+    with db_pool.connection() as conn:
+        cursor = conn.execute("""
+            UPDATE files SET file_path = ?, filename = ?, relative_path = COALESCE(?, relative_path),
+                mime_type = 'video/mp4', file_size = ?, file_hash = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (str(final_path), final_path.name, relative_path, final_path.stat().st_size,
+              get_file_hash(final_path), file_id))
+        conn.commit()
+        updated = cursor.rowcount
+    metadata_cache.invalidate(file_id)
+
+    if not updated:
+        # 変換中に削除された
+        unlink_quietly(final_path)
+        return
+    if final_path != source:
+        unlink_quietly(source)
+    print(f"[TRANSCODE] Live Photos動画変換完了: {source.name} -> {final_path.name}")
+
+def reserve_live_photo_conversion(conn, pending, file_id, source_path):
+    """Live Photos 動画の変換を予約（行と同じトランザクションで記録し、コミット後に変換キューへ送る）"""
+    conn.execute("""
+        INSERT OR REPLACE INTO live_photo_conversions (file_id, source_path, owner_pid) VALUES (?, ?, ?)
+    """, (file_id, str(source_path), os.getpid()))
+    pending.append((file_id, source_path))
+
+def schedule_live_photo_conversions(pending):
+    """コミット済みの行の Live Photos 動画を変換キューに送る"""
+    for file_id, source_path in pending:
+        transcode_queue.submit(_convert_live_photo, file_id, str(source_path))
+    pending.clear()
+
+def _process_alive(pid):
+    if not pid:
         return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def resume_live_photo_conversions():
+    """終了したワーカー（gunicorn の max_requests による再起動など）が変換し終えていない Live Photos 動画を引き継ぐ"""
+    pid = os.getpid()
+    resumed = []
+    with db_pool.connection() as conn:
+        rows = conn.execute("SELECT file_id, source_path, owner_pid FROM live_photo_conversions").fetchall()
+        for file_id, source_path, owner_pid in rows:
+            if owner_pid != pid and _process_alive(owner_pid):
+                continue
+            # 同時に起動した他のワーカーと二重に引き継がない
+            cursor = conn.execute("""
+                UPDATE live_photo_conversions SET owner_pid = ? WHERE file_id = ? AND owner_pid IS ?
+            """, (pid, file_id, owner_pid))
+            if cursor.rowcount:
+                resumed.append((file_id, source_path))
+        conn.commit()
+    if resumed:
+        print(f"[TRANSCODE] 中断していた Live Photos 動画の変換を再開: {len(resumed)}件")
+        schedule_live_photo_conversions(resumed)
 
+@metrics.timed('hash')
 def get_file_hash(file_path):
     """ファイルのSHA256ハッシュを計算"""
     hash_sha256 = hashlib.sha256()
@@ -534,10 +808,20 @@ def get_file_hash(file_path):
             hash_sha256.update(chunk)
     return hash_sha256.hexdigest()
 
+@metrics.timed('phash')
+def compute_phash(file_path):
+    """画像の知覚ハッシュ（データベース保存用の値）を計算。失敗時は None"""
+    try:
+        return similarity.to_db(similarity.dhash(file_path))
+    except Exception as e:
+        phash_log.warning("phash failed", extra={"path": str(file_path), "error": str(e)})
+        return None
+
+@metrics.timed('heic')
 def convert_heic_to_jpeg(heic_path, jpeg_path, quality=90):
     """HEICファイルをJPEGに変換し、元のHEICファイルを削除"""
     try:
-        with Image.open(heic_path) as img:
+        with imaging.pil().open(heic_path) as img:
             # RGBモードに変換（JPEG用）
             if img.mode != 'RGB':
                 img = img.convert('RGB')
@@ -626,25 +910,25 @@ def service_worker():
 def upload_file():
     """ファイルアップロード"""
     # リクエスト詳細をログ出力
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-    user_agent = request.headers.get('User-Agent', 'Unknown')
-    print(f"[UPLOAD] Client: {client_ip}, User-Agent: {user_agent}")
+    upload_log.info("upload request", extra=client_fields())
     
     # 'files' または 'image' キーに対応
     files = []
     if 'files' in request.files:
         files = request.files.getlist('files')
-        print(f"[UPLOAD] Found {len(files)} files in 'files' key")
+        upload_log.debug("files received", extra={"key": "files", "count": len(files)})
     elif 'image' in request.files:
         files = request.files.getlist('image')
-        print(f"[UPLOAD] Found {len(files)} files in 'image' key")
+        upload_log.debug("files received", extra={"key": "image", "count": len(files)})
     
     if not files:
-        print("[UPLOAD] No files found in request")
+        upload_log.info("no files in request")
         return jsonify({"error": "ファイルが選択されていません"}), 400
     uploaded_files = []
+    # コミット後に変換キューへ送る Live Photos 動画 (file_id, パス)
+    pending_conversions = []
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -652,7 +936,7 @@ def upload_file():
             if file.filename == '':
                 continue
             
-            print(f"[UPLOAD] Processing file: {file.filename}")
+            upload_log.debug("processing file", extra={"file_name": file.filename})
                 
             # 一時保存してメタデータ抽出
             file_id = str(uuid.uuid4())
@@ -665,22 +949,26 @@ def upload_file():
             file.save(temp_file_path)
             
             # ファイルタイプを判定
-            file_type = 'image' if file_ext in {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.heic', '.heif'} else 'video'
+            file_type = 'image' if file_ext in IMAGE_EXTENSIONS else 'video'
             
             # 撮影日時を取得（ファイルタイプに応じて適切な関数を使用）
             taken_date = get_file_taken_date(str(temp_file_path), file_type)
-            print(f"[UPLOAD] Detected taken date: {taken_date}")
+            upload_log.debug("taken date detected", extra={"file_name": original_name, "taken_date": str(taken_date)})
             
-            # 適切なフォルダを確保
-            date_folder_path, date_folder_name = ensure_date_folder(taken_date)
+            # 適切なフォルダを確保（保存先のルートは UPLOAD_ROOT の規則で選ぶ）
+            upload_root = storage.choose_upload_root()
+            date_folder_path, date_folder_name = ensure_date_folder(taken_date, upload_root)
             
             # 最終的なファイル名とパス
             filename = f"{file_id}{file_ext}"
             final_file_path = date_folder_path / filename
             
-            # HEICファイルの場合はJPEGに変換
-            if file_ext.lower() == '.heic':
-                print(f"[UPLOAD] Converting HEIC to JPEG: {original_name}")
+            source_format = derivatives.source_format_for(original_name)
+            derivative = derivatives.derivative_for(source_format)
+            
+            # HEICファイルの場合はJPEGに変換（lazy モードでは HEIC のまま保存し、表示時に派生画像を作る）
+            if file_ext.lower() == '.heic' and not derivative:
+                upload_log.debug("converting heic to jpeg", extra={"file_name": original_name})
                 # JPEG用の新しいファイルパスを作成
                 jpeg_filename = f"{file_id}.jpg"
                 jpeg_file_path = date_folder_path / jpeg_filename
@@ -691,9 +979,9 @@ def upload_file():
                     final_file_path = jpeg_file_path
                     filename = jpeg_filename
                     file_ext = '.jpg'
-                    print(f"[UPLOAD] HEIC converted to JPEG: {filename}")
+                    upload_log.debug("heic converted to jpeg", extra={"file_name": original_name, "stored_as": filename})
                 else:
-                    print(f"[UPLOAD] HEIC conversion failed, keeping original file")
+                    upload_log.warning("heic conversion failed, keeping original file", extra={"file_name": original_name})
                     # 変換失敗の場合は元ファイルを移動
                     shutil.move(str(temp_file_path), str(final_file_path))
             else:
@@ -702,14 +990,14 @@ def upload_file():
             
             # ハッシュ計算（最終ファイルに対して）
             file_hash = get_file_hash(final_file_path)
-            print(f"[UPLOAD] File hash: {file_hash}")
+            upload_log.debug("file hashed", extra={"file_name": original_name, "file_hash": file_hash})
             
             # 重複チェック
-            cursor.execute("SELECT id, original_name FROM files WHERE file_hash = ?", (file_hash,))
+            cursor.execute(db.SQL_FIND_BY_HASH, (file_hash,))
             existing_file = cursor.fetchone()
             
             if existing_file:
-                print(f"[UPLOAD] Duplicate file detected! Existing: {existing_file[1]}")
+                upload_log.info("duplicate upload", extra={"file_name": original_name, "existing_id": existing_file[0]})
                 # 重複ファイルの場合は削除して既存ファイル情報を返す
                 final_file_path.unlink()
                 uploaded_files.append({
@@ -723,56 +1011,52 @@ def upload_file():
             # ファイル情報取得
             file_size = final_file_path.stat().st_size
             file_type = get_file_type(final_file_path)
-            mime_type = magic.from_file(str(final_file_path), mime=True)
+            mime_type = detect_mime_type(final_file_path)
             
             # HEICからJPEGに変換した場合は、MIME typeを修正
             if file_ext == '.jpg' and original_name.lower().endswith('.heic'):
                 mime_type = 'image/jpeg'
             
             # 相対パスを計算
-            relative_path = str(final_file_path.relative_to(EXTERNAL_STORAGE_DIR))
+            relative_path = str(final_file_path.relative_to(upload_root.path))
             
             # サムネイル作成（動画の場合のみ - 画像は元画像を使用）
             thumbnail_path = None
+            thumbnail_hash = None
+            phash = compute_phash(final_file_path) if file_type == 'image' and not derivative else None
+            live_photo = False
             if file_type == 'video':
-                # Live Photos動画の場合は互換形式に変換
-                if is_live_photo_video(str(final_file_path)):
-                    print(f"[UPLOAD] Live Photos動画を検出: {original_name}")
-                    
-                    # MP4に変換したファイルパス
-                    converted_path = final_file_path.with_suffix('.mp4')
-                    
-                    if convert_live_photo_video(str(final_file_path), str(converted_path)):
-                        # 変換成功時は元ファイルを削除し、パスを更新
-                        import os
-                        os.remove(str(final_file_path))
-                        final_file_path = converted_path
-                        relative_path = str(final_file_path.relative_to(EXTERNAL_STORAGE_DIR))
-                        mime_type = 'video/mp4'
-                        
-                        print(f"[UPLOAD] Live Photos動画変換完了: {original_name} -> {converted_path.name}")
-                
-                thumbnail_filename = f"thumb_{file_id}.jpg"
-                thumbnail_path = THUMBNAILS_DIR / thumbnail_filename
-                if create_video_thumbnail(final_file_path, thumbnail_path):
-                    thumbnail_path = str(thumbnail_path)
-                else:
-                    thumbnail_path = None
+                # ffprobe と ffmpeg は書き込みの前に済ませる（実行中に書き込みロックを持たない）
+                live_photo = is_live_photo_video(str(final_file_path))
+                thumbnail_temp, thumbnail_hash = render_video_thumbnail(file_id, final_file_path)
+                if thumbnail_temp:
+                    thumbnail_path = thumbnails.save(conn, file_id, thumbnail_temp)
             
             # データベースに保存
             cursor.execute("""
                 INSERT INTO files (
                     id, original_name, filename, file_path, relative_path, 
                     date_folder, thumbnail_path, file_type, mime_type, 
-                    file_size, file_hash, taken_date
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    file_size, file_hash, taken_date, thumbnail_hash, phash,
+                    source_format, derivative
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (
                 file_id, original_name, filename, str(final_file_path), relative_path,
                 date_folder_name, thumbnail_path, file_type, mime_type, 
-                file_size, file_hash, taken_date
+                file_size, file_hash, taken_date, thumbnail_hash, phash,
+                source_format, derivative
             ))
+            if live_photo:
+                # Live Photos動画の場合は互換形式への変換を予約（コミット後に変換キューへ）
+                upload_log.debug("live photo video detected", extra={"file_id": file_id, "file_name": original_name})
+                reserve_live_photo_conversion(conn, pending_conversions, file_id, final_file_path)
+            # 次のファイルの処理中に書き込みロックを持ち続けないよう、1件ごとにコミット
+            conn.commit()
+            schedule_live_photo_conversions(pending_conversions)
             
-            print(f"[UPLOAD] Successfully uploaded: {original_name} -> {date_folder_name}/{filename}")
+            upload_log.info("file uploaded", extra={
+                "file_id": file_id, "file_name": original_name, "path": f"{date_folder_name}/{filename}"
+            })
             uploaded_files.append({
                 "id": file_id,
                 "original_name": original_name,
@@ -783,7 +1067,6 @@ def upload_file():
                 "status": "uploaded"
             })
         
-        conn.commit()
         return jsonify({
             "message": f"{len(uploaded_files)}個のファイルがアップロードされました",
             "files": uploaded_files
@@ -793,7 +1076,8 @@ def upload_file():
         conn.rollback()
         return jsonify({"error": f"アップロードエラー: {str(e)}"}), 500
     finally:
-        conn.close()
+        if files_index and uploaded_files:
+            files_index.changed()
 
 @app.route('/scan', methods=['POST'])
 @login_required
@@ -816,69 +1100,288 @@ def scan_storage():
         }), 500
 
 @app.route('/cleanup', methods=['POST'])
+@login_required
 def cleanup_database():
-    """データベースとファイルシステムの整合性をチェックし、不整合なエントリを削除"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    # データベース内の全ファイルを取得
-    cursor.execute("SELECT id, file_path, thumbnail_path FROM files")
-    db_files = cursor.fetchall()
-    
-    cleaned_files = []
-    for file_id, file_path, thumbnail_path in db_files:
-        # ファイルが存在しない場合は削除
-        if not Path(file_path).exists():
-            print(f"[CLEANUP] Removing missing file from DB: {file_id} ({file_path})")
-            cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
-            cleaned_files.append(file_id)
-        # サムネイルが指定されているが存在しない場合はNULLに更新
-        elif thumbnail_path and not Path(thumbnail_path).exists():
-            print(f"[CLEANUP] Clearing missing thumbnail for: {file_id} ({thumbnail_path})")
-            cursor.execute("UPDATE files SET thumbnail_path = NULL WHERE id = ?", (file_id,))
-    
-    conn.commit()
-    conn.close()
-    
+    """データベースとファイルシステムの整合性チェックをバックグラウンドジョブとして開始
+
+    存在しないファイルを参照する行の削除に加え、どの行からも参照されていない
+    孤立ファイル・孤立サムネイルを報告する（delete_orphan_files / delete_orphan_thumbnails
+    を指定した場合は削除する）。進捗と結果は GET /jobs/<job_id> で確認する。
+    """
+    options = request.get_json(silent=True) or {}
+    params = {
+        "delete_orphan_files": bool(options.get('delete_orphan_files', False)),
+        "delete_orphan_thumbnails": bool(options.get('delete_orphan_thumbnails', False))
+    }
+
+    def run(job):
+        return cleanup.run_cleanup(
+            job, db_pool, [root.path for root in storage], THUMBNAILS_DIR,
+            IMAGE_EXTENSIONS | VIDEO_EXTENSIONS,
+            on_removed=forget_files,
+            workers=CLEANUP_WORKERS,
+            thumbnails_busy=lambda: job_manager.is_running(THUMBNAIL_MIGRATION_JOB), **params
+        )
+
+    job, started = job_manager.start('cleanup', run, params)
+    return jsonify({
+        "message": "クリーンアップを開始しました" if started else "クリーンアップは既に実行中です",
+        "job": job.to_dict()
+    }), 202
+
+@app.route('/thumbnails/migrate', methods=['POST'])
+@login_required
+def migrate_thumbnails():
+    """サムネイルを現在の保存方式（分割した配置 / パック）へ移すジョブを開始（配信は止めない）"""
+    def on_moved(ids):
+        for file_id in ids:
+            metadata_cache.invalidate(file_id)
+
+    job, started = job_manager.start(
+        THUMBNAIL_MIGRATION_JOB,
+        lambda job: thumbnails.migrate(job, db_pool, on_moved=on_moved)
+    )
+    return jsonify({
+        "message": "サムネイルの移行を開始しました" if started else "サムネイルの移行は既に実行中です",
+        "job": job.to_dict()
+    }), 202
+
+@app.route('/thumbnails/compact', methods=['POST'])
+@login_required
+def compact_thumbnail_packs():
+    """削除したファイルのサムネイルが多いパックを詰め直すジョブを開始"""
+    job, started = job_manager.start(
+        'thumbnail_compaction',
+        lambda job: thumbnails.packs.compact(job, db_pool)
+    )
+    return jsonify({
+        "message": "パックの圧縮を開始しました" if started else "パックの圧縮は既に実行中です",
+        "job": job.to_dict()
+    }), 202
+
+@app.route('/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    """バックグラウンドジョブの一覧"""
+    return jsonify({"jobs": [job.to_dict() for job in job_manager.list()]})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    """バックグラウンドジョブの進捗と結果"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job.to_dict())
+
+# メトリクス（Prometheus 形式、値はワーカープロセスごと）
+
+# /metrics の Bearer トークン（未設定ならログインセッションが必要）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# プロファイル（X-Profile ヘッダーか ?_profile= に cprofile または trace を指定、ログイン中のみ）
+PROFILE_MODES = ('cprofile', 'trace')
+
+@app.before_request
+def start_request_profile():
+    mode = request.headers.get('X-Profile') or request.args.get('_profile')
+    if mode not in PROFILE_MODES or not session.get('logged_in'):
+        return
+    label = f"{request.method} {request.path}"
+    if mode == 'cprofile':
+        g.profiler = profiling.start_profile()
+        if g.profiler is None:
+            g.profile_busy = True
+    else:
+        g.tracer = profiling.start_trace(label)
+
+@app.after_request
+def finish_request_profile(response):
+    """レポートを保存し、X-Profile-Report ヘッダーで取得先を返す"""
+    label = f"{request.method} {request.path} {response.status_code}"
+    profiler = g.pop('profiler', None)
+    tracer = g.pop('tracer', None)
+    try:
+        if profiler:
+            profiling.stop_profile(profiler)
+            name = profiling.save_profile(profiler, label)
+        elif tracer:
+            profiling.stop_trace()
+            name = profiling.save_trace(tracer)
+        else:
+            if g.pop('profile_busy', False):
+                response.headers['X-Profile-Report'] = 'busy'
+            return response
+    except OSError as e:
+        print(f"[PROFILE] レポートの保存に失敗: {e}")
+        return response
+    response.headers['X-Profile-Report'] = url_for('get_profile_report', name=name)
+    return response
+
+@app.teardown_request
+def stop_request_profile(exception=None):
+    """例外で after_request が呼ばれなかった場合もプロファイラを止める"""
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiling.stop_profile(profiler)
+    if g.pop('tracer', None):
+        profiling.stop_trace()
+
+@app.after_request
+def record_request_metrics(response):
+    """ルート（URLパターン）ごとのリクエスト数・処理時間・送信バイト数を記録"""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    if 'first_request' not in startup_times:
+        startup_times['first_request'] = time.perf_counter() - APP_LOAD_STARTED
+        print(f"[STARTUP] 最初のリクエストまで {startup_times['first_request']:.3f}秒"
+              f"（初期化 {startup_times.get('ready', 0):.3f}秒）")
+    # ファイルIDごとにラベルが増えないよう、実際のパスではなくURLパターンを使う
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    metrics.HTTP_DURATION.observe(time.perf_counter() - started, method=request.method, route=route)
+    # ストリーミングのレスポンスは長さが分からないので数えない
+    if response.content_length:
+        metrics.HTTP_BYTES.inc(response.content_length, route=route)
+    return response
+
+def _queue_depths():
+    depths = {
+        ('io', 'queued'): io_pool._work_queue.qsize(),
+        ('transcode', 'queued'): transcode_queue.queued,
+        ('transcode', 'running'): transcode_queue.running,
+    }
+    for root in storage:
+        depths[(f'root:{root.name}', 'queued')] = root.queued()
+        depths[(f'root-scan:{root.name}', 'queued')] = root.scans_queued()
+    if hls_packager:
+        hls_stats = hls_packager.stats()
+        depths[('hls', 'queued')] = hls_stats['queued']
+        depths[('hls', 'running')] = hls_stats['running']
+    return depths
+
+metrics.gauge('image_syncer_queue_depth', 'バックグラウンド処理のキューの長さ', ('queue', 'state'),
+              callback=_queue_depths)
+metrics.gauge('image_syncer_log_dropped', 'ログのキューがあふれて捨てたレコード数',
+              callback=logs.dropped_count)
+metrics.gauge('image_syncer_startup_seconds', 'モジュールの読み込み開始から各段階までの秒数', ('phase',),
+              callback=lambda: {(phase,): value for phase, value in startup_times.items()})
+metrics.gauge('image_syncer_active_jobs', '実行中のバックグラウンドジョブ数',
+              callback=lambda: sum(1 for job in job_manager.list() if job.active))
+metrics.gauge('image_syncer_metadata_cache', 'メタデータキャッシュの件数とヒット数', ('value',),
+              callback=lambda: {(key,): value for key, value in metadata_cache.stats().items()
+                                if key in ('size', 'hits', 'misses')})
+metrics.gauge('image_syncer_hot_tier', 'ホット層の使用量とヒット数', ('value',),
+              callback=lambda: {(key,): value for key, value in hot_store.stats().items()
+                                if key in ('bytes', 'hits', 'misses', 'promoted')} if hot_store else {})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus のスクレイプ用（METRICS_TOKEN を設定した場合は Bearer トークンで認証）"""
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+            return jsonify({"error": "認証が必要です"}), 401
+    elif not session.get('logged_in'):
+        return jsonify({"error": "認証が必要です"}), 401
+    return Response(metrics.REGISTRY.expose(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/profiles', methods=['GET'])
+@login_required
+def list_profile_reports():
+    """保存済みのプロファイル・トレースのレポート（新しい順）"""
+    return jsonify({"reports": [
+        {"name": name, "url": url_for('get_profile_report', name=name)}
+        for name in profiling.list_reports()
+    ]})
+
+@app.route('/profiles/<name>', methods=['GET'])
+@login_required
+def get_profile_report(name):
+    """.txt は集計テキスト、.prof は pstats 形式、.json は Chrome トレース形式"""
+    path = profiling.report_path(name)
+    if not path:
+        return jsonify({"error": "レポートが見つかりません"}), 404
+    mimetypes_by_ext = {'.txt': 'text/plain', '.json': 'application/json', '.prof': 'application/octet-stream'}
+    return send_file(os.path.abspath(path), mimetype=mimetypes_by_ext[os.path.splitext(name)[1]],
+                     as_attachment=name.endswith('.prof'))
+
+@app.route('/cache/stats', methods=['GET'])
+@login_required
+def cache_stats():
+    """メタデータキャッシュのヒット率などを返す（キャッシュサイズ調整用）"""
     return jsonify({
-        "message": f"クリーンアップ完了: {len(cleaned_files)}個の不整合エントリを削除",
-        "cleaned_files": cleaned_files
+        "metadata_cache": metadata_cache.stats(),
+        "library_index": files_index.stats() if files_index else {"enabled": False},
+        "hot_tier": hot_store.stats() if hot_store else {"enabled": False},
+        "thumbnail_store": dict(store=thumbnails.THUMBNAIL_STORE, **thumbnails.packs.stats(get_db()))
     })
 
+@app.route('/storage/roots', methods=['GET'])
+@login_required
+def storage_root_stats():
+    """ルートごとの件数・使用量・空き容量・I/Oキューの長さ・最後のスキャン"""
+    return jsonify(storage.stats(get_db()))
+
 @app.route('/files', methods=['GET'])
 @login_required
 def list_files():
     """ファイル一覧取得（ページネーション対応）"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # ページネーションパラメータ
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)  # デフォルト50件
     offset = (page - 1) * per_page
+    # 種類での絞り込み（image / video）
+    file_type = request.args.get('type') or None
+    if file_type not in (None, 'image', 'video'):
+        return jsonify({"error": "type は image / video のいずれかです"}), 400
     
-    # 総件数を取得
-    cursor.execute("SELECT COUNT(*) FROM files")
-    total_count = cursor.fetchone()[0]
-    
-    # ページ分の데이터を取得
-    cursor.execute("""
-        SELECT id, original_name, filename, file_type, file_size, created_at, taken_date
-        FROM files
-        ORDER BY taken_date DESC, created_at DESC
-        LIMIT ? OFFSET ?
-    """, (per_page, offset))
+    if files_index and files_index.ready:
+        # メモリ上のインデックスでページの ID を求め、詳細だけを主キーで取得
+        total_count, page_ids = files_index.page(max(offset, 0), per_page, file_type)
+        found = fetch_rows_by_ids(cursor, page_ids, db.LIST_FILE_COLUMNS)
+        rows = [found[file_id] for file_id in page_ids if file_id in found]
+    else:
+        # 総件数を取得
+        if file_type:
+            cursor.execute(db.SQL_COUNT_FILES_BY_TYPE, (file_type,))
+        else:
+            cursor.execute(db.SQL_COUNT_FILES)
+        total_count = cursor.fetchone()[0]
+        
+        # ページ分の데이터を取得
+        if file_type:
+            cursor.execute(db.SQL_LIST_FILES_BY_TYPE, (file_type, per_page, offset))
+        else:
+            cursor.execute(db.SQL_LIST_FILES, (per_page, offset))
+        rows = cursor.fetchall()
     
     files = []
-    for row in cursor.fetchall():
+    for row in rows:
+        file_id, file_type, file_hash, thumbnail_hash = row[0], row[3], row[8], row[9]
         files.append({
-            "id": row[0],
+            "id": file_id,
             "original_name": row[1],
             "filename": row[2],
-            "file_type": row[3],
+            "file_type": file_type,
             "file_size": row[4],
             "created_at": row[5],
-            "taken_date": row[6]
+            "taken_date": row[6],
+            "mime_type": row[7],
+            # 内容が変わるとURLも変わるので、ブラウザは再検証なしでキャッシュを使える
+            "url": versioned_url(f"/files/{file_id}", file_version(file_hash)),
+            "thumbnail_url": versioned_url(
+                f"/thumbnails/{file_id}", thumbnail_version(file_type, file_hash, thumbnail_hash)
+            ),
+            # 対象外の動画ではマスタープレイリストが404になり、ビューアは元ファイルを再生する
+            "hls_url": f"/files/{file_id}/hls/master.m3u8" if hls_packager and file_type == 'video' else None
         })
     
     # ページネーション情報
@@ -886,12 +1389,9 @@ def list_files():
     has_next = page < total_pages
     has_prev = page > 1
     
-    # デバッグ用ログ
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    user_agent = request.headers.get('User-Agent', 'Unknown')
-    print(f"[DEBUG] /files request from {client_ip}, page {page}, returning {len(files)} files")
-    
-    conn.close()
+    # デバッグ用ログ（既定では出力しない）
+    if request_log.isEnabledFor(logging.DEBUG):
+        request_log.debug("list files", extra=dict(client_fields(), page=page, count=len(files)))
     
     response = jsonify({
         "files": files,
@@ -910,98 +1410,209 @@ def list_files():
     response.headers['Expires'] = '0'
     return response
 
+@app.route('/timeline', methods=['GET'])
+@login_required
+def timeline():
+    """撮影月ごとの件数（新しい月から、撮影日時のないものは month が null）"""
+    file_type = request.args.get('type') or None
+    if file_type not in (None, 'image', 'video'):
+        return jsonify({"error": "type は image / video のいずれかです"}), 400
+    if files_index and files_index.ready:
+        months = files_index.timeline(file_type)
+    else:
+        where, params = ("WHERE file_type = ?", (file_type,)) if file_type else ("", ())
+        months = get_db().execute(db.SQL_TIMELINE.format(where=where), params).fetchall()
+    return jsonify({
+        "months": [{"month": month, "count": count} for month, count in months],
+        "total_count": sum(count for _, count in months)
+    })
+
+def display_file(file_id, meta):
+    """表示用の (パス, MIMEタイプ)。派生画像が未作成なら作り、ついでに知覚ハッシュを埋める"""
+    def fill_phash(img):
+        try:
+            conn = get_db()
+            conn.execute(
+                "UPDATE files SET phash = ? WHERE id = ? AND phash IS NULL",
+                (similarity.to_db(similarity.dhash_image(img)), file_id)
+            )
+            conn.commit()
+        except Exception as e:
+            phash_log.warning("phash failed", extra={"file_id": file_id, "error": str(e)})
+
+    path = derivative_cache.get(meta.file_path, meta.file_hash, meta.derivative, on_decoded=fill_phash)
+    return path, derivatives.DerivativeCache.mimetype(meta.derivative)
+
+def media_path(file_id, meta, original=False):
+    """配信する (パス, MIMEタイプ)。元ファイルがない場合は None
+
+    作成済みの派生画像やホット層のコピーがあれば、HDD 上の元ファイルには触れない
+    （存在確認もしないので、ブラウズ中に HDD がスピンダウンできる）。
+    """
+    if meta.derivative and not original:
+        path = derivative_cache.cached(meta.file_hash, meta.derivative)
+        if path:
+            return path, derivatives.DerivativeCache.mimetype(meta.derivative)
+        if not Path(meta.file_path).exists():
+            return None
+        return display_file(file_id, meta)
+
+    if hot_store:
+        path = hot_store.lookup(meta.file_hash, meta.file_path)
+        if path:
+            return path, meta.mime_type
+    if not Path(meta.file_path).exists():
+        return None
+    return meta.file_path, meta.mime_type
+
 @app.route('/files/<file_id>', methods=['GET'])
 def get_file(file_id):
     """ファイル取得"""
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    user_agent = request.headers.get('User-Agent', 'Unknown')
-    
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT file_path, original_name, mime_type FROM files WHERE id = ?", (file_id,))
-    result = cursor.fetchone()
-    conn.close()
+    meta = get_file_meta(file_id)
     
-    if not result:
-        print(f"[DEBUG] File {file_id} not found in database")
+    if not meta:
+        request_log.debug("file not in database", extra={"file_id": file_id})
         return jsonify({"error": "ファイルが見つかりません"}), 404
     
-    file_path, original_name, mime_type = result
+    if request_log.isEnabledFor(logging.DEBUG):
+        request_log.debug("get file", extra=dict(client_fields(), file_id=file_id))
     
-    if not Path(file_path).exists():
-        print(f"[DEBUG] File {file_id} not found on disk: {file_path}")
+    # 派生画像がある場合は表示用の派生画像を返す（?original=1 で元ファイル）
+    original = bool(request.args.get('original'))
+    try:
+        found = media_path(file_id, meta, original=original)
+    except Exception as e:
+        derivative_log.error("derivative failed", extra={"file_id": file_id, "error": str(e)})
+        return jsonify({"error": "画像を表示できません"}), 500
+    if not found:
+        request_log.warning("file missing on disk", extra={"file_id": file_id, "path": meta.file_path})
         return jsonify({"error": "ファイルが存在しません"}), 404
     
-    print(f"[DEBUG] /files/{file_id} request from {client_ip} ({user_agent})")
+    file_path, mime_type = found
+    original_name = meta.original_name
+    if meta.derivative and not original:
+        original_name = Path(original_name).stem + derivatives.FORMATS[meta.derivative][0]
     
     # キャッシュヘッダーを追加してRange Requestを制御
-    response = send_file(
-        file_path, 
-        as_attachment=False, 
-        download_name=original_name, 
-        mimetype=mime_type,
-        conditional=True  # ETagとLast-Modifiedを有効化
-    )
+    # （SENDFILE_MODE 設定時は本体の送信をリバースプロキシに任せる）
+    response = send_media(file_path, mimetype=mime_type, download_name=original_name)
     
-    # キャッシュヘッダーを設定
-    response.headers['Cache-Control'] = 'public, max-age=31536000'  # 1年間キャッシュ
+    # キャッシュヘッダーを設定（?v= が現在の内容と一致する場合のみ immutable）
+    response.headers['Cache-Control'] = cache_control_for(file_version(meta.file_hash))
     response.headers['Accept-Ranges'] = 'bytes'  # Range Requestを許可
     
     return response
 
+@app.route('/files/<file_id>/hls/master.m3u8', methods=['GET'])
+def get_hls_master(file_id):
+    """HLSのマスタープレイリスト（初回の再生でレンディションの生成を開始する）"""
+    if not hls_packager:
+        return jsonify({"error": "HLS配信は無効です"}), 404
+
+    meta = get_file_meta(file_id)
+    if not meta or meta.file_type != 'video' or not meta.file_hash:
+        return jsonify({"error": "ファイルが見つかりません"}), 404
+    if not Path(meta.file_path).exists():
+        return jsonify({"error": "ファイルが存在しません"}), 404
+
+    try:
+        if not hls_packager.is_eligible(meta.file_path, os.path.getsize(meta.file_path), meta.file_hash):
+            return jsonify({"error": "HLS配信の対象外です"}), 404
+        playlist = hls_packager.master_playlist(meta.file_path, meta.file_hash, '/hls')
+    except Exception as e:
+        print(f"[HLS] マスタープレイリストの作成に失敗: {file_id}, {e}")
+        return jsonify({"error": "HLS配信を利用できません"}), 404
+
+    hls_packager.ensure(meta.file_path, meta.file_hash)
+    hls_packager.touch(meta.file_hash)
+    response = Response(playlist, mimetype=hls.MASTER_MIME_TYPE)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/hls/<key>/<int:rendition>/<name>', methods=['GET'])
+def get_hls_file(key, rendition, name):
+    """レンディションのプレイリストとセグメント"""
+    path = hls_packager.segment_path(key, rendition, name) if hls_packager else None
+    if not path:
+        return jsonify({"error": "ファイルが見つかりません"}), 404
+
+    is_playlist = name.endswith('.m3u8')
+    if not os.path.exists(path):
+        # 生成を始めた直後は最初のセグメントができるまで、リクエストで待たずに再試行してもらう
+        if is_playlist and hls_packager.is_generating(key):
+            response = jsonify({"error": "生成中です"})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(hls.PLAYLIST_RETRY_AFTER)
+            return response
+        return jsonify({"error": "ファイルが見つかりません"}), 404
+
+    response = send_media(path, mimetype=hls.MASTER_MIME_TYPE if is_playlist else hls.SEGMENT_MIME_TYPE)
+    # プレイリストは生成中に伸びるので毎回再検証、セグメントは内容のハッシュごとのディレクトリなので不変
+    response.headers['Cache-Control'] = 'no-cache' if is_playlist else IMMUTABLE_CACHE_CONTROL
+    return response
+
 @app.route('/thumbnails/<file_id>', methods=['GET'])
 def get_thumbnail(file_id):
     """サムネイル取得（画像の場合は元画像、動画の場合はサムネイル）"""
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    user_agent = request.headers.get('User-Agent', 'Unknown')
-    print(f"[DEBUG] /thumbnails/{file_id} request from {client_ip} ({user_agent})")
-    
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    if request_log.isEnabledFor(logging.DEBUG):
+        request_log.debug("get thumbnail", extra=dict(client_fields(), file_id=file_id))
     
-    cursor.execute("SELECT file_path, thumbnail_path, file_type, mime_type FROM files WHERE id = ?", (file_id,))
-    result = cursor.fetchone()
-    conn.close()
+    meta = get_file_meta(file_id)
     
-    if not result:
-        print(f"[DEBUG] Thumbnail for {file_id} not found in database")
+    if not meta:
+        request_log.debug("thumbnail not in database", extra={"file_id": file_id})
         return jsonify({"error": "ファイルが見つかりません"}), 404
     
-    file_path, thumbnail_path, file_type, mime_type = result
+    thumbnail_path, file_type = meta.thumbnail_path, meta.file_type
+    cache_control = cache_control_for(
+        thumbnail_version(file_type, meta.file_hash, meta.thumbnail_hash)
+    )
     
-    # 画像の場合は元画像を返す（HEICは既にJPEGに変換済み）
+    # 画像の場合は元画像を返す（HEICは変換済みのJPEG、lazy モードでは派生画像、ホット層にあればそのコピー）
     if file_type == 'image':
-        if Path(file_path).exists():
-            response = send_file(file_path, mimetype=mime_type, conditional=True)
-            response.headers['Cache-Control'] = 'public, max-age=86400'  # 24時間キャッシュ
-            return response
-        else:
-            print(f"[DEBUG] Image file {file_id} not found on disk: {file_path}")
+        try:
+            found = media_path(file_id, meta)
+        except Exception as e:
+            derivative_log.error("derivative failed", extra={"file_id": file_id, "error": str(e)})
+            return jsonify({"error": "画像を表示できません"}), 500
+        if not found:
+            request_log.warning("file missing on disk", extra={"file_id": file_id, "path": meta.file_path})
             return jsonify({"error": "ファイルが存在しません"}), 404
+        file_path, mime_type = found
+        response = send_media(file_path, mimetype=mime_type)
+        response.headers['Cache-Control'] = cache_control
+        return response
     
     # 動画の場合はサムネイルを返す
-    if thumbnail_path and Path(thumbnail_path).exists():
-        response = send_file(thumbnail_path, mimetype='image/jpeg', conditional=True)
-        response.headers['Cache-Control'] = 'public, max-age=86400'  # 24時間キャッシュ
+    found = thumbnails.locate(file_id, thumbnail_path) if thumbnail_path else None
+    if found:
+        response = send_media(found, mimetype='image/jpeg')
+        response.headers['Cache-Control'] = cache_control
+        return response
+    
+    # パックに保存したサムネイルはパックファイルの mmap から読んで返す
+    # （保存方式の移行直後で、キャッシュのパスが古い場合もパックを探す）
+    data = thumbnails.read_packed(get_db(), file_id) if thumbnail_path else None
+    if data is not None:
+        response = send_buffer(data, mimetype='image/jpeg', etag=meta.thumbnail_hash)
+        response.headers['Cache-Control'] = cache_control
         return response
     
     # サムネイルがない場合はデフォルト画像やエラーを返す
-    print(f"[DEBUG] Thumbnail for {file_id} not found on disk: {thumbnail_path}")
+    request_log.debug("thumbnail missing", extra={"file_id": file_id, "path": thumbnail_path})
     return jsonify({"error": "サムネイルが見つかりません"}), 404
 
 @app.route('/files/<file_id>', methods=['DELETE'])
 @login_required
 def delete_file(file_id):
     """ファイル削除"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT file_path, thumbnail_path FROM files WHERE id = ?", (file_id,))
+    cursor.execute(db.SQL_DELETE_TARGET_BY_ID, (file_id,))
     result = cursor.fetchone()
     
     if not result:
-        conn.close()
         return jsonify({"error": "ファイルが見つかりません"}), 404
     
     file_path, thumbnail_path = result
@@ -1012,21 +1623,331 @@ def delete_file(file_id):
             Path(file_path).unlink()
         
         # サムネイル削除
-        if thumbnail_path and Path(thumbnail_path).exists():
-            Path(thumbnail_path).unlink()
+        if thumbnail_path:
+            thumbnails.remove(file_id, thumbnail_path)
         
         # データベースから削除
         cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
         conn.commit()
-        conn.close()
+        forget_files([file_id])
         
         return jsonify({"message": "ファイルが削除されました"})
         
     except Exception as e:
         conn.rollback()
-        conn.close()
         return jsonify({"error": f"削除エラー: {str(e)}"}), 500
 
+def get_request_ids():
+    """リクエストからファイルIDのリストを取得（JSON の ids またはフォームの ids）"""
+    if request.is_json:
+        ids = (request.get_json(silent=True) or {}).get('ids') or []
+    else:
+        ids = []
+        for value in request.form.getlist('ids'):
+            ids.extend(v for v in value.split(',') if v)
+    # 重複を除き、指定された順序を保つ
+    return list(dict.fromkeys(str(i) for i in ids))
+
+def fetch_rows_by_ids(cursor, ids, columns, chunk_size=500):
+    """IDのリストで行を取得（SQLiteの変数上限を超えないよう分割）"""
+    rows = {}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f"SELECT id, {columns} FROM files WHERE id IN ({placeholders})", chunk)
+        for row in cursor.fetchall():
+            rows[row[0]] = row[1:]
+    return rows
+
+@app.route('/download', methods=['POST'])
+@login_required
+def download_files():
+    """選択したファイルを無圧縮ZIPとしてストリーミングでまとめてダウンロード
+
+    一時ファイルを作らずに生成しながら送信する。サイズは事前に確定するため
+    Content-Length を返し、Rangeリクエストによる再開にも対応する。
+    """
+    ids = get_request_ids()
+    if not ids:
+        return jsonify({"error": "ファイルが選択されていません"}), 400
+
+    rows = fetch_rows_by_ids(get_db().cursor(), ids, "original_name, file_path")
+
+    names, paths = [], []
+    for file_id in ids:
+        if file_id not in rows:
+            continue
+        original_name, file_path = rows[file_id]
+        if not Path(file_path).exists():
+            continue
+        names.append(original_name)
+        paths.append(file_path)
+
+    if not paths:
+        return jsonify({"error": "ファイルが見つかりません"}), 404
+
+    archive = StreamingZip(list(zip(unique_names(names), paths)))
+    etag = archive.etag()
+
+    start, stop, status = 0, archive.size, 200
+    if request.range is not None and len(request.range.ranges) == 1:
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range.strip('"') == etag:
+            byte_range = request.range.range_for_length(archive.size)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f"bytes */{archive.size}"
+                return response
+            start, stop = byte_range
+            status = 206
+
+    download_name = f"image-syncer-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    response = Response(
+        archive.iter_bytes(start, stop), status=status,
+        mimetype='application/zip', direct_passthrough=True
+    )
+    response.content_length = stop - start
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'no-store'
+    response.set_etag(etag)
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{archive.size}"
+    return response
+
+def unlink_quietly(path):
+    """ファイルを削除（存在しない場合やエラーは無視してFalseを返す）"""
+    try:
+        Path(path).unlink()
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        delete_log.warning("unlink failed", extra={"path": str(path), "error": str(e)})
+        return False
+
+@app.route('/files/batch-delete', methods=['POST'])
+@login_required
+def batch_delete_files():
+    """複数ファイルを一括削除
+
+    データベースの行は1トランザクションでまとめて削除し、ファイルとサムネイルの削除は
+    I/Oスレッドプールで非同期に行う（レスポンスはファイル削除の完了を待たない）。
+    """
+    ids = get_request_ids()
+    if not ids:
+        return jsonify({"error": "ファイルが選択されていません"}), 400
+
+    conn = get_db()
+    cursor = conn.cursor()
+    rows = fetch_rows_by_ids(cursor, ids, "file_path, thumbnail_path")
+
+    found_ids = [file_id for file_id in ids if file_id in rows]
+    try:
+        cursor.executemany("DELETE FROM files WHERE id = ?", [(file_id,) for file_id in found_ids])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": f"削除エラー: {str(e)}"}), 500
+
+    forget_files(found_ids)
+    for file_id in found_ids:
+        file_path, thumbnail_path = rows[file_id]
+        # 元ファイルはそのディスクのI/Oワーカーで削除する
+        storage.submit(file_path, unlink_quietly, file_path, fallback=io_pool)
+        if thumbnail_path:
+            io_pool.submit(thumbnails.remove, file_id, thumbnail_path)
+
+    results = [
+        {"id": file_id, "status": "deleted" if file_id in rows else "not_found"}
+        for file_id in ids
+    ]
+    delete_log.info("batch delete", extra={"deleted": len(found_ids), "requested": len(ids)})
+    return jsonify({
+        "message": f"{len(found_ids)}個のファイルが削除されました",
+        "deleted": len(found_ids),
+        "not_found": len(ids) - len(found_ids),
+        "results": results
+    })
+
+SIMILAR_FILE_COLUMNS = "original_name, file_type, file_size, taken_date, file_hash, thumbnail_hash"
+
+def similar_file_summary(file_id, row):
+    """類似画像検索の結果に含めるファイル情報"""
+    original_name, file_type, file_size, taken_date, file_hash, thumbnail_hash = row
+    return {
+        "id": file_id,
+        "original_name": original_name,
+        "file_type": file_type,
+        "file_size": file_size,
+        "taken_date": taken_date,
+        "url": versioned_url(f"/files/{file_id}", file_version(file_hash)),
+        "thumbnail_url": versioned_url(
+            f"/thumbnails/{file_id}", thumbnail_version(file_type, file_hash, thumbnail_hash)
+        )
+    }
+
+def get_distance_param(default):
+    """?distance= を取得（範囲外なら None）"""
+    distance = request.args.get('distance', default, type=int)
+    if distance is None or not 0 <= distance <= similarity.MAX_DISTANCE:
+        return None
+    return distance
+
+def fetch_existing_rows(cursor, ids):
+    """IDの行を取得し、他のプロセスで削除済みのものはインデックスからも除く"""
+    rows = fetch_rows_by_ids(cursor, ids, SIMILAR_FILE_COLUMNS)
+    missing = [file_id for file_id in ids if file_id not in rows]
+    if missing:
+        near_duplicates.remove(missing)
+    return rows
+
+@app.route('/files/<file_id>/similar', methods=['GET'])
+@login_required
+def similar_files(file_id):
+    """知覚ハッシュのハミング距離が distance 以内の画像を距離の近い順に返す"""
+    distance = get_distance_param(similarity.DEFAULT_DISTANCE)
+    if distance is None:
+        return jsonify({"error": f"distance は 0〜{similarity.MAX_DISTANCE} で指定してください"}), 400
+
+    cursor = get_db().cursor()
+    cursor.execute("SELECT phash FROM files WHERE id = ?", (file_id,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({"error": "ファイルが見つかりません"}), 404
+    if row[0] is None:
+        return jsonify({"error": "このファイルの知覚ハッシュは未計算です（POST /similar/backfill）"}), 409
+
+    matches = near_duplicates.similar(file_id, distance)
+    rows = fetch_existing_rows(cursor, [other_id for other_id, _ in matches])
+    return jsonify({
+        "id": file_id,
+        "distance": distance,
+        "files": [
+            dict(similar_file_summary(other_id, rows[other_id]), distance=d)
+            for other_id, d in matches if other_id in rows
+        ]
+    })
+
+@app.route('/similar/groups', methods=['GET'])
+@login_required
+def similar_groups():
+    """ライブラリ全体の近似重複グループ（距離 distance 以内で推移的につながる画像）
+
+    distance が similarity.CHUNK_COUNT 未満ならチャンクの完全一致だけで済むので速い。
+    """
+    distance = get_distance_param(similarity.DEFAULT_GROUP_DISTANCE)
+    if distance is None:
+        return jsonify({"error": f"distance は 0〜{similarity.MAX_DISTANCE} で指定してください"}), 400
+    limit = max(request.args.get('limit', 100, type=int) or 100, 1)
+
+    groups = near_duplicates.groups(distance)
+    groups.sort(key=len, reverse=True)
+
+    cursor = get_db().cursor()
+    rows = fetch_existing_rows(cursor, [file_id for group in groups[:limit] for file_id in group])
+    result = []
+    for group in groups[:limit]:
+        files = [similar_file_summary(file_id, rows[file_id]) for file_id in group if file_id in rows]
+        if len(files) > 1:
+            result.append({"count": len(files), "files": files})
+    return jsonify({
+        "distance": distance,
+        "group_count": len(groups),
+        "groups": result
+    })
+
+@app.route('/similar/backfill', methods=['POST'])
+@login_required
+def similar_backfill():
+    """知覚ハッシュが未計算の既存画像について計算するジョブを開始"""
+    job, started = job_manager.start(
+        'phash_backfill',
+        lambda job: similarity.backfill(job, db_pool, near_duplicates)
+    )
+    return jsonify({
+        "message": "知覚ハッシュの計算を開始しました" if started else "知覚ハッシュの計算は既に実行中です",
+        "job": job.to_dict()
+    }), 202
+
+def duplicate_group_summary(group):
+    """重複レポートの1グループ分（NDJSONの1行）"""
+    return {
+        "file_hash": group.file_hash,
+        "count": len(group.rows),
+        "file_size": group.file_size,
+        "reclaimable_bytes": group.reclaimable_bytes,
+        "files": [
+            {
+                "id": row.id,
+                "original_name": row.original_name,
+                "file_path": row.file_path,
+                "created_at": row.created_at,
+                "taken_date": row.taken_date,
+                "url": versioned_url(f"/files/{row.id}", file_version(row.file_hash))
+            }
+            for row in group.rows
+        ]
+    }
+
+@app.route('/duplicates', methods=['GET'])
+@login_required
+def list_duplicates():
+    """内容が同じ（file_hash が一致する）ファイルのグループを NDJSON でストリーミング
+
+    1行に1グループを書き、最後の行に合計（{"summary": ...}）を書く。
+    """
+    def generate():
+        groups = files = reclaimable = 0
+        with db_pool.connection() as conn:
+            for group in duplicates.iter_duplicate_groups(conn):
+                groups += 1
+                files += len(group.rows)
+                reclaimable += group.reclaimable_bytes
+                yield json.dumps(duplicate_group_summary(group), ensure_ascii=False) + "\n"
+        yield json.dumps({"summary": {
+            "groups": groups,
+            "files": files,
+            "reclaimable_bytes": reclaimable
+        }}) + "\n"
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/duplicates/reclaim', methods=['POST'])
+@login_required
+def reclaim_duplicates():
+    """重複グループごとに1件だけ残し、残りの行とファイルを削除するジョブを開始
+
+    JSON: {"keep": "oldest" | "newest", "hashes": [...], "dry_run": false}
+    hashes を省略するとすべての重複グループが対象。dry_run では削除せずに結果だけを返す。
+    """
+    options = request.get_json(silent=True) or {}
+    keep = options.get('keep', 'oldest')
+    if keep not in duplicates.KEEP_POLICIES:
+        return jsonify({"error": f"keep は {' / '.join(duplicates.KEEP_POLICIES)} のいずれかです"}), 400
+    hashes = options.get('hashes')
+    if hashes is not None and not isinstance(hashes, list):
+        return jsonify({"error": "hashes はリストで指定してください"}), 400
+    params = {
+        "keep": keep,
+        "hashes": [str(h) for h in hashes] if hashes is not None else None,
+        "dry_run": bool(options.get('dry_run', False))
+    }
+
+    job, started = job_manager.start(
+        'dedupe',
+        lambda job: duplicates.reclaim(
+            job, db_pool, on_removed=forget_files, unlink=unlink_quietly, **params
+        ),
+        params
+    )
+    return jsonify({
+        "message": "重複ファイルの整理を開始しました" if started else "重複ファイルの整理は既に実行中です",
+        "job": job.to_dict()
+    }), 202
+
 # Service Worker
 
 SERVICE_WORKER_JS = """
@@ -1741,7 +2662,7 @@ self.addEventListener('fetch', (event) => {
 """
 
 if __name__ == '__main__':
-    init_db()
+    create_app()
     
     # 外部ストレージの自動スキャン（環境変数で制御）
     auto_scan = os.environ.get('AUTO_SCAN_STORAGE', 'false').lower() == 'true'  # デフォルトをfalseに変更
@@ -1756,25 +2677,25 @@ if __name__ == '__main__':
     else:
         print("[STARTUP] Auto-scan disabled. Use /scan endpoint to scan manually.")
     
-    # デバッグ: 起動時にデータベースの内容を確認
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, original_name, file_type FROM files")
-    all_files = cursor.fetchall()
-    print(f"[STARTUP] Database contains {len(all_files)} files:")
-    for file_id, name, file_type in all_files:
-        print(f"  - {file_id}: {name} ({file_type})")
-    conn.close()
+    # 起動時にデータベースの件数を確認（全件の一覧は出力しない）
+    with db_pool.connection() as conn:
+        counts = dict(conn.execute("SELECT file_type, COUNT(*) FROM files GROUP BY file_type").fetchall())
+    summary = ', '.join(f"{file_type}: {count}" for file_type, count in sorted(counts.items()))
+    print(f"[STARTUP] Database contains {sum(counts.values())} files ({summary or 'empty'})")
     
     # 外部ストレージパスの表示
-    print(f"[STARTUP] External storage path: {EXTERNAL_STORAGE_DIR}")
+    for root in storage:
+        print(f"[STARTUP] Storage root {root.name}: {root.path}")
     print(f"[STARTUP] Thumbnails path: {THUMBNAILS_DIR}")
+    if hot_store:
+        print(f"[STARTUP] Hot tier path: {hot_store.cache_dir}")
     
     # LAN内アクセス用の設定
     print("=" * 50)
     print("Image Syncer サーバーを起動中...")
     print("=" * 50)
-    print("ローカルアクセス: http://127.0.0.1:5000")
-    print("LAN内アクセス: http://172.26.155.97:5000")
+    port = int(os.environ.get('PORT', '5000'))
+    print(f"ローカルアクセス: http://127.0.0.1:{port}")
+    print(f"LAN内アクセス: http://172.26.155.97:{port}")
     print("=" * 50)
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
+    app.run(host=os.environ.get('HOST', '0.0.0.0'), port=port, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""2つのベンチマーク結果の比較
+
+    python benchmarks/compare.py results/before.json results/after.json
+
+項目ごとに p50 と合計時間の変化率を表示する（負の値が高速化）。
+"""
+import json
+import sys
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def change(before, after):
+    if not before:
+        return '      -'
+    return f"{(after - before) / before * 100:+6.1f}%"
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(2)
+    before, after = load(sys.argv[1]), load(sys.argv[2])
+    print(f"before: {before['meta'].get('commit')} {before['meta'].get('library')}")
+    print(f"after:  {after['meta'].get('commit')} {after['meta'].get('library')}")
+    if before['meta'].get('library') != after['meta'].get('library'):
+        print("[BENCH] 注意: ライブラリの構成が異なります")
+
+    names = list(before['results']) + [n for n in after['results'] if n not in before['results']]
+    for name in names:
+        old, new = before['results'].get(name), after['results'].get(name)
+        if not old or not new:
+            print(f"  {name:<20} （片方のみ）")
+            continue
+        print(f"  {name:<20} p50 {old['p50_s'] * 1000:9.2f}ms -> {new['p50_s'] * 1000:9.2f}ms "
+              f"{change(old['p50_s'], new['p50_s'])}   total {change(old['total_s'], new['total_s'])}")
+
+
+if __name__ == '__main__':
+    main()
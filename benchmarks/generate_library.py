@@ -0,0 +1,167 @@
+"""ベンチマーク用の合成ライブラリを作成
+
+外部ストレージと同じ YYYYMM フォルダ構成で、EXIF付きJPEG・PNG・HEIC・短い動画を作る。
+乱数のシードが同じなら同じ内容のライブラリができる。
+
+    python benchmarks/generate_library.py --out /tmp/library --images 1000 --videos 20
+
+動画はローカルの ffmpeg で作るので、ffmpeg がない場合は作らない。
+HEIC は pillow_heif のエンコーダがない場合は作らない。
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+from PIL import Image, ImageDraw
+
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+
+def _month_folders(months, end=datetime(2024, 12, 1)):
+    folders = []
+    year, month = end.year, end.month
+    for _ in range(months):
+        folders.append(f"{year}{month:02d}")
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return folders
+
+
+def _taken_date(rng, folder):
+    start = datetime(int(folder[:4]), int(folder[4:]), 1)
+    return start + timedelta(seconds=rng.randrange(27 * 24 * 3600))
+
+
+def _render(rng, size):
+    """ファイルごとに内容が異なる画像（グラデーションと矩形）"""
+    width, height = size
+    base = Image.linear_gradient('L').resize(size).convert('RGB')
+    tint = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    img = Image.blend(base, tint, 0.5)
+    draw = ImageDraw.Draw(img)
+    for _ in range(8):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(1, width // 3), y0 + rng.randrange(1, height // 3)
+        draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img
+
+
+def _exif(taken):
+    exif = Image.Exif()
+    stamp = taken.strftime('%Y:%m:%d %H:%M:%S')
+    exif[EXIF_DATETIME] = stamp
+    exif.get_ifd(EXIF_IFD)[EXIF_DATETIME_ORIGINAL] = stamp
+    return exif
+
+
+def heic_supported():
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        return bool(pillow_heif.libheif_info().get('HEIF'))
+    except Exception:
+        return False
+
+
+def make_video(path, seconds, size, seed):
+    """testsrc の短い H.264 動画を作る（ffmpeg がなければ False）"""
+    width, height = size
+    command = [
+        'ffmpeg', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f"testsrc=duration={seconds}:size={width}x{height}:rate=30",
+        '-f', 'lavfi', '-i', f"sine=frequency={200 + seed % 800}:duration={seconds}",
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest',
+        # 同じ設定の動画でもハッシュが変わるようにメタデータに番号を入れる
+        '-metadata', f"comment=benchmark-{seed}",
+        str(path)
+    ]
+    return subprocess.run(command, capture_output=True).returncode == 0
+
+
+def generate(out, images=500, pngs=50, heics=50, videos=10, months=12,
+             image_size=(1024, 768), video_seconds=2, seed=1):
+    """ライブラリを作成して種類ごとの件数を返す"""
+    rng = random.Random(seed)
+    folders = _month_folders(months)
+    for folder in folders:
+        os.makedirs(os.path.join(out, folder), exist_ok=True)
+
+    counts = {"jpeg": 0, "png": 0, "heic": 0, "video": 0}
+    for i in range(images):
+        folder = rng.choice(folders)
+        taken = _taken_date(rng, folder)
+        _render(rng, image_size).save(
+            os.path.join(out, folder, f"IMG_{i:06d}.jpg"), 'JPEG', quality=85, exif=_exif(taken))
+        counts["jpeg"] += 1
+
+    for i in range(pngs):
+        folder = rng.choice(folders)
+        _render(rng, image_size).save(os.path.join(out, folder, f"SCREEN_{i:06d}.png"), 'PNG')
+        counts["png"] += 1
+
+    if heics and heic_supported():
+        for i in range(heics):
+            folder = rng.choice(folders)
+            taken = _taken_date(rng, folder)
+            _render(rng, image_size).save(
+                os.path.join(out, folder, f"IMG_{i:06d}.HEIC"), 'HEIF', quality=80, exif=_exif(taken))
+            counts["heic"] += 1
+    elif heics:
+        print("[BENCH] HEIC のエンコーダがないため HEIC は作成しません", file=sys.stderr)
+
+    if videos and shutil.which('ffmpeg'):
+        for i in range(videos):
+            folder = rng.choice(folders)
+            if make_video(os.path.join(out, folder, f"MOV_{i:06d}.mp4"), video_seconds, (320, 240), seed * 100000 + i):
+                counts["video"] += 1
+    elif videos:
+        print("[BENCH] ffmpeg がないため動画は作成しません", file=sys.stderr)
+
+    return counts
+
+
+def make_upload_image(index, size=(1024, 768), seed=1):
+    """アップロード用の JPEG（バイト列）"""
+    import io
+    rng = random.Random(seed * 1000003 + index)
+    buffer = io.BytesIO()
+    _render(rng, size).save(buffer, 'JPEG', quality=85, exif=_exif(datetime(2024, 1, 1) + timedelta(minutes=index)))
+    return buffer.getvalue()
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+def add_arguments(parser):
+    parser.add_argument('--images', type=int, default=500, help='JPEG の数')
+    parser.add_argument('--pngs', type=int, default=50, help='PNG の数')
+    parser.add_argument('--heics', type=int, default=50, help='HEIC の数')
+    parser.add_argument('--videos', type=int, default=10, help='動画の数（ffmpeg が必要）')
+    parser.add_argument('--months', type=int, default=12, help='YYYYMM フォルダの数')
+    parser.add_argument('--image-size', type=parse_size, default=(1024, 768), help='画像サイズ（例: 1024x768）')
+    parser.add_argument('--video-seconds', type=int, default=2, help='動画の長さ（秒）')
+    parser.add_argument('--seed', type=int, default=1, help='乱数のシード')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', required=True, help='作成先のディレクトリ')
+    add_arguments(parser)
+    args = parser.parse_args()
+    counts = generate(
+        args.out, images=args.images, pngs=args.pngs, heics=args.heics, videos=args.videos,
+        months=args.months, image_size=args.image_size, video_seconds=args.video_seconds, seed=args.seed
+    )
+    print(f"[BENCH] ライブラリを作成しました: {args.out} {counts}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""起動中のサーバーに対する負荷試験
+
+PWA の利用を模した仮想ユーザーを同時に動かし、ルートごとのスループットと
+p50 / p95 / p99 のレイテンシを出力する。各仮想ユーザーは次を繰り返す。
+
+1. ログイン
+2. /files を1ページずつ読み進める（無限スクロール）
+3. ページごとに、表示された分のサムネイルをブラウザと同じく複数接続で一度に取得する
+4. 一定の確率で動画を Range リクエストで再生する（先頭と途中のシーク）
+5. 一定の確率でアップロードする（--upload-ratio、既定では行わない）
+
+    python benchmarks/loadtest.py --url http://127.0.0.1:5000 --users 20 --duration 60
+
+アップロードは実際にライブラリへファイルを追加するので、検証用のサーバーでのみ有効にすること。
+アップロード以外は標準ライブラリだけで動くので、サーバーとは別のマシンからも実行できる
+（アップロードには Pillow が必要）。
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 集計用にURLのIDをまとめる（/thumbnails/<id> など）
+ROUTE_PATTERNS = [
+    (re.compile(r'^/thumbnails/[^/?]+'), '/thumbnails/<id>'),
+    (re.compile(r'^/files/[^/?]+$'), '/files/<id>'),
+]
+
+
+def route_of(method, path, label=None):
+    if label:
+        return f"{method} {label}"
+    path = path.split('?', 1)[0]
+    for pattern, route in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return f"{method} {route}"
+    return f"{method} {path}"
+
+
+class Recorder:
+    """ルートごとのレイテンシ・ステータス・バイト数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def add(self, route, seconds, status, size):
+        with self._lock:
+            entry = self.routes.setdefault(route, {"latencies": [], "statuses": {}, "errors": 0, "bytes": 0})
+            entry["latencies"].append(seconds)
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["bytes"] += size
+            if status == 'error' or (isinstance(status, int) and status >= 500):
+                entry["errors"] += 1
+
+    def summary(self, elapsed):
+        def percentile(ordered, p):
+            return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+        result = {}
+        with self._lock:
+            items = sorted(self.routes.items())
+        for route, entry in items:
+            ordered = sorted(entry["latencies"])
+            result[route] = {
+                "count": len(ordered),
+                "rps": round(len(ordered) / elapsed, 2),
+                "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2),
+                "errors": entry["errors"],
+                "statuses": {str(k): v for k, v in entry["statuses"].items()},
+                "mb_per_s": round(entry["bytes"] / elapsed / 1024 ** 2, 2),
+            }
+        return result
+
+
+class Connection:
+    """keep-alive で使い回す HTTP 接続"""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self._conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """(ステータス, レスポンス, 本体) を返す。接続が切れていたら1回だけ再接続する"""
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = self._connect()
+            try:
+                self._conn.request(method, path, body=body, headers=headers or {})
+                response = self._conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, response, data
+            except (http.client.HTTPException, ConnectionError, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class VirtualUser:
+    def __init__(self, index, options, recorder, deadline):
+        self.rng = random.Random(options.seed * 1000 + index)
+        self.options = options
+        self.recorder = recorder
+        self.deadline = deadline
+        self.cookie = None
+        self.main = Connection(options.url, options.timeout)
+        self._local = threading.local()
+        self._burst_pool = ThreadPoolExecutor(max_workers=options.parallel)
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.uploads = 0
+
+    def _burst_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = Connection(self.options.url, self.options.timeout)
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _headers(self, extra=None):
+        headers = dict(extra or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        return headers
+
+    def call(self, method, path, conn=None, body=None, headers=None, label=None):
+        conn = conn or self.main
+        started = time.perf_counter()
+        try:
+            status, response, data = conn.request(method, path, body, self._headers(headers))
+        except Exception:
+            self.recorder.add(route_of(method, path, label), time.perf_counter() - started, 'error', 0)
+            return None, None, b''
+        self.recorder.add(route_of(method, path, label), time.perf_counter() - started, status, len(data))
+        return status, response, data
+
+    def login(self):
+        body = urlencode({'username': self.options.username, 'password': self.options.password})
+        status, response, _ = self.call('POST', '/login', body=body,
+                                        headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        cookie = response.getheader('Set-Cookie') if response else None
+        if not cookie:
+            raise RuntimeError(f"ログインに失敗しました（ステータス {status}）")
+        self.cookie = cookie.split(';', 1)[0]
+
+    def think(self):
+        if self.options.think_time:
+            time.sleep(self.rng.uniform(0, self.options.think_time * 2))
+
+    def fetch_thumbnails(self, files):
+        def fetch(item):
+            self.call('GET', item['thumbnail_url'], conn=self._burst_connection())
+        list(self._burst_pool.map(fetch, files))
+
+    def play_video(self, item):
+        url = item['url']
+        chunk = self.options.range_size
+        status, response, _ = self.call('GET', url, headers={'Range': f'bytes=0-{chunk - 1}'},
+                                        label='/files/<id> (range)')
+        total = None
+        if response is not None:
+            match = re.search(r'/(\d+)$', response.getheader('Content-Range', ''))
+            total = int(match.group(1)) if match else None
+        if total and total > chunk * 2:
+            # 途中へのシーク
+            start = self.rng.randrange(chunk, total - chunk)
+            self.call('GET', url, headers={'Range': f'bytes={start}-{start + chunk - 1}'},
+                      label='/files/<id> (range)')
+
+    def upload(self):
+        import generate_library
+        boundary = uuid.uuid4().hex
+        data = generate_library.make_upload_image(self.rng.randrange(1 << 30), (1024, 768), self.options.seed)
+        name = f"loadtest_{uuid.uuid4().hex[:12]}.jpg"
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{name}\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n"
+        ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        self.call('POST', '/upload', body=body,
+                  headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        self.uploads += 1
+
+    def session(self):
+        """ログインしてから終了時刻までスクロールを繰り返す"""
+        self.login()
+        while time.monotonic() < self.deadline:
+            for page in range(1, self.options.pages + 1):
+                if time.monotonic() >= self.deadline:
+                    break
+                status, _, data = self.call(
+                    'GET', f'/files?page={page}&per_page={self.options.per_page}')
+                if status != 200:
+                    break
+                listing = json.loads(data)
+                files = listing.get('files', [])
+                self.fetch_thumbnails(files)
+
+                videos = [f for f in files if f.get('file_type') == 'video']
+                if videos and self.rng.random() < self.options.video_ratio:
+                    self.play_video(self.rng.choice(videos))
+                if self.rng.random() < self.options.upload_ratio:
+                    self.upload()
+                self.think()
+                if not listing.get('pagination', {}).get('has_next'):
+                    break
+
+    def run(self):
+        try:
+            self.session()
+        except Exception as e:
+            print(f"[LOADTEST] 仮想ユーザーのエラー: {e}", file=sys.stderr)
+        finally:
+            self._burst_pool.shutdown(wait=True)
+            self.main.close()
+            with self._connections_lock:
+                for conn in self._connections:
+                    conn.close()
+
+
+def run(options):
+    sys.path.insert(0, BENCH_DIR)
+    recorder = Recorder()
+    started = time.monotonic()
+    deadline = started + options.duration
+    users = []
+    threads = []
+    for i in range(options.users):
+        user = VirtualUser(i, options, recorder, deadline)
+        thread = threading.Thread(target=user.run, name=f"vu-{i}", daemon=True)
+        users.append(user)
+        threads.append(thread)
+        thread.start()
+        # 全員が同時にログインしないよう、ランプアップ時間に分散して開始する
+        if options.ramp_up and i < options.users - 1:
+            time.sleep(options.ramp_up / options.users)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    routes = recorder.summary(elapsed)
+    total = sum(r["count"] for r in routes.values())
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "url": options.url,
+            "users": options.users,
+            "parallel": options.parallel,
+            "duration_s": round(elapsed, 2),
+            "uploads": sum(u.uploads for u in users),
+        },
+        "total": {"count": total, "rps": round(total / elapsed, 2),
+                  "errors": sum(r["errors"] for r in routes.values())},
+        "routes": routes
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='サーバーのURL')
+    parser.add_argument('--username', default=os.environ.get('ADMIN_USERNAME', 'admin'))
+    parser.add_argument('--password', default=os.environ.get('ADMIN_PASSWORD', 'password'))
+    parser.add_argument('--users', type=int, default=10, help='同時に動かす仮想ユーザー数')
+    parser.add_argument('--duration', type=float, default=30, help='実行時間（秒）')
+    parser.add_argument('--ramp-up', type=float, default=5, help='全ユーザーが開始するまでの時間（秒）')
+    parser.add_argument('--parallel', type=int, default=6, help='1ユーザーがサムネイル取得に使う接続数')
+    parser.add_argument('--pages', type=int, default=10, help='1回のスクロールで読み進めるページ数')
+    parser.add_argument('--per-page', type=int, default=50, help='/files の1ページの件数')
+    parser.add_argument('--think-time', type=float, default=0.5, help='ページ間の平均待ち時間（秒）')
+    parser.add_argument('--video-ratio', type=float, default=0.2, help='ページごとに動画を再生する確率')
+    parser.add_argument('--range-size', type=int, default=1024 * 1024, help='動画の Range リクエストのサイズ')
+    parser.add_argument('--upload-ratio', type=float, default=0.0, help='ページごとにアップロードする確率')
+    parser.add_argument('--timeout', type=float, default=30, help='リクエストのタイムアウト（秒）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='結果の JSON の保存先')
+    options = parser.parse_args()
+
+    report = run(options)
+    print(f"{'route':<32} {'count':>7} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for route, r in report["routes"].items():
+        print(f"{route:<32} {r['count']:>7} {r['rps']:>8} {r['p50_ms']:>7}ms {r['p95_ms']:>7}ms "
+              f"{r['p99_ms']:>7}ms {r['errors']:>7}")
+    total = report["total"]
+    print(f"合計 {total['count']}件, {total['rps']} req/s, エラー {total['errors']}件 "
+          f"({report['meta']['duration_s']}秒, {options.users}ユーザー)")
+    if options.output:
+        os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[LOADTEST] 結果を保存しました: {options.output}")
+
+
+if __name__ == '__main__':
+    main()
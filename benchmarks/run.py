@@ -0,0 +1,189 @@
+"""ベンチマークの実行
+
+合成ライブラリを一時ディレクトリに作成し、アプリをプロセス内で読み込んで
+次の処理の時間を計測し、結果を JSON で保存する。
+
+- scan_cold: 空のデータベースへの初回スキャン
+- scan_rescan: 変更のないライブラリの再スキャン
+- files_page_first / files_page_middle / files_page_last: /files の先頭・中間・末尾のページ
+- thumbnail: /thumbnails/<id>（本体の読み出しまで）
+- upload: /upload（1リクエスト1ファイル）
+
+    python benchmarks/run.py --images 2000 --videos 20 --output results/baseline.json
+    python benchmarks/compare.py results/baseline.json results/after.json
+
+HTTP はテストクライアントで呼ぶので、ネットワークと WSGI サーバーの時間は含まない。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+import generate_library  # noqa: E402
+
+
+def summarize(samples):
+    """計測値（秒）の要約"""
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "n": len(ordered),
+        "total_s": round(sum(ordered), 6),
+        "mean_s": round(statistics.fmean(ordered), 6),
+        "p50_s": round(percentile(50), 6),
+        "p95_s": round(percentile(95), 6),
+        "min_s": round(ordered[0], 6),
+        "max_s": round(ordered[-1], 6),
+    }
+
+
+def measure(func, repeat=1):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='image-syncer-bench-')
+    original_cwd = os.getcwd()
+    library = os.path.join(workdir, 'library')
+    try:
+        started = time.perf_counter()
+        counts = generate_library.generate(
+            library, images=args.images, pngs=args.pngs, heics=args.heics, videos=args.videos,
+            months=args.months, image_size=args.image_size, video_seconds=args.video_seconds, seed=args.seed
+        )
+        print(f"[BENCH] ライブラリ作成: {counts} ({time.perf_counter() - started:.1f}秒)")
+
+        # アプリは作業ディレクトリ基準で storage/ とデータベースを作るので、一時ディレクトリで読み込む
+        os.chdir(workdir)
+        os.environ['EXTERNAL_STORAGE_PATH'] = library
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        sys.path.insert(0, REPO_DIR)
+        quiet = contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+
+        results = {}
+        with quiet:
+            started = time.perf_counter()
+            import app as appmod
+            results["import_app"] = summarize([time.perf_counter() - started])
+            appmod.create_app()
+
+            results["scan_cold"] = summarize(measure(appmod.scan_external_storage))
+            results["scan_rescan"] = summarize(measure(appmod.scan_external_storage, args.repeat))
+
+            client = appmod.app.test_client()
+            client.post('/login', data={'username': appmod.ADMIN_USERNAME, 'password': appmod.ADMIN_PASSWORD})
+
+            total = client.get('/files?per_page=1').get_json()['pagination']['total_count']
+            last_page = max(1, (total + args.per_page - 1) // args.per_page)
+            for name, page in (('first', 1), ('middle', (last_page + 1) // 2), ('last', last_page)):
+                url = f'/files?page={page}&per_page={args.per_page}'
+                results[f"files_page_{name}"] = summarize(measure(lambda: client.get(url).get_json(), args.repeat))
+
+            ids = []
+            for page in range(1, last_page + 1):
+                ids.extend(f['id'] for f in client.get(f'/files?page={page}&per_page=500').get_json()['files'])
+                if len(ids) >= args.thumbnails * 4:
+                    break
+            sample = random.Random(args.seed).sample(ids, min(args.thumbnails, len(ids)))
+            thumbnail_samples = []
+            for file_id in sample:
+                started = time.perf_counter()
+                response = client.get(f'/thumbnails/{file_id}')
+                response.get_data()
+                response.close()
+                thumbnail_samples.append(time.perf_counter() - started)
+            if thumbnail_samples:
+                results["thumbnail"] = summarize(thumbnail_samples)
+
+            upload_samples = []
+            for i in range(args.uploads):
+                data = generate_library.make_upload_image(i, args.image_size, args.seed)
+                started = time.perf_counter()
+                client.post('/upload', data={'files': [(io.BytesIO(data), f'upload_{i:05d}.jpg')]},
+                            content_type='multipart/form-data')
+                upload_samples.append(time.perf_counter() - started)
+            if upload_samples:
+                results["upload"] = summarize(upload_samples)
+
+            appmod.db_pool.close_all()
+
+        return {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec='seconds'),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "library": counts,
+                "options": {
+                    "seed": args.seed, "image_size": list(args.image_size), "repeat": args.repeat,
+                    "per_page": args.per_page, "thumbnails": args.thumbnails, "uploads": args.uploads
+                }
+            },
+            "results": results
+        }
+    finally:
+        os.chdir(original_cwd)
+        if args.keep:
+            print(f"[BENCH] 作業ディレクトリを残しました: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    generate_library.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5, help='再スキャンと /files の繰り返し回数')
+    parser.add_argument('--per-page', type=int, default=50, help='/files の1ページの件数')
+    parser.add_argument('--thumbnails', type=int, default=200, help='取得するサムネイルの数')
+    parser.add_argument('--uploads', type=int, default=20, help='アップロードするファイルの数')
+    parser.add_argument('--output', help='結果の JSON の保存先（省略時は benchmarks/results/<日時>.json）')
+    parser.add_argument('--keep', action='store_true', help='作業ディレクトリを削除しない')
+    parser.add_argument('--verbose', action='store_true', help='アプリの出力を表示する')
+    args = parser.parse_args()
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BENCH_DIR, 'results', datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for name, summary in report["results"].items():
+        print(f"  {name:<20} n={summary['n']:<5} p50={summary['p50_s'] * 1000:9.2f}ms "
+              f"p95={summary['p95_s'] * 1000:9.2f}ms total={summary['total_s']:.3f}s")
+    print(f"[BENCH] 結果を保存しました: {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""起動から最初のリクエストに応答するまでの時間の計測
+
+python app.py でサーバーを起動し、GET /login が 200 を返すまでの時間を繰り返し計測して、
+目標（--target 秒）と比べる。p50 が目標を超えた場合は終了コード 1 で終わる。
+
+    python benchmarks/startup.py --rows 400000 --target 2.0
+
+--rows を指定すると、その件数のダミー行を入れたデータベースで計測する
+（起動時間がライブラリの件数に比例しないことの確認用）。
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def populate(database_path, rows, batch_size=10000):
+    """ダミー行を入れたデータベースを作成"""
+    sys.path.insert(0, REPO_DIR)
+    import db
+    import migrations
+
+    conn = db.open_connection(database_path)
+    try:
+        migrations.apply_migrations(conn)
+        for start in range(0, rows, batch_size):
+            batch = []
+            for i in range(start, min(rows, start + batch_size)):
+                name = f"IMG_{i:07d}.jpg"
+                batch.append((str(uuid.uuid4()), name, name, f"/library/202401/{name}", '202401',
+                              'image', 'image/jpeg', 1000000, f"{i:064x}", '2024-01-01 00:00:00'))
+            conn.executemany("""
+                INSERT INTO files (id, original_name, filename, file_path, date_folder,
+                    file_type, mime_type, file_size, file_hash, taken_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, batch)
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def measure_once(workdir, port, timeout):
+    env = dict(os.environ, PORT=str(port), HOST='127.0.0.1', LOG_LEVEL='WARNING',
+               EXTERNAL_STORAGE_PATH=os.path.join(workdir, 'storage'))
+    url = f"http://127.0.0.1:{port}/login"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, 'app.py')], cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"サーバーが終了しました（終了コード {process.returncode}）")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError, OSError):
+                time.sleep(0.01)
+        raise RuntimeError(f"{timeout}秒以内に応答しませんでした")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='計測の回数')
+    parser.add_argument('--rows', type=int, default=0, help='データベースに入れるダミー行の数')
+    parser.add_argument('--target', type=float, default=2.0, help='最初のリクエストまでの目標（秒）')
+    parser.add_argument('--timeout', type=float, default=60, help='1回の起動を待つ最大秒数')
+    parser.add_argument('--output', help='結果の JSON の保存先')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='image-syncer-startup-')
+    try:
+        if args.rows:
+            started = time.perf_counter()
+            populate(os.path.join(workdir, 'image_syncer.db'), args.rows)
+            print(f"[BENCH] {args.rows}行のデータベースを作成 ({time.perf_counter() - started:.1f}秒)")
+        # 1回目はマイグレーションの適用を含むので計測から除く
+        measure_once(workdir, free_port(), args.timeout)
+        samples = [measure_once(workdir, free_port(), args.timeout) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    p50 = statistics.median(samples)
+    report = {
+        "rows": args.rows,
+        "runs": args.runs,
+        "target_s": args.target,
+        "p50_s": round(p50, 4),
+        "min_s": round(min(samples), 4),
+        "max_s": round(max(samples), 4),
+        "samples_s": [round(s, 4) for s in samples],
+        "passed": p50 <= args.target
+    }
+    print(f"[BENCH] 最初のリクエストまで p50={p50:.3f}秒 min={min(samples):.3f}秒 max={max(samples):.3f}秒 "
+          f"（目標 {args.target}秒: {'OK' if report['passed'] else '超過'}）")
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
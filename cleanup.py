@@ -0,0 +1,258 @@
+"""データベースとファイルシステムの整合性チェック
+
+1. データベースの行をチャンク単位で読み、ファイルとサムネイルの存在確認を並列に行う。
+   元ファイルがない行はチャンクごとにまとめて削除し、サムネイルがない行はサムネイル列をクリアする。
+2. ストレージ（すべてのルート）とサムネイルディレクトリの一覧と、データベースのパス一覧をそれぞれソートして
+   マージ結合し、どの行からも参照されていない孤立ファイルを検出する（指定時のみ削除）。
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import thumbnails
+
+# 結果に含めるIDやパスの最大件数（件数と合計サイズは全件分を集計する）
+MAX_REPORTED_ORPHANS = 1000
+
+# 更新から間もないファイルは孤立扱いしない（アップロード中でまだDBに登録されていない場合があるため）。
+# 移動（rename）では mtime が変わらないので、サムネイルの移行で移したばかりのファイルも ctime で除く
+ORPHAN_MIN_AGE = 600
+
+
+def normalize_path(path):
+    """比較用にパスを正規化（ディスクアクセスはしない）"""
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _iter_db_chunks(conn, chunk_size):
+    """id順のキーセットページングで (id, file_path, thumbnail_path) をチャンク単位に返す"""
+    last_id = ''
+    cursor = conn.cursor()
+    while True:
+        cursor.execute("""
+            SELECT id, file_path, thumbnail_path FROM files
+            WHERE id > ? ORDER BY id LIMIT ?
+        """, (last_id, chunk_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _check_row(row):
+    """(id, 元ファイルがあるか, サムネイルの状態) を返す（サムネイル未設定なら None）"""
+    file_id, file_path, thumbnail_path = row
+    file_exists = os.path.exists(file_path)
+    # サムネイルの配置の移行中は新しいパスにある場合もある（パックのエントリは圧縮時に整理する）
+    if not file_exists or not thumbnail_path or thumbnails.is_packed(thumbnail_path):
+        thumbnail_exists = None
+    else:
+        thumbnail_exists = thumbnails.locate(file_id, thumbnail_path) is not None
+    return file_id, file_exists, thumbnail_exists
+
+
+def remove_missing_entries(job, conn, executor, chunk_size, on_removed):
+    """存在しないファイルを参照している行を削除し、消えたサムネイルの参照をクリア"""
+    total = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    checked = 0
+    removed_ids = []
+    cleared_thumbnails = 0
+    job.update(phase='missing', checked=0, total=total)
+
+    for rows in _iter_db_chunks(conn, chunk_size):
+        missing, missing_thumbnails = [], []
+        for file_id, file_exists, thumbnail_exists in executor.map(_check_row, rows):
+            if not file_exists:
+                missing.append(file_id)
+            elif thumbnail_exists is False:
+                missing_thumbnails.append(file_id)
+
+        if missing or missing_thumbnails:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM files WHERE id = ?", [(i,) for i in missing])
+            cursor.executemany("""
+                UPDATE files SET thumbnail_path = NULL, thumbnail_hash = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, [(i,) for i in missing_thumbnails])
+            conn.commit()
+            on_removed(missing + missing_thumbnails)
+            for file_id in missing:
+                print(f"[CLEANUP] Removing missing file from DB: {file_id}")
+            removed_ids.extend(missing)
+            cleared_thumbnails += len(missing_thumbnails)
+
+        checked += len(rows)
+        job.update(checked=checked, removed=len(removed_ids), cleared_thumbnails=cleared_thumbnails)
+
+    return removed_ids, cleared_thumbnails
+
+
+def _walk_files(root, include):
+    """root 以下のファイルを os.scandir で列挙（include(dir_entry) が真のものだけ）"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and include(entry):
+                        yield entry
+        except OSError as e:
+            print(f"[CLEANUP] ディレクトリを読めません: {directory}, {e}")
+
+
+def merge_join_orphans(disk_entries, db_paths):
+    """ソート済みの (正規化パス, 元パス, サイズ) とソート済みのDBパスから、DBにないものを返す"""
+    orphans = []
+    i = j = 0
+    while i < len(disk_entries):
+        key = disk_entries[i][0]
+        while j < len(db_paths) and db_paths[j] < key:
+            j += 1
+        if j >= len(db_paths) or db_paths[j] != key:
+            orphans.append(disk_entries[i])
+        i += 1
+    return orphans
+
+
+def _db_paths(conn, column):
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {column} FROM files WHERE {column} IS NOT NULL")
+    paths = []
+    while True:
+        rows = cursor.fetchmany(5000)
+        if not rows:
+            break
+        paths.extend(normalize_path(row[0]) for row in rows)
+    paths.sort()
+    return paths
+
+
+def _listing(roots, include):
+    """(正規化パス, 元パス, サイズ) のソート済みリスト（更新から間もないファイルは除く）"""
+    cutoff = time.time() - ORPHAN_MIN_AGE
+    entries = []
+    for root in roots:
+        for entry in _walk_files(root, include):
+            stat = entry.stat(follow_symlinks=False)
+            if max(stat.st_mtime, stat.st_ctime) > cutoff:
+                continue
+            entries.append((normalize_path(entry.path), entry.path, stat.st_size))
+    entries.sort()
+    return entries
+
+
+def date_folders(storage_dir):
+    """スキャン対象と同じ日付フォルダ（先頭6文字が数字）の一覧"""
+    folders = []
+    try:
+        with os.scandir(storage_dir) as it:
+            for entry in it:
+                name = entry.name
+                if entry.is_dir() and name != 'thumbnails' and len(name) >= 6 and name[:6].isdigit():
+                    folders.append(entry.path)
+    except OSError as e:
+        print(f"[CLEANUP] ストレージを読めません: {storage_dir}, {e}")
+    return folders
+
+
+def _report(orphans, deleted):
+    return {
+        "count": len(orphans),
+        "bytes": sum(size for _, _, size in orphans),
+        "deleted": deleted,
+        "paths": [path for _, path, _ in orphans[:MAX_REPORTED_ORPHANS]]
+    }
+
+
+def _delete_orphans(executor, orphans):
+    def unlink(path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError as e:
+            print(f"[CLEANUP] 孤立ファイルの削除に失敗: {path}, {e}")
+            return False
+    return sum(executor.map(unlink, [path for _, path, _ in orphans]))
+
+
+def find_orphans(job, conn, executor, storage_dirs, thumbnails_dir, media_extensions,
+                 delete_orphan_files=False, delete_orphan_thumbnails=False, thumbnails_busy=None):
+    """どの行からも参照されていない元ファイルとサムネイルを検出（指定時は削除）
+
+    thumbnails_busy() が真の間（サムネイルの移行中）は、移動とデータベースの更新の間の
+    ファイルを孤立扱いしないよう、サムネイルの検出を省く。
+    """
+    thumbnails_root = normalize_path(thumbnails_dir)
+
+    def is_media(entry):
+        name = entry.name
+        if name.startswith('temp_') or name.endswith('.converting.mp4'):
+            return False
+        if os.path.splitext(name)[1].lower() not in media_extensions:
+            return False
+        # サムネイルディレクトリがストレージ内にある場合は除外
+        return not normalize_path(entry.path).startswith(thumbnails_root + os.sep)
+
+    # 日付フォルダ以外はスキャン対象外なので、孤立ファイルの判定にも含めない
+    # （DBのパスはディスクの一覧を取った後に読み、その間に登録されたファイルを孤立扱いしない）
+    job.update(phase='orphan_files')
+    disk_files = _listing(
+        [folder for storage_dir in storage_dirs for folder in date_folders(storage_dir)], is_media
+    )
+    orphan_files = merge_join_orphans(disk_files, _db_paths(conn, 'file_path'))
+
+    deleted_files = _delete_orphans(executor, orphan_files) if delete_orphan_files else 0
+    result = {"files": _report(orphan_files, deleted_files)}
+
+    if thumbnails_busy and thumbnails_busy():
+        print("[CLEANUP] サムネイルの移行中のため孤立サムネイルの検出を省略")
+        result["thumbnails"] = dict(_report([], 0), skipped="thumbnail_migration")
+        return result
+
+    job.update(phase='orphan_thumbnails')
+    # パックファイルはデータベースのパスと対応しないので除く
+    packs_root = normalize_path(os.path.join(thumbnails_dir, thumbnails.PACKS_DIRNAME))
+    disk_thumbnails = _listing(
+        [thumbnails_dir], lambda entry: not normalize_path(entry.path).startswith(packs_root + os.sep)
+    )
+    orphan_thumbnails = merge_join_orphans(disk_thumbnails, _db_paths(conn, 'thumbnail_path'))
+    # 一覧を取っている間に移行が始まった場合も削除しない
+    if delete_orphan_thumbnails and not (thumbnails_busy and thumbnails_busy()):
+        deleted_thumbnails = _delete_orphans(executor, orphan_thumbnails)
+    else:
+        deleted_thumbnails = 0
+
+    result["thumbnails"] = _report(orphan_thumbnails, deleted_thumbnails)
+    return result
+
+
+def run_cleanup(job, pool, storage_dirs, thumbnails_dir, media_extensions, on_removed,
+                delete_orphan_files=False, delete_orphan_thumbnails=False,
+                chunk_size=1000, workers=8, thumbnails_busy=None):
+    """クリーンアップジョブ本体（JobManager から呼ばれる）"""
+    with pool.connection() as conn, ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='cleanup-stat'
+    ) as executor:
+        removed_ids, cleared_thumbnails = remove_missing_entries(
+            job, conn, executor, chunk_size, on_removed
+        )
+        orphans = find_orphans(
+            job, conn, executor, storage_dirs, thumbnails_dir, media_extensions,
+            delete_orphan_files, delete_orphan_thumbnails, thumbnails_busy
+        )
+
+    job.update(phase='done')
+    print(f"[CLEANUP] 完了: {len(removed_ids)}件削除, サムネイル参照{cleared_thumbnails}件クリア, "
+          f"孤立ファイル{orphans['files']['count']}件, 孤立サムネイル{orphans['thumbnails']['count']}件")
+    return {
+        "message": f"クリーンアップ完了: {len(removed_ids)}個の不整合エントリを削除",
+        "cleaned_count": len(removed_ids),
+        "cleaned_files": removed_ids[:MAX_REPORTED_ORPHANS],
+        "cleared_thumbnails": cleared_thumbnails,
+        "orphans": orphans
+    }
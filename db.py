@@ -0,0 +1,203 @@
+"""SQLite接続レイヤー
+
+スレッドごとに接続を再利用し、WAL・mmap・ページキャッシュなどの
+チューニング済みPRAGMAを接続作成時に一度だけ適用する。
+"""
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+import profiling
+
+DATABASE_PATH = "image_syncer.db"
+
+# 接続ごとのプリペアドステートメントキャッシュ数（sqlite3はSQL文字列をキーにキャッシュする）
+STATEMENT_CACHE_SIZE = 256
+
+# 接続作成時に適用するPRAGMA
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",          # 読み込みが書き込みトランザクションでブロックされない
+    "PRAGMA synchronous=NORMAL",        # WALでは NORMAL で十分安全
+    "PRAGMA mmap_size=268435456",       # 256MB をメモリマップで読む
+    "PRAGMA cache_size=-65536",         # ページキャッシュ 64MB（負の値はKiB指定）
+    "PRAGMA temp_store=MEMORY",
+)
+
+# ロック待ちのタイムアウト（秒）
+BUSY_TIMEOUT = 30.0
+
+# ホットパスのクエリ（同一文字列を使い回すことでプリペアドステートメントが再利用される）
+SQL_FILE_META_BY_ID = """
+    SELECT file_path, original_name, mime_type, thumbnail_path, file_type,
+           file_hash, thumbnail_hash, derivative
+    FROM files WHERE id = ?
+"""
+SQL_DELETE_TARGET_BY_ID = "SELECT file_path, thumbnail_path FROM files WHERE id = ?"
+SQL_COUNT_FILES = "SELECT COUNT(*) FROM files"
+SQL_COUNT_FILES_BY_TYPE = "SELECT COUNT(*) FROM files WHERE file_type = ?"
+# 一覧の1行分の列（先頭は id）
+LIST_FILE_COLUMNS = (
+    "id, original_name, filename, file_type, file_size, created_at, taken_date, "
+    "mime_type, file_hash, thumbnail_hash"
+)
+SQL_LIST_FILES = f"""
+    SELECT {LIST_FILE_COLUMNS}
+    FROM files
+    ORDER BY taken_date DESC, created_at DESC, id
+    LIMIT ? OFFSET ?
+"""
+SQL_LIST_FILES_BY_TYPE = f"""
+    SELECT {LIST_FILE_COLUMNS}
+    FROM files WHERE file_type = ?
+    ORDER BY taken_date DESC, created_at DESC, id
+    LIMIT ? OFFSET ?
+"""
+# 撮影月（YYYY-MM）ごとの件数、撮影日時のないものは最後
+SQL_TIMELINE = """
+    SELECT substr(taken_date, 1, 7) AS month, COUNT(*) FROM files {where}
+    GROUP BY month ORDER BY month IS NULL, month DESC
+"""
+SQL_FIND_BY_HASH = "SELECT id, original_name FROM files WHERE file_hash = ?"
+SQL_FIND_BY_HASH_OR_PATH = "SELECT id FROM files WHERE file_hash = ? OR file_path = ?"
+SQL_COUNT_PHASHES = "SELECT COUNT(*) FROM files WHERE phash IS NOT NULL"
+
+
+# メトリクスのラベルにするSQL文の種類の上限（超えた分は 'other' にまとめる）
+MAX_STATEMENT_LABELS = 200
+_statement_labels = {}
+
+
+def statement_label(sql):
+    """SQL文をメトリクスのラベルに正規化（空白を詰め、IN (?,?,...) の個数の違いをまとめる）"""
+    label = _statement_labels.get(sql)
+    if label is None:
+        label = re.sub(r'\s+', ' ', sql).strip()
+        label = re.sub(r'\(\s*\?(\s*,\s*\?)*\s*\)', '(?)', label)[:120]
+        if len(_statement_labels) < MAX_STATEMENT_LABELS:
+            _statement_labels[sql] = label
+        else:
+            label = 'other'
+    return label
+
+
+def _record_query(sql, started):
+    duration = time.perf_counter() - started
+    label = statement_label(sql)
+    metrics.DB_QUERY_DURATION.observe(duration, statement=label)
+    profiling.record(label, 'sql', started, duration)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """execute / executemany の時間をSQL文ごとに記録するカーソル"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(sql, started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """cursor() と conn.execute() が TimedCursor を使う接続"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # sqlite3 の Connection.execute は cursor() を経由せずに実行するので上書きする
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def open_connection(database_path):
+    """チューニング済みの新しい接続を作成"""
+    conn = sqlite3.connect(
+        database_path,
+        timeout=BUSY_TIMEOUT,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,  # プールに返却して別スレッドで再利用するため
+        factory=TimedConnection,
+    )
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """スレッドごとに接続を割り当てて再利用する接続プール
+
+    スレッドは最初の acquire() で接続を受け取り、release() するまで同じ接続を使い続ける。
+    返却された接続はアイドルキューに入り、次のスレッドで再利用される。
+    """
+
+    def __init__(self, database_path, max_idle=16):
+        self.database_path = database_path
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def acquire(self):
+        """現在のスレッドに割り当てられた接続を返す（なければ割り当てる）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = open_connection(self.database_path)
+
+        self._local.conn = conn
+        return conn
+
+    def release(self):
+        """現在のスレッドの接続をプールに返却"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+
+        # 未確定のトランザクションは持ち越さない
+        if conn.in_transaction:
+            conn.rollback()
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """バックグラウンド処理用: 接続を取得し、終了時にプールへ返却
+
+        既に接続を持っているスレッド（リクエスト処理中など）では、その接続をそのまま使い返却しない。
+        """
+        owned = getattr(self._local, 'conn', None) is None
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            if owned:
+                self.release()
+
+    def close_all(self):
+        """アイドル接続をすべて閉じる"""
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
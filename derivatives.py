@@ -0,0 +1,106 @@
+"""HEIC の表示用派生画像（JPEG / WebP）のキャッシュ
+
+HEIC_MODE=lazy のとき、HEIC は変換せずにそのまま元ファイルとして保存し、
+ブラウザに表示するときに初めて JPEG か WebP の派生画像を作ってキャッシュする。
+取り込み時のデコードと再エンコードがなくなるので、大量の HEIC の取り込みは
+ディスクI/Oだけで律速される。
+
+派生画像は元ファイルのハッシュごとに1つで、キャッシュの合計が
+DERIVATIVE_CACHE_BUDGET を超えたら最後に使われてから最も時間が経ったものから削除する。
+"""
+import os
+import threading
+
+import imaging
+import metrics
+from disk_cache import DiskCache
+
+# convert: 取り込み時に JPEG に変換して HEIC を削除（従来の動作） / lazy: HEIC のまま保存
+HEIC_MODE = os.environ.get('HEIC_MODE', 'convert')
+# lazy モードで作る派生画像の形式（jpeg / webp）
+DERIVATIVE_FORMAT = os.environ.get('DERIVATIVE_FORMAT', 'jpeg')
+DERIVATIVES_DIR = os.environ.get('DERIVATIVES_DIR', 'storage/derivatives')
+DERIVATIVE_CACHE_BUDGET = int(os.environ.get('DERIVATIVE_CACHE_BUDGET', str(5 * 1024 ** 3)))
+
+# 形式 → (拡張子, MIMEタイプ, PILの形式名, 保存オプション)
+# optimize=True はエンコードが遅くなる割にサイズがほとんど変わらないので使わない
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', 'JPEG', {'quality': 85}),
+    'webp': ('.webp', 'image/webp', 'WEBP', {'quality': 80, 'method': 4}),
+}
+
+# ブラウザで表示できないため派生画像が必要な元ファイルの形式
+LAZY_SOURCE_FORMATS = {'heic', 'heif'}
+
+
+def source_format_for(name):
+    """ファイル名から元ファイルの形式（'jpeg', 'heic' など）"""
+    ext = os.path.splitext(str(name))[1].lower().lstrip('.')
+    return 'jpeg' if ext == 'jpg' else ext or None
+
+
+def derivative_for(source_format):
+    """取り込み時に記録する派生画像の形式（不要なら None）"""
+    if HEIC_MODE == 'lazy' and source_format in LAZY_SOURCE_FORMATS:
+        return DERIVATIVE_FORMAT if DERIVATIVE_FORMAT in FORMATS else 'jpeg'
+    return None
+
+
+def keeps_heic():
+    """HEIC を変換せずに保存するモードか"""
+    return HEIC_MODE == 'lazy'
+
+
+class DerivativeCache(DiskCache):
+    """派生画像のディスクキャッシュ"""
+
+    log_tag = 'DERIVATIVE'
+
+    def __init__(self, cache_dir=DERIVATIVES_DIR, budget=DERIVATIVE_CACHE_BUDGET):
+        super().__init__(cache_dir, budget)
+        self._key_locks = {}
+
+    def path_for(self, file_hash, fmt):
+        return os.path.join(self.cache_dir, file_hash[:2], f"{file_hash[:32]}{FORMATS[fmt][0]}")
+
+    def cached(self, file_hash, fmt):
+        """作成済みの派生画像のパス（なければ None、元ファイルには触れない）"""
+        path = self.path_for(file_hash, fmt)
+        return path if self._touch(path) else None
+
+    @staticmethod
+    def mimetype(fmt):
+        return FORMATS[fmt][1]
+
+    def get(self, source_path, file_hash, fmt, on_decoded=None):
+        """派生画像のパスを返す（なければ作る）。on_decoded(img) はデコードした画像で呼ばれる"""
+        path = self.path_for(file_hash, fmt)
+        if self._touch(path):
+            return path
+
+        # 同じ画像への同時リクエストで二重に変換しない
+        with self._lock:
+            key_lock = self._key_locks.setdefault(path, threading.Lock())
+        with key_lock:
+            if not self._touch(path):
+                size = self._render(source_path, path, fmt, on_decoded)
+                self._added(size)
+        with self._lock:
+            self._key_locks.pop(path, None)
+        return path
+
+    @metrics.timed('derivative')
+    def _render(self, source_path, path, fmt, on_decoded):
+        _, _, pil_format, options = FORMATS[fmt]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with imaging.pil().open(source_path) as img:
+            img.load()
+            if on_decoded:
+                on_decoded(img)
+            if pil_format == 'JPEG' and img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(temp_path, pil_format, **options)
+        # 他のプロセスが同時に作っていても、置き換えは不可分なので読み手は壊れたファイルを見ない
+        os.replace(temp_path, path)
+        return os.path.getsize(path)
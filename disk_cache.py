@@ -0,0 +1,81 @@
+"""上限サイズつきのディスクキャッシュ
+
+派生画像や高速ディスクへ昇格した元ファイルなど、ディレクトリに置いたファイルの合計が
+上限（budget）を超えたら、最後に使われてから最も時間が経ったものから削除する。
+使われた時刻はファイルの更新時刻で表す（プロセスをまたいで共有でき、再起動後も残る）。
+"""
+import os
+import threading
+
+
+class DiskCache:
+    """更新時刻を最終使用時刻とする LRU のディスクキャッシュ"""
+
+    # 追い出し時のログのタグ
+    log_tag = 'CACHE'
+
+    def __init__(self, cache_dir, budget):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._total = None  # キャッシュの合計サイズ（初回の追加時に数える）
+
+    def _touch(self, path):
+        """存在すれば更新時刻を今にして True（追い出し順に使う）"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _added(self, size):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, _, size in self._scan())
+            else:
+                self._total += size
+            over = self._total > self.budget
+        if over:
+            self.enforce_budget()
+
+    def enforce_budget(self):
+        """合計が上限の9割以下になるまで、使われていない順に削除"""
+        entries = self._scan()
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        target = self.budget * 0.9
+        removed = 0
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        with self._lock:
+            self._total = total
+        if removed:
+            print(f"[{self.log_tag}] キャッシュから{removed}件削除")
+
+    def total_size(self):
+        """キャッシュの合計サイズ（まだ数えていなければ数える）"""
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, _, size in self._scan())
+            return self._total
@@ -0,0 +1,220 @@
+"""file_hash が同じ（内容が完全に同じ）ファイルの検出と整理
+
+強制再スキャンや手作業のコピーで同じ内容の行が複数できた場合に、
+idx_file_hash を使った GROUP BY で重複しているハッシュだけを取り出し、
+グループ単位で順に返す（テーブル全体をメモリに載せない）。
+"""
+import os
+
+import db
+import logs
+import thumbnails
+
+log = logs.get_logger('dedupe')
+
+# 重複グループの行（file_hash, created_at, id 順に並ぶのでグループごとに連続する）
+DUPLICATE_COLUMNS = (
+    "id, file_hash, original_name, file_path, thumbnail_path, file_size, "
+    "created_at, taken_date, file_type, thumbnail_hash"
+)
+SQL_DUPLICATE_ROWS = f"""
+    SELECT {DUPLICATE_COLUMNS} FROM files
+    WHERE file_hash IN (
+        SELECT file_hash FROM files WHERE file_hash IS NOT NULL
+        GROUP BY file_hash HAVING COUNT(*) > 1
+    )
+    ORDER BY file_hash, created_at, id
+"""
+
+KEEP_POLICIES = ('oldest', 'newest')
+
+# 結果に含めるグループの最大数（件数と解放量は全件分を集計する）
+MAX_REPORTED_GROUPS = 1000
+
+
+class DuplicateRow:
+    __slots__ = tuple(column.strip() for column in DUPLICATE_COLUMNS.split(','))
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+
+def _normalize(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class DuplicateGroup:
+    """同じ file_hash を持つ行のグループ（rows は作成日時の古い順）"""
+
+    def __init__(self, file_hash, rows):
+        self.file_hash = file_hash
+        self.rows = rows
+
+    @property
+    def file_size(self):
+        return self.rows[0].file_size
+
+    def distinct_path_count(self):
+        """実体のファイル数（強制再スキャンでは同じパスを指す行ができる）"""
+        return len({_normalize(row.file_path) for row in self.rows})
+
+    @property
+    def reclaimable_bytes(self):
+        """1つを残して削除した場合に空くディスク容量（同じパスを指す行は数えない）"""
+        return (self.distinct_path_count() - 1) * (self.file_size or 0)
+
+    def keeper(self, keep='oldest', exists=os.path.exists):
+        """残す行（ファイルが存在する行のうち最も古い・新しいもの、どれも存在しなければ None）
+
+        手作業の移動や強制再スキャンで残った古い行はファイルを指していないので、
+        それを残して他の行のファイルを消すと唯一の実体がなくなる。
+        """
+        candidates = [row for row in self.rows if row.file_path and exists(row.file_path)]
+        if not candidates:
+            return None
+        return candidates[0] if keep == 'oldest' else candidates[-1]
+
+    def removals(self, keep='oldest', exists=os.path.exists):
+        """(残す行, [(削除する行, ファイルも消すか), ...])
+
+        どの行のファイルも存在しない場合は (None, []) を返す（グループには手を付けない）。
+        同じパスを複数の行が指している場合、ファイルを消すのは残す行と異なるパスの最初の1行だけ。
+        """
+        kept = self.keeper(keep, exists)
+        if kept is None:
+            return None, []
+        seen = {_normalize(kept.file_path)}
+        removals = []
+        for row in self.rows:
+            if row is kept:
+                continue
+            path = _normalize(row.file_path)
+            removals.append((row, path not in seen and exists(row.file_path)))
+            seen.add(path)
+        return kept, removals
+
+
+def _group_rows(cursor, fetch_size=1000):
+    """ハッシュ順に並んだ行を DuplicateGroup にまとめて返す"""
+    current_hash = None
+    rows = []
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if not batch:
+            break
+        for raw in batch:
+            row = DuplicateRow(raw)
+            if row.file_hash != current_hash:
+                if len(rows) > 1:
+                    yield DuplicateGroup(current_hash, rows)
+                current_hash, rows = row.file_hash, []
+            rows.append(row)
+    if len(rows) > 1:
+        yield DuplicateGroup(current_hash, rows)
+
+
+def iter_duplicate_groups(conn, hashes=None, chunk_size=500):
+    """重複グループを順に返す（hashes を指定した場合はそのハッシュだけ）"""
+    if hashes is None:
+        yield from _group_rows(conn.execute(SQL_DUPLICATE_ROWS))
+        return
+    for i in range(0, len(hashes), chunk_size):
+        chunk = hashes[i:i + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        cursor = conn.execute(f"""
+            SELECT {DUPLICATE_COLUMNS} FROM files
+            WHERE file_hash IN ({placeholders})
+            ORDER BY file_hash, created_at, id
+        """, chunk)
+        yield from _group_rows(cursor)
+
+
+def reclaim(job, pool, keep='oldest', hashes=None, dry_run=False,
+            on_removed=None, unlink=None, batch_size=500):
+    """各グループで1件だけ残して残りの行とファイルを削除する（ジョブとして実行）
+
+    削除した行と同じパスを他の行がまだ参照している場合、そのファイルは消さない。
+    残す行はファイルが存在する行から選び、どの行のファイルも存在しないグループは飛ばす。
+    行の削除は batch_size 件ごとにまとめてコミットし、その直前に残す行のファイルがまだあるかを
+    確かめ直す（なくなっていたグループは削除しない）。
+    """
+    groups = removed = reclaimed = skipped = 0
+    pending = []   # (残す行, 削除する行, ファイルも消すか)
+    results = []
+    reported = {}  # 残す行の ID → results のグループ
+
+    def flush(conn):
+        nonlocal removed, reclaimed, skipped
+        lost = {kept.id for kept, _, _ in pending if not os.path.exists(kept.file_path)}
+        for kept_id in lost:
+            skipped += 1
+            log.warning("keeper file missing, group skipped", extra={"file_id": kept_id})
+            if kept_id in reported:
+                reported[kept_id].update(kept=None, deleted=[], skipped="keeper_missing")
+        pending[:] = [(kept, row, delete_file) for kept, row, delete_file in pending if kept.id not in lost]
+        if not pending:
+            return
+        ids = [row.id for _, row, _ in pending]
+        if not dry_run:
+            conn.executemany("DELETE FROM files WHERE id = ?", [(i,) for i in ids])
+            conn.commit()
+            if on_removed:
+                on_removed(ids)
+        for _, row, delete_file in pending:
+            if delete_file and not dry_run:
+                # 別のハッシュの行（更新前の古い行など）が同じパスを指している場合は残す
+                delete_file = conn.execute(
+                    "SELECT 1 FROM files WHERE file_path = ? LIMIT 1", (row.file_path,)
+                ).fetchone() is None
+                if delete_file:
+                    unlink(row.file_path)
+            if delete_file:
+                reclaimed += row.file_size or 0
+            if row.thumbnail_path and not dry_run:
+                # 分割した配置・移行前のパス・パックのどれに保存されていても消す
+                thumbnails.remove(row.id, row.thumbnail_path)
+        removed += len(ids)
+        pending.clear()
+        job.update(groups=groups, removed=removed, reclaimed_bytes=reclaimed, skipped_groups=skipped)
+
+    # 読み込み中のカーソルと削除を同じ接続で混ぜないよう、読み込み用に別の接続を使う
+    reader = db.open_connection(pool.database_path)
+    try:
+        with pool.connection() as conn:
+            for group in iter_duplicate_groups(reader, hashes):
+                kept, removals = group.removals(keep)
+                groups += 1
+                if kept is None:
+                    skipped += 1
+                    if len(results) < MAX_REPORTED_GROUPS:
+                        results.append({"file_hash": group.file_hash, "kept": None, "deleted": [],
+                                        "skipped": "missing_files"})
+                    continue
+                pending.extend((kept, row, delete_file) for row, delete_file in removals)
+                if len(results) < MAX_REPORTED_GROUPS:
+                    results.append({
+                        "file_hash": group.file_hash,
+                        "kept": kept.id,
+                        "deleted": [row.id for row, _ in removals]
+                    })
+                    reported[kept.id] = results[-1]
+                if len(pending) >= batch_size:
+                    flush(conn)
+            flush(conn)
+    finally:
+        reader.close()
+
+    log.info("dedupe finished", extra={
+        "dry_run": dry_run, "groups": groups, "removed": removed,
+        "reclaimed_bytes": reclaimed, "skipped_groups": skipped
+    })
+    return {
+        "dry_run": dry_run,
+        "keep": keep,
+        "groups": groups,
+        "removed": removed,
+        "reclaimed_bytes": reclaimed,
+        "skipped_groups": skipped,
+        "results": results
+    }
@@ -0,0 +1,163 @@
+"""メディアファイルの送信
+
+SENDFILE_MODE を設定すると、認証とDB検索が終わった時点でファイル本体の送信を
+リバースプロキシ（nginx の X-Accel-Redirect / Apache・lighttpd の X-Sendfile）に任せる。
+Pythonワーカーはヘッダーだけ返してすぐに解放される。
+
+プロキシを使わない場合、単一レンジのRangeリクエストは wsgi.file_wrapper で返し、
+gunicorn などのWSGIサーバーが os.sendfile でゼロコピー送信できるようにする。
+"""
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+from flask import Response, request, send_file
+
+# file_wrapper を使わない場合の読み込み単位
+RANGE_CHUNK_SIZE = 256 * 1024
+
+# '' (Flaskで送信) / 'x-accel' (nginx) / 'x-sendfile' (Apache, lighttpd)
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '').strip().lower()
+
+
+def parse_accel_mappings(value):
+    """'ディレクトリ=内部ロケーション,...' 形式の設定を (絶対パス, ロケーション) のリストに変換
+
+    長いディレクトリから順に並べ、入れ子になったディレクトリは内側のマッピングを優先する。
+    """
+    mappings = []
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        directory, location = item.split('=', 1)
+        directory, location = directory.strip(), location.strip()
+        if not directory or not location:
+            continue
+        root = os.path.realpath(directory)
+        mappings.append((root, location.rstrip('/') + '/'))
+    mappings.sort(key=lambda m: len(m[0]), reverse=True)
+    return mappings
+
+
+# 例: X_ACCEL_MAPPINGS=/media/usb-hdd/photos=/_protected/media,storage/thumbnails=/_protected/thumbnails
+X_ACCEL_MAPPINGS = parse_accel_mappings(os.environ.get('X_ACCEL_MAPPINGS', ''))
+
+
+def accel_location(file_path, mappings=None):
+    """ファイルパスに対応する nginx 内部ロケーションのURIを返す（対象外なら None）"""
+    real_path = os.path.realpath(file_path)
+    for root, location in (X_ACCEL_MAPPINGS if mappings is None else mappings):
+        if real_path == root or not real_path.startswith(root + os.sep):
+            continue
+        relative = os.path.relpath(real_path, root).replace(os.sep, '/')
+        return location + quote(relative)
+    return None
+
+
+def send_media(file_path, mimetype=None, download_name=None):
+    """設定されたモードでメディアファイルのレスポンスを作成
+
+    Cache-Control などのキャッシュヘッダーは呼び出し側で設定する（nginx はそのまま転送する）。
+    """
+    if SENDFILE_MODE == 'x-accel':
+        location = accel_location(file_path)
+        if location:
+            response = Response(status=200, mimetype=mimetype or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = location
+            if download_name:
+                response.headers['Content-Disposition'] = (
+                    f"inline; filename*=UTF-8''{quote(download_name)}"
+                )
+            return response
+
+    if SENDFILE_MODE == 'x-sendfile':
+        response = Response(status=200, mimetype=mimetype or 'application/octet-stream')
+        response.headers['X-Sendfile'] = str(Path(file_path).resolve())
+        if download_name:
+            response.headers['Content-Disposition'] = (
+                f"inline; filename*=UTF-8''{quote(download_name)}"
+            )
+        return response
+
+    if request.range is not None and 'If-Range' not in request.headers:
+        response = send_range(file_path, mimetype, download_name)
+        if response is not None:
+            return response
+
+    # 全体の送信は send_file が wsgi.file_wrapper を使うのでそのままゼロコピーになる
+    return send_file(
+        file_path,
+        as_attachment=False,
+        download_name=download_name,
+        mimetype=mimetype,
+        conditional=True  # ETagとLast-Modifiedを有効化
+    )
+
+
+def _iter_range(f, length):
+    """file_wrapper がないサーバー向け: 指定バイト数だけ読み出す"""
+    try:
+        while length > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def send_range(file_path, mimetype=None, download_name=None):
+    """単一レンジのRangeリクエストに206で応答
+
+    ファイルを開始位置までシークして wsgi.file_wrapper に渡し、Content-Length でレンジ長を示す。
+    gunicorn はこの組み合わせを os.sendfile(offset, count) でそのまま送信する。
+    複数レンジや範囲外の指定など、ここで扱わないものは None を返して send_file に任せる。
+    """
+    if len(request.range.ranges) != 1:
+        return None
+
+    stat = os.stat(file_path)
+    byte_range = request.range.range_for_length(stat.st_size)
+    if byte_range is None:
+        return None
+    start, stop = byte_range
+    length = stop - start
+
+    f = open(file_path, 'rb')
+    f.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        body = file_wrapper(f, RANGE_CHUNK_SIZE)
+    else:
+        body = _iter_range(f, length)
+
+    response = Response(
+        body, status=206,
+        mimetype=mimetype or 'application/octet-stream',
+        direct_passthrough=True
+    )
+    response.content_length = length
+    response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{stat.st_size}"
+    response.last_modified = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+    response.set_etag(f"{stat.st_mtime}-{stat.st_size}")
+    if download_name:
+        response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(download_name)}"
+    return response
+
+
+def send_buffer(data, mimetype=None, etag=None):
+    """メモリ上の内容（パックファイルから読んだサムネイルなど）のレスポンスを作成
+
+    内容は1つのチャンクとして WSGI サーバーに渡す（WSGI の本体は bytes でなければならないので、
+    memoryview などは bytes にしてから渡す）。
+    etag を指定すると If-None-Match が一致するリクエストに 304 で応答する。
+    """
+    data = bytes(data)
+    response = Response([data], mimetype=mimetype or 'application/octet-stream', direct_passthrough=True)
+    response.content_length = len(data)
+    if etag:
+        response.set_etag(etag)
+        response.make_conditional(request)
+    return response
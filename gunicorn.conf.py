@@ -0,0 +1,74 @@
+"""gunicorn 設定
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+各値は環境変数で上書きできる。動画のストリーミングは1接続が長時間続くため、
+ワーカープロセスごとに複数スレッドを持つ gthread ワーカーを使う。
+"""
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+# on_starting でマスタープロセスが読み込むモジュール（db・metrics など）は環境変数を読み込み時に参照し、
+# ワーカーはフォーク時にそれを引き継ぐので、.env はここで反映しておく
+load_dotenv()
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# ワーカープロセス数とプロセスあたりのスレッド数
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2, 8)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+# 一定数のリクエストを処理したワーカーを再起動（メモリ肥大化対策、ジッターで同時再起動を避ける）
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '200'))
+
+# アップロードやスキャンは時間がかかるため長めに設定
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '300'))
+# SIGTERM 受信後、処理中のリクエスト（動画配信など）の完了を待つ時間
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+# wsgi.file_wrapper のレスポンスを os.sendfile でゼロコピー送信
+sendfile = True
+
+# ワーカーごとにSQLite接続やスレッドを持つため、アプリはフォーク後に読み込む
+preload_app = False
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def on_starting(server):
+    """ワーカーを起動する前にスキーママイグレーションを適用し、メトリクスのディレクトリを空にする
+
+    インデックスの作成中は書き込みロックを持つため、配信を始める前にマスタープロセスで1回だけ行う
+    （ワーカーの起動中に行うと、時間がかかった場合に timeout で強制終了される）。
+    """
+    import db
+    import metrics
+    import migrations
+    migrations.migrate(db.DATABASE_PATH)
+    # 前回の起動のワーカーごとのメトリクスを捨てる（カウンターは0から数え直す）
+    metrics.REGISTRY.reset()
+
+
+def worker_exit(server, worker):
+    """ワーカー終了時にプール内のSQLite接続を閉じ、キューに残ったログとメトリクスを書き出す"""
+    try:
+        from app import db_pool
+        db_pool.close_all()
+    except Exception:
+        pass
+    try:
+        import logs
+        logs.shutdown()
+    except Exception:
+        pass
+    try:
+        import metrics
+        metrics.REGISTRY.flush()
+    except Exception:
+        pass
@@ -0,0 +1,345 @@
+"""大きな動画の HLS（複数ビットレート）配信
+
+サイズかビットレートがしきい値を超える動画について、最初に再生されたときに
+複数の画質（レンディション）の HLS セグメントを生成し、キャッシュディレクトリに保存する。
+生成は1つの ffmpeg でデコード1回・複数エンコードで行い、プレイリストは
+EVENT 型なので最初のセグメントができた時点から再生を始められる。
+
+キャッシュは元ファイルのハッシュごとのディレクトリで、合計が HLS_CACHE_BUDGET を
+超えたら最後に再生されてから最も時間が経ったものから削除する。
+"""
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+
+import transcode
+
+HLS_ENABLED = os.environ.get('HLS_ENABLED', '').lower() in ('1', 'true', 'yes')
+HLS_CACHE_DIR = os.environ.get('HLS_CACHE_DIR', 'storage/hls')
+# キャッシュ全体の上限（バイト）
+HLS_CACHE_BUDGET = int(os.environ.get('HLS_CACHE_BUDGET', str(10 * 1024 ** 3)))
+# これ以上のサイズ（バイト）またはビットレート（bps）の動画を HLS で配信する
+HLS_MIN_SIZE = int(os.environ.get('HLS_MIN_SIZE', str(50 * 1024 ** 2)))
+HLS_MIN_BITRATE = int(os.environ.get('HLS_MIN_BITRATE', str(8 * 1000 ** 2)))
+# レンディション: 短辺の画素数:映像ビットレート(kbps) のカンマ区切り
+HLS_RENDITIONS = os.environ.get('HLS_RENDITIONS', '1080:5000,720:2800,360:800')
+HLS_CONCURRENCY = int(os.environ.get('HLS_CONCURRENCY', '1'))
+HLS_SEGMENT_SECONDS = 4
+AUDIO_BITRATE_KBPS = 128
+
+MASTER_MIME_TYPE = 'application/vnd.apple.mpegurl'
+SEGMENT_MIME_TYPE = 'video/mp2t'
+
+# レンディションのディレクトリ内で配信してよいファイル名
+SEGMENT_NAME = re.compile(r'^(index\.m3u8|seg_\d{5}\.ts)$')
+
+DONE_MARKER = '.done'
+ACCESS_MARKER = '.access'
+# 生成中はこのファイルの flock を持ち続ける（プロセスが終了すればロックは自動的に外れる）
+LOCK_FILE = '.lock'
+# 生成中でまだプレイリストがないときに返す Retry-After（秒）
+PLAYLIST_RETRY_AFTER = 2
+
+
+def parse_renditions(value):
+    """'1080:5000,720:2800' → [(1080, 5000), (720, 2800)]（短辺の大きい順）"""
+    renditions = []
+    for item in value.split(','):
+        if ':' not in item:
+            continue
+        short_side, kbps = item.split(':', 1)
+        renditions.append((int(short_side), int(kbps)))
+    renditions.sort(reverse=True)
+    return renditions
+
+
+def cache_key(file_hash):
+    return file_hash[:16]
+
+
+def _video_stream(probe):
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            return stream
+    return None
+
+
+def _display_size(stream):
+    """回転メタデータを考慮した表示上の (幅, 高さ)"""
+    width, height = int(stream.get('width') or 0), int(stream.get('height') or 0)
+    rotation = stream.get('tags', {}).get('rotate')
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+
+class HlsPackager:
+    """HLS レンディションの生成とキャッシュ管理"""
+
+    def __init__(self, cache_dir=HLS_CACHE_DIR, budget=HLS_CACHE_BUDGET,
+                 renditions=HLS_RENDITIONS, concurrency=HLS_CONCURRENCY):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.renditions = parse_renditions(renditions)
+        self._queue = transcode.TranscodeQueue(max_workers=concurrency)
+        self._lock = threading.Lock()
+        self._active = set()
+        self._probes = {}
+
+    # --- 判定 ---
+
+    def probe(self, file_path, file_hash):
+        """ffprobe の結果（ハッシュごとにキャッシュ）"""
+        key = cache_key(file_hash)
+        with self._lock:
+            probe = self._probes.get(key)
+        if probe is None:
+            probe = transcode.probe(file_path)
+            with self._lock:
+                if len(self._probes) > 1000:
+                    self._probes.clear()
+                self._probes[key] = probe
+        return probe
+
+    def is_eligible(self, file_path, file_size, file_hash):
+        """HLS で配信する対象か（サイズかビットレートがしきい値以上）"""
+        if file_size and file_size >= HLS_MIN_SIZE:
+            return True
+        try:
+            bit_rate = int(self.probe(file_path, file_hash).get('format', {}).get('bit_rate') or 0)
+        except Exception as e:
+            print(f"[HLS] ビットレートの取得に失敗: {file_path}, {e}")
+            return False
+        return bit_rate >= HLS_MIN_BITRATE
+
+    def variants(self, file_path, file_hash):
+        """元の動画の解像度を超えないレンディション [(番号, 幅, 高さ, 映像kbps)]"""
+        stream = _video_stream(self.probe(file_path, file_hash)) or {}
+        width, height = _display_size(stream)
+        source_short = min(width, height) if width and height else None
+        selected = [
+            (short_side, kbps) for short_side, kbps in self.renditions
+            if source_short is None or short_side <= source_short
+        ] or self.renditions[-1:]
+
+        variants = []
+        for index, (short_side, kbps) in enumerate(selected):
+            if width and height:
+                scale = short_side / min(width, height)
+                # H.264 の幅・高さは偶数にする
+                w, h = (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
+            else:
+                w = h = None
+            variants.append((index, w, h, kbps))
+        return variants
+
+    def has_audio(self, file_path, file_hash):
+        return any(
+            s.get('codec_type') == 'audio'
+            for s in self.probe(file_path, file_hash).get('streams', [])
+        )
+
+    # --- キャッシュ ---
+
+    def directory(self, file_hash):
+        return os.path.join(self.cache_dir, cache_key(file_hash))
+
+    def is_done(self, file_hash):
+        return os.path.exists(os.path.join(self.directory(file_hash), DONE_MARKER))
+
+    def touch(self, file_hash):
+        """最終アクセス時刻を記録（キャッシュの追い出し順に使う）"""
+        path = os.path.join(self.directory(file_hash), ACCESS_MARKER)
+        try:
+            with open(path, 'a'):
+                pass
+            os.utime(path)
+        except OSError:
+            pass
+
+    def segment_path(self, key, rendition, name):
+        """配信するファイルのパス（不正な名前なら None）"""
+        if not re.fullmatch(r'[0-9a-f]{1,16}', key) or not SEGMENT_NAME.match(name):
+            return None
+        return os.path.join(self.cache_dir, key, str(int(rendition)), name)
+
+    def _directory_size(self, path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def enforce_budget(self):
+        """キャッシュの合計が上限を超えていれば、最後のアクセスが古いものから削除"""
+        try:
+            keys = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return
+        entries = []
+        for key in keys:
+            path = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(path):
+                continue
+            access = os.path.join(path, ACCESS_MARKER)
+            last_access = os.path.getmtime(access) if os.path.exists(access) else os.path.getmtime(path)
+            entries.append((last_access, key, path, self._directory_size(path)))
+
+        total = sum(size for _, _, _, size in entries)
+        entries.sort()
+        for _, key, path, size in entries:
+            if total <= self.budget:
+                break
+            with self._lock:
+                if key in self._active:
+                    continue
+            if self._locked(path):
+                continue  # 別のプロセスが生成中
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            print(f"[HLS] キャッシュを削除: {key} ({size}バイト)")
+
+    # --- 生成 ---
+
+    def _acquire(self, directory):
+        """生成用のロックを取る（開いたロックファイル、他のプロセスが生成中なら None）
+
+        ロックは生成が終わるまで持ち続けるので、どれだけ長い生成でも二重には始まらない。
+        """
+        os.makedirs(directory, exist_ok=True)
+        lock = os.path.join(directory, LOCK_FILE)
+        f = open(lock, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # ロックを取る前にディレクトリごと削除（生成の失敗や追い出し）されていないか
+            if os.stat(lock).st_ino != os.fstat(f.fileno()).st_ino:
+                raise BlockingIOError
+        except (BlockingIOError, FileNotFoundError):
+            f.close()
+            return None
+        return f
+
+    def _locked(self, directory):
+        """別のプロセス（またはこのプロセス）が directory の生成中か"""
+        try:
+            f = open(os.path.join(directory, LOCK_FILE), 'r')
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            f.close()
+        return False
+
+    def is_generating(self, key):
+        """キャッシュキーのレンディションを生成中か（プレイリストを待つか 404 にするかの判断用）"""
+        return self._locked(os.path.join(self.cache_dir, key))
+
+    def ensure(self, file_path, file_hash):
+        """レンディションが未生成なら生成を開始する（生成済み・生成中なら何もしない）"""
+        key = cache_key(file_hash)
+        directory = self.directory(file_hash)
+        if self.is_done(file_hash):
+            return
+        with self._lock:
+            if key in self._active:
+                return
+            lock = self._acquire(directory)
+            if lock is None:
+                return
+            self._active.add(key)
+        self._queue.submit(self._generate, file_path, file_hash, lock)
+
+    def command(self, file_path, file_hash):
+        directory = self.directory(file_hash)
+        variants = self.variants(file_path, file_hash)
+        audio = self.has_audio(file_path, file_hash)
+
+        # 1回のデコードを split で各レンディションのスケーラーに分配する
+        outputs = ''.join(f'[v{i}]' for i, _, _, _ in variants)
+        filters = [f"[0:v]split={len(variants)}{outputs}"]
+        for i, w, h, _ in variants:
+            if w and h:
+                filters.append(f"[v{i}]scale={w}:{h}[o{i}]")
+            else:
+                filters.append(f"[v{i}]null[o{i}]")
+
+        command = ['ffmpeg', '-i', str(file_path), '-filter_complex', ';'.join(filters)]
+        stream_map = []
+        for i, _, _, kbps in variants:
+            command += ['-map', f'[o{i}]']
+            if audio:
+                command += ['-map', '0:a:0']
+            command += [
+                f'-c:v:{i}', 'libx264', f'-b:v:{i}', f'{kbps}k',
+                f'-maxrate:v:{i}', f'{int(kbps * 1.07)}k', f'-bufsize:v:{i}', f'{kbps * 2}k'
+            ]
+            stream_map.append(f'v:{i},a:{i}' if audio else f'v:{i}')
+        if audio:
+            command += ['-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE_KBPS}k', '-ac', '2']
+        command += [
+            '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+            # 全レンディションでキーフレーム位置を揃え、セグメント境界を一致させる
+            '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})',
+            '-sc_threshold', '0',
+            '-f', 'hls',
+            '-hls_time', str(HLS_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'event',
+            '-hls_flags', 'independent_segments+temp_file',
+            '-hls_segment_filename', os.path.join(directory, '%v', 'seg_%05d.ts'),
+            '-var_stream_map', ' '.join(stream_map),
+            os.path.join(directory, '%v', 'index.m3u8')
+        ]
+        return command
+
+    def _generate(self, file_path, file_hash, lock):
+        key = cache_key(file_hash)
+        directory = self.directory(file_hash)
+        started = time.monotonic()
+        try:
+            returncode, stderr = transcode.run_ffmpeg(self.command(file_path, file_hash))
+            if returncode == 0:
+                with open(os.path.join(directory, DONE_MARKER), 'w'):
+                    pass
+                print(f"[HLS] 生成完了: {key} ({time.monotonic() - started:.1f}秒)")
+            else:
+                print(f"[HLS] 生成エラー: {file_path}, {stderr[-500:]}")
+                shutil.rmtree(directory, ignore_errors=True)
+        except Exception as e:
+            print(f"[HLS] 生成エラー: {file_path}, {e}")
+            shutil.rmtree(directory, ignore_errors=True)
+        finally:
+            # ロックファイルは残す（削除すると、開いたばかりの別のプロセスと二重にロックを取りうる）
+            lock.close()
+            with self._lock:
+                self._active.discard(key)
+        self.enforce_budget()
+
+    def master_playlist(self, file_path, file_hash, base_url):
+        """マスタープレイリスト（各レンディションの index.m3u8 を指す）"""
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+        audio_bps = AUDIO_BITRATE_KBPS * 1000 if self.has_audio(file_path, file_hash) else 0
+        for i, w, h, kbps in self.variants(file_path, file_hash):
+            attributes = [f"BANDWIDTH={int(kbps * 1000 * 1.07) + audio_bps}"]
+            if w and h:
+                attributes.append(f"RESOLUTION={w}x{h}")
+            codecs = 'avc1.640028,mp4a.40.2' if audio_bps else 'avc1.640028'
+            attributes.append(f'CODECS="{codecs}"')
+            lines.append(f"#EXT-X-STREAM-INF:{','.join(attributes)}")
+            lines.append(f"{base_url}/{cache_key(file_hash)}/{i}/index.m3u8")
+        return '\n'.join(lines) + '\n'
+
+    def stats(self):
+        with self._lock:
+            active = len(self._active)
+        return dict(self._queue.stats(), active=active, budget=self.budget)
@@ -0,0 +1,128 @@
+"""よく使う元ファイルを高速なディスクに置くホット層
+
+元ファイルが USB HDD などの遅いディスク（EXTERNAL_STORAGE_PATH）にある場合、一覧のスクロールや
+ビューアのたびにランダムなシークが発生する。HOT_TIER_DIR（ローカルの SSD など）を設定すると、
+最近または繰り返し表示された元ファイルをそこへコピーし、以降の /files/<id> と /thumbnails/<id> は
+HDD に触れずにコピーから返す。ブラウズ中に HDD がスピンダウンできる。
+
+- コピーは内容のハッシュごとに1つ（ファイル名は同じでも内容が変われば別のコピー）
+- HOT_TIER_PROMOTE_AFTER 回目のアクセスでバックグラウンドにコピーする（1なら初回の表示後）
+- 合計が HOT_TIER_BUDGET を超えたら最後に使われてから最も時間が経ったものから削除する
+- HOT_TIER_MAX_FILE_SIZE より大きいファイル（長い動画など）はコピーしない
+
+コピーは1本のスレッドで順に行い、リクエストの読み込みと HDD のシークを奪い合わないようにする
+（submit を渡した場合は、元ファイルのあるディスクのI/Oワーカーで行う）。
+"""
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from disk_cache import DiskCache
+
+# 空の場合はホット層を使わない
+HOT_TIER_DIR = os.environ.get('HOT_TIER_DIR', '')
+HOT_TIER_BUDGET = int(os.environ.get('HOT_TIER_BUDGET', str(20 * 1024 ** 3)))
+HOT_TIER_PROMOTE_AFTER = max(1, int(os.environ.get('HOT_TIER_PROMOTE_AFTER', '1')))
+HOT_TIER_MAX_FILE_SIZE = int(os.environ.get('HOT_TIER_MAX_FILE_SIZE', str(512 * 1024 ** 2)))
+# アクセス回数を覚えておくファイル数（古いものから忘れる）
+HOT_TIER_TRACKED = int(os.environ.get('HOT_TIER_TRACKED', '100000'))
+
+
+class HotTier(DiskCache):
+    """元ファイルのコピーを置く高速ディスクのキャッシュ"""
+
+    log_tag = 'HOT_TIER'
+
+    def __init__(self, cache_dir=HOT_TIER_DIR, budget=HOT_TIER_BUDGET,
+                 promote_after=HOT_TIER_PROMOTE_AFTER, max_file_size=HOT_TIER_MAX_FILE_SIZE,
+                 tracked=HOT_TIER_TRACKED, submit=None):
+        super().__init__(cache_dir, budget)
+        self.promote_after = promote_after
+        self.max_file_size = max_file_size
+        self.tracked = tracked
+        self._accesses = OrderedDict()  # ファイルのハッシュ → ホット層にないときのアクセス回数
+        self._pending = set()
+        if submit is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hot-tier')
+            submit = lambda source_path, func, *args: executor.submit(func, *args)  # noqa: E731
+        # submit(元ファイルのパス, func, *args)
+        self._submit = submit
+        self.hits = 0
+        self.misses = 0
+        self.promoted = 0
+        self.skipped = 0
+
+    def path_for(self, file_hash, source_path):
+        ext = os.path.splitext(str(source_path))[1].lower()
+        return os.path.join(self.cache_dir, file_hash[:2], f"{file_hash[:32]}{ext}")
+
+    def lookup(self, file_hash, source_path):
+        """ホット層のコピーのパス（なければ None）。ない場合はアクセスを数え、必要ならコピーを予約する"""
+        if not file_hash:
+            return None
+        path = self.path_for(file_hash, source_path)
+        if self._touch(path):
+            with self._lock:
+                self.hits += 1
+            return path
+
+        with self._lock:
+            self.misses += 1
+            count = self._accesses.pop(file_hash, 0) + 1
+            if count < self.promote_after:
+                self._accesses[file_hash] = count
+                while len(self._accesses) > self.tracked:
+                    self._accesses.popitem(last=False)
+                return None
+            if file_hash in self._pending:
+                return None
+            self._pending.add(file_hash)
+        self._submit(str(source_path), self._promote, file_hash, str(source_path), path)
+        return None
+
+    def _promote(self, file_hash, source_path, path):
+        try:
+            size = os.path.getsize(source_path)
+            if size > self.max_file_size:
+                with self._lock:
+                    self.skipped += 1
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                shutil.copyfile(source_path, temp_path)
+                # 他のプロセスが同時にコピーしていても、置き換えは不可分なので読み手は途中のファイルを見ない
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                raise
+            with self._lock:
+                self.promoted += 1
+            self._added(size)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[HOT_TIER] コピーに失敗: {source_path}, {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(file_hash)
+
+    def stats(self):
+        total = self.total_size()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "directory": self.cache_dir,
+                "bytes": total,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "promoted": self.promoted,
+                "skipped_large": self.skipped,
+                "pending": len(self._pending)
+            }
@@ -0,0 +1,35 @@
+"""画像ライブラリ（Pillow・pillow_heif・libmagic）の遅延読み込み
+
+一覧やサムネイルの配信だけを行うプロセスではこれらのライブラリを使わないので、
+起動時には読み込まず、最初に画像を開くときやファイルの種類を判定するときに読み込む。
+HEIC のオープナーの登録も初回の読み込み時に一度だけ行う。
+"""
+import threading
+
+_lock = threading.Lock()
+_image = None
+_magic = None
+
+
+def pil():
+    """PIL.Image モジュール（HEIC のオープナー登録済み）"""
+    global _image
+    if _image is None:
+        with _lock:
+            if _image is None:
+                import pillow_heif  # HEIC画像サポート
+                from PIL import Image
+                pillow_heif.register_heif_opener()
+                _image = Image
+    return _image
+
+
+def mime_type(file_path):
+    """ファイルの内容から MIME タイプを判定（libmagic）"""
+    global _magic
+    if _magic is None:
+        with _lock:
+            if _magic is None:
+                import magic
+                _magic = magic
+    return _magic.from_file(str(file_path), mime=True)
@@ -0,0 +1,247 @@
+"""バックグラウンドジョブ
+
+時間のかかる処理（クリーンアップなど）をリクエストから切り離して別スレッドで実行し、
+進捗と結果を /jobs/<job_id> で参照できるようにする。
+
+gunicorn の複数ワーカーのどれが GET /jobs/<job_id> を受けても同じ結果を返すよう、ジョブの状態は
+SQLite の jobs テーブルに保存する。同じ種類のジョブを同時に1つだけ実行するための確認は
+種類ごとのロックファイルの flock で行う（プロセスが終了すればロックは自動的に外れるので、
+実行中のまま終了したワーカーのジョブは次の参照時に failed にする）。
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import db
+
+# 進捗をデータベースに書き込む最短の間隔（秒）
+PROGRESS_FLUSH_INTERVAL = 0.5
+
+SQL_INSERT_JOB = """
+    INSERT INTO jobs (id, kind, params, status, progress, created_at, pid)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_UPDATE_JOB = """
+    UPDATE jobs SET status = ?, progress = ?, result = ?, error = ?, finished_at = ? WHERE id = ?
+"""
+SQL_JOB_COLUMNS = "id, kind, params, status, progress, result, error, created_at, finished_at"
+SQL_ACTIVE_JOB_BY_KIND = f"""
+    SELECT {SQL_JOB_COLUMNS} FROM jobs
+    WHERE kind = ? AND status IN ('pending', 'running') ORDER BY created_at DESC LIMIT 1
+"""
+SQL_TRIM_JOBS = """
+    DELETE FROM jobs WHERE status NOT IN ('pending', 'running') AND id NOT IN (
+        SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?
+    )
+"""
+
+
+class Job:
+    """1回分のジョブの状態"""
+
+    def __init__(self, kind, params=None, manager=None):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.params = params or {}
+        self.status = 'pending'     # pending / running / completed / failed
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._manager = manager
+        self._flushed_at = 0.0
+
+    @classmethod
+    def from_row(cls, row):
+        job_id, kind, params, status, progress, result, error, created_at, finished_at = row
+        job = cls(kind, json.loads(params) if params else None)
+        job.id = job_id
+        job.status = status
+        job.progress = json.loads(progress) if progress else {}
+        job.result = json.loads(result) if result else None
+        job.error = error
+        job.created_at = created_at
+        job.finished_at = finished_at
+        return job
+
+    @property
+    def active(self):
+        return self.status in ('pending', 'running')
+
+    def update(self, **progress):
+        """進捗を更新（ジョブ関数から呼ぶ、データベースへは一定間隔で書き込む）"""
+        self.progress.update(progress)
+        now = time.monotonic()
+        if self._manager is not None and now - self._flushed_at >= PROGRESS_FLUSH_INTERVAL:
+            self._flushed_at = now
+            self._manager.save(self)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobManager:
+    """ジョブの起動と状態管理（同じ種類のジョブはすべてのワーカーを通して同時に1つだけ実行する）"""
+
+    def __init__(self, database_path, max_history=50):
+        self.database_path = database_path
+        self.max_history = max_history
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # ジョブ関数のトランザクションを途中でコミットしないよう、状態の書き込みには専用の接続を使う
+        if self._conn is None:
+            self._conn = db.open_connection(self.database_path)
+        return self._conn
+
+    def _kind_lock_path(self, kind):
+        return f"{self.database_path}.job-{kind}.lock"
+
+    def _try_lock(self, kind):
+        """種類ごとのロックを取る（他で実行中なら None）"""
+        f = open(self._kind_lock_path(kind), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    def is_running(self, kind):
+        """その種類のジョブがいずれかのプロセスで実行中か"""
+        f = self._try_lock(kind)
+        if f is None:
+            return True
+        f.close()
+        return False
+
+    def start(self, kind, func, params=None):
+        """func(job) を別スレッドで実行する。同じ種類のジョブが実行中ならそれを返す"""
+        lock = self._try_lock(kind)
+        if lock is None:
+            # ロックを取ったプロセスが行を書き込むまでの短い間は少し待つ
+            for _ in range(20):
+                job = self._active(kind)
+                if job is not None:
+                    return job, False
+                time.sleep(0.05)
+            raise RuntimeError(f"実行中の {kind} ジョブが見つかりません")
+
+        try:
+            job = Job(kind, params, manager=self)
+            with self._lock:
+                conn = self._connection()
+                # 前回のプロセスが終了して残った実行中の行を片付ける
+                self._fail_stale(conn, kind)
+                conn.execute(SQL_INSERT_JOB, (
+                    job.id, kind, json.dumps(job.params), job.status, '{}', job.created_at, os.getpid()
+                ))
+                conn.execute(SQL_TRIM_JOBS, (self.max_history,))
+                conn.commit()
+        except BaseException:
+            lock.close()
+            raise
+
+        thread = threading.Thread(target=self._run, args=(job, func, lock), name=f"job-{kind}", daemon=True)
+        thread.start()
+        return job, True
+
+    def _run(self, job, func, lock):
+        job.status = 'running'
+        self.save(job)
+        try:
+            job.result = func(job)
+            job.status = 'completed'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+            print(f"[JOB] {job.kind} 失敗: {e}")
+            traceback.print_exc()
+        finally:
+            job.finished_at = time.time()
+            try:
+                self.save(job)
+            finally:
+                lock.close()
+
+    def save(self, job):
+        """ジョブの状態をデータベースに書き込む"""
+        result = json.dumps(job.result, default=str) if job.result is not None else None
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(SQL_UPDATE_JOB, (
+                    job.status, json.dumps(job.progress, default=str), result,
+                    job.error, job.finished_at, job.id
+                ))
+                conn.commit()
+        except Exception as e:
+            print(f"[JOB] 状態の保存に失敗: {job.kind}, {e}")
+
+    def _fail_stale(self, conn, kind):
+        """ロックが外れているのに実行中のままの行（ワーカーの終了などで中断したジョブ）を failed にする"""
+        conn.execute("""
+            UPDATE jobs SET status = 'failed', error = ?, finished_at = ?
+            WHERE kind = ? AND status IN ('pending', 'running')
+        """, ("ジョブを実行していたプロセスが終了しました", time.time(), kind))
+
+    def _check_stale(self, jobs):
+        stale = {job.kind for job in jobs if job.active and not self.is_running(job.kind)}
+        if not stale:
+            return False
+        with self._lock:
+            conn = self._connection()
+            for kind in stale:
+                # 確認とロックの間に別のプロセスが開始していないか確かめてから片付ける
+                lock = self._try_lock(kind)
+                if lock is None:
+                    continue
+                try:
+                    self._fail_stale(conn, kind)
+                    conn.commit()
+                finally:
+                    lock.close()
+        return True
+
+    def _active(self, kind):
+        with self._lock:
+            row = self._connection().execute(SQL_ACTIVE_JOB_BY_KIND, (kind,)).fetchone()
+        return Job.from_row(row) if row else None
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection().execute(
+                f"SELECT {SQL_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = Job.from_row(row)
+        if self._check_stale([job]):
+            return self.get(job_id)
+        return job
+
+    def list(self):
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT {SQL_JOB_COLUMNS} FROM jobs ORDER BY created_at DESC LIMIT ?", (self.max_history,)
+            ).fetchall()
+        jobs = [Job.from_row(row) for row in rows]
+        if self._check_stale(jobs):
+            return self.list()
+        return jobs
@@ -0,0 +1,356 @@
+"""一覧表示用のメモリ上のインデックス
+
+/files のページ分けと種類での絞り込み、月ごとの件数（タイムライン）を SQLite を使わずに返すため、
+全ファイルの id・撮影日時・作成日時・種類・撮影月を一覧の並び順（撮影日時の新しい順、
+作成日時の新しい順、id 順）で列ごとの配列に持つ。深いページでも OFFSET の走査がない。
+ページに表示する各ファイルの詳細は、主キーでデータベースから取得する。
+
+データベースの変更はバックグラウンドのスレッドが LIBRARY_INDEX_REFRESH_INTERVAL 秒ごとに
+PRAGMA data_version で検出するので、/files と /timeline はデータベースを使わない。他の接続
+（同じプロセスの別スレッドや他のワーカープロセス）がコミットしていれば、rowid が前回より大きい行を
+追加し、files のトリガーが記録する file_changes から削除・更新された行を差分で取り込む。
+file_changes の取り込んでいない分が削除されていた場合だけ全件を読み直す。差分は新しい配列を
+スライスの連結で作って入れ替えるので、まとめて追加しても1行ずつの挿入のように遅くならない。
+
+メモリはワーカープロセスごとに使う（40万件で数十MB程度）。
+"""
+import os
+import threading
+from array import array
+from calendar import timegm
+from datetime import datetime
+
+import db
+import logs
+
+log = logs.get_logger('index')
+
+LIBRARY_INDEX_ENABLED = os.environ.get('LIBRARY_INDEX', '0').lower() in ('1', 'true', 'yes')
+# 他の接続の変更を確認する間隔（秒）
+LIBRARY_INDEX_REFRESH_INTERVAL = float(os.environ.get('LIBRARY_INDEX_REFRESH_INTERVAL', '1.0'))
+
+FILE_TYPES = ('image', 'video', 'other')
+_TYPE_CODES = {name: code for code, name in enumerate(FILE_TYPES)}
+
+# 撮影日時がない行（SQLite の NULL と同じく降順で最後に並ぶ）
+MISSING = -(1 << 63)
+
+# 全件の読み込みでは並び順の値・年月・種類の番号を SQLite 側で計算する（Python で1行ずつ変換すると遅い）
+_TIMESTAMP_SQL = (
+    "COALESCE(CAST(strftime('%s', {column}) AS INTEGER) * 1000000"
+    " + CAST(substr(substr({column}, 21) || '000000', 1, 6) AS INTEGER), {missing})"
+)
+SQL_INDEX_ROWS = f"""
+    SELECT rowid, id,
+        {_TIMESTAMP_SQL.format(column='taken_date', missing=MISSING)},
+        {_TIMESTAMP_SQL.format(column='created_at', missing=MISSING)},
+        CASE file_type WHEN 'image' THEN 0 WHEN 'video' THEN 1 ELSE 2 END,
+        COALESCE(CAST(substr(taken_date, 1, 4) AS INTEGER) * 100 + CAST(substr(taken_date, 6, 2) AS INTEGER), 0)
+    FROM files
+    ORDER BY taken_date DESC, created_at DESC, id
+"""
+SQL_INDEX_ROWS_AFTER = """
+    SELECT rowid, id, taken_date, created_at, file_type FROM files
+    WHERE rowid > ? ORDER BY rowid
+"""
+SQL_INDEX_ROWS_BY_ID = """
+    SELECT rowid, id, taken_date, created_at, file_type FROM files WHERE id IN ({placeholders})
+"""
+SQL_CHANGES_AFTER = "SELECT seq, file_id FROM file_changes WHERE seq > ? ORDER BY seq"
+# これまでに記録した最後の変更の番号（file_changes は AUTOINCREMENT なので削除された行も数える）
+SQL_LAST_CHANGE = "SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'file_changes'"
+
+# IN (...) に渡す ID の最大数
+_ID_CHUNK = 500
+
+
+def timestamp_key(value):
+    """'YYYY-MM-DD HH:MM:SS[.ffffff]' → UTC とみなしたマイクロ秒の整数（SQL_INDEX_ROWS と同じ値）"""
+    if value is None:
+        return MISSING
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value))
+        except ValueError:
+            return MISSING
+    return timegm(value.utctimetuple()) * 1000000 + value.microsecond
+
+
+def month_key(value):
+    """撮影日時の年月（YYYYMM の整数、ない場合は 0）"""
+    if value is None:
+        return 0
+    text = str(value)
+    try:
+        return int(text[:4]) * 100 + int(text[5:7])
+    except ValueError:
+        return 0
+
+
+def month_label(month):
+    return f"{month // 100:04d}-{month % 100:02d}" if month else None
+
+
+def _empty_columns():
+    """(id, rowid, 撮影日時, 作成日時, 種類, 撮影月) の列"""
+    return [], array('q'), array('q'), array('q'), array('b'), array('l')
+
+
+def _entry(rowid, file_id, taken_date, created_at, file_type):
+    """データベースの行 → 列の並びの値"""
+    return (file_id, rowid, timestamp_key(taken_date), timestamp_key(created_at),
+            _TYPE_CODES.get(file_type, 2), month_key(taken_date))
+
+
+def _sort_key(entry):
+    return -entry[2], -entry[3], entry[0]
+
+
+def _position(columns, key):
+    """並び順で key（_sort_key の値）を挿入する位置"""
+    ids, _, taken, created = columns[:4]
+    low, high = 0, len(ids)
+    while low < high:
+        middle = (low + high) // 2
+        if (-taken[middle], -created[middle], ids[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _without(columns, positions):
+    """positions（昇順）の行を除いた列"""
+    result = _empty_columns()
+    start = 0
+    for position in positions + [len(columns[0])]:
+        for column, target in zip(columns, result):
+            target.extend(column[start:position])
+        start = position + 1
+    return result
+
+
+def _merged(columns, entries):
+    """entries を並び順の位置に入れた列（既存の行はスライスでまとめてコピーする）"""
+    result = _empty_columns()
+    start = 0
+    for entry in sorted(entries, key=_sort_key):
+        position = _position(columns, _sort_key(entry))
+        for column, target in zip(columns, result):
+            target.extend(column[start:position])
+        for value, target in zip(entry, result):
+            target.append(value)
+        start = position
+    for column, target in zip(columns, result):
+        target.extend(column[start:])
+    return result
+
+
+class LibraryIndex:
+    def __init__(self, database_path):
+        self.database_path = database_path
+        # 読み取りは _lock、列の作り直し（refresh と remove）は _update_lock で直列にする
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+        self.ready = False
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._set_columns(_empty_columns())
+        self._last_rowid = 0
+        self._last_change = 0
+        self.reloads = 0
+        self.refreshes = 0
+
+    def _set_columns(self, columns):
+        self._ids, self._rowids, self._taken, self._created, self._types, self._months = columns
+        self._derived = {}  # 種類ごとの位置・タイムライン（行が増減したときに作り直す）
+
+    def _columns(self):
+        return self._ids, self._rowids, self._taken, self._created, self._types, self._months
+
+    def _swap(self, columns):
+        with self._lock:
+            self._set_columns(columns)
+
+    def _connection(self):
+        # data_version は接続ごとの値なので、スレッドごとのプールではなく専用の接続を使う
+        if self._conn is None:
+            self._conn = db.open_connection(self.database_path)
+        return self._conn
+
+    def start_loading(self, interval=LIBRARY_INDEX_REFRESH_INTERVAL):
+        """バックグラウンドで全件を読み込み、その後は interval 秒ごとに変更を取り込む
+
+        読み込みが終わるまでの問い合わせはデータベースで処理する。
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    log.warning("library index refresh failed", extra={"error": str(e)})
+                self._wake.wait(interval)
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=run, name='library-index', daemon=True)
+        self._thread.start()
+
+    def changed(self):
+        """このプロセスで行を追加した（次の確認を待たずに取り込む）"""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _load_all(self, conn):
+        columns = _empty_columns()
+        self._last_change = conn.execute(SQL_LAST_CHANGE).fetchone()[0]
+        cursor = conn.execute(SQL_INDEX_ROWS)
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            rowids, ids, taken, created, types, months = zip(*rows)
+            for column, values in zip(columns, (ids, rowids, taken, created, types, months)):
+                column.extend(values)
+        self._last_rowid = max(columns[1], default=0)
+        self._swap(columns)
+        self.reloads += 1
+
+    def refresh(self):
+        """データベースが変わっていれば差分を取り込む"""
+        with self._update_lock:
+            conn = self._connection()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if self.ready and data_version == self._data_version:
+                return
+            self._data_version = data_version
+            # file_changes と files を同じ時点の内容で読む
+            conn.execute("BEGIN")
+            try:
+                if not self.ready:
+                    self._load_all(conn)
+                    self.ready = True
+                    log.info("library index loaded", extra={"entries": len(self._ids)})
+                else:
+                    self._apply_changes(conn)
+                    self.refreshes += 1
+            finally:
+                conn.rollback()
+
+    def _apply_changes(self, conn):
+        changes = conn.execute(SQL_CHANGES_AFTER, (self._last_change,)).fetchall()
+        if len(changes) != conn.execute(SQL_LAST_CHANGE).fetchone()[0] - self._last_change:
+            # 取り込む前に削除された変更がある
+            self._load_all(conn)
+            return
+        if changes:
+            self._last_change = changes[-1][0]
+        changed = list({file_id for _, file_id in changes})
+
+        columns = original = self._columns()
+        removed, added = set(), {}
+        for i in range(0, len(changed), _ID_CHUNK):
+            chunk = changed[i:i + _ID_CHUNK]
+            rows = conn.execute(
+                SQL_INDEX_ROWS_BY_ID.format(placeholders=','.join('?' * len(chunk))), chunk
+            ).fetchall()
+            current = {row[1]: _entry(*row) for row in rows}
+            for file_id in chunk:
+                entry = current.get(file_id)
+                if entry is not None:
+                    # 並び順と種類が変わっていない行（サムネイルの更新など）はそのまま
+                    position = _position(columns, _sort_key(entry))
+                    if (position < len(columns[0]) and columns[0][position] == file_id
+                            and columns[4][position] == entry[4]):
+                        continue
+                    added[file_id] = entry
+                removed.add(file_id)
+
+        if removed:
+            positions = [i for i, file_id in enumerate(columns[0]) if file_id in removed]
+            if positions:
+                removed_rowids = {columns[1][i] for i in positions}
+                columns = _without(columns, positions)
+                if self._last_rowid in removed_rowids:
+                    # 末尾の行が削除されると rowid が再利用されるので、残っている最大の rowid から読む
+                    self._last_rowid = max(columns[1], default=0)
+
+        for row in conn.execute(SQL_INDEX_ROWS_AFTER, (self._last_rowid,)):
+            added[row[1]] = _entry(*row)
+        if added:
+            self._last_rowid = max(self._last_rowid, max(entry[1] for entry in added.values()))
+            columns = _merged(columns, added.values())
+        if columns is not original:
+            self._swap(columns)
+
+    def remove(self, file_ids):
+        """このプロセスで削除した行を即座に除く"""
+        removed = set(file_ids)
+        with self._update_lock:
+            if not self.ready:
+                return
+            columns = self._columns()
+            positions = [i for i, file_id in enumerate(columns[0]) if file_id in removed]
+            if not positions:
+                return
+            removed_rowids = {columns[1][i] for i in positions}
+            columns = _without(columns, positions)
+            if self._last_rowid in removed_rowids:
+                self._last_rowid = max(columns[1], default=0)
+            self._swap(columns)
+
+    def _positions(self, file_type):
+        """種類 file_type の行の位置（並び順）"""
+        key = ('positions', file_type)
+        positions = self._derived.get(key)
+        if positions is None:
+            code = _TYPE_CODES[file_type]
+            positions = self._derived[key] = array(
+                'l', (i for i, value in enumerate(self._types) if value == code))
+        return positions
+
+    def page(self, offset, limit, file_type=None):
+        """(総件数, ページの id のリスト)"""
+        with self._lock:
+            if file_type is None:
+                return len(self._ids), self._ids[offset:offset + limit]
+            positions = self._positions(file_type)
+            return len(positions), [self._ids[i] for i in positions[offset:offset + limit]]
+
+    def timeline(self, file_type=None):
+        """[(年月, 件数), ...]（新しい月から）"""
+        with self._lock:
+            key = ('timeline', file_type)
+            result = self._derived.get(key)
+            if result is None:
+                counts = {}
+                code = _TYPE_CODES[file_type] if file_type else None
+                for month, value in zip(self._months, self._types):
+                    if code is None or value == code:
+                        counts[month] = counts.get(month, 0) + 1
+                # 撮影月がないもの（0）は最後
+                result = self._derived[key] = [
+                    (month_label(month), counts[month])
+                    for month in sorted(counts, key=lambda m: (m == 0, -m))
+                ]
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "ready": self.ready,
+                "entries": len(self._ids),
+                "last_rowid": self._last_rowid,
+                "last_change": self._last_change,
+                "refreshes": self.refreshes,
+                "reloads": self.reloads
+            }
@@ -0,0 +1,156 @@
+"""構造化ログ（1行1 JSON）
+
+リクエストスレッドはレコードをキューに入れるだけで、書き込みは QueueListener の
+スレッドが行うので、ログの I/O がリクエストを待たせない。キューがあふれた場合は
+リクエストを止めずにレコードを捨て、捨てた件数を数える。
+
+ロガーはサブシステムごとに image_syncer.<subsystem> で、レベルは LOG_LEVELS で個別に変えられる。
+
+    LOG_LEVEL=INFO
+    LOG_LEVELS=request=DEBUG,scan=WARNING
+    LOG_SAMPLE_RATE=0.01    # DEBUG のレコードを1%だけ出力
+
+リクエストごとの DEBUG ログ（request サブシステム）は既定では出力しない。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+ROOT_LOGGER = 'image_syncer'
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# サブシステムごとのレベル（例: request=DEBUG,scan=WARNING）
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+# DEBUG 以下のレコードを出力する割合（0〜1）
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+# 出力先（未設定なら標準出力）。ファイルの場合は LOG_MAX_BYTES ごとにローテーションする
+LOG_FILE = os.environ.get('LOG_FILE')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+# 書き込み待ちのレコード数の上限
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+# LogRecord の標準の属性（これ以外の属性は extra で渡されたフィールドとして出力する）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """DEBUG 以下のレコードを rate の割合だけ通す（INFO 以上は常に通す）"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯ならレコードを捨てる（リクエストスレッドを待たせない）"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_lock = threading.Lock()
+_handler = None
+_listener = None
+
+
+def _output_handler():
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def parse_levels(spec):
+    """'request=DEBUG,scan=WARNING' → {'request': 'DEBUG', 'scan': 'WARNING'}"""
+    levels = {}
+    for item in spec.split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup():
+    """ロガーとキューの書き込みスレッドを準備（何度呼んでもよい）
+
+    gunicorn はアプリをフォーク後に読み込むので、書き込みスレッドはワーカーごとに起動される。
+    """
+    global _handler, _listener
+    with _lock:
+        if _listener:
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        for name, level in parse_levels(LOG_LEVELS).items():
+            logging.getLogger(f"{ROOT_LOGGER}.{name}").setLevel(level)
+
+        if _handler:
+            root.removeHandler(_handler)
+        _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        if LOG_SAMPLE_RATE < 1.0:
+            _handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+        root.addHandler(_handler)
+
+        _listener = logging.handlers.QueueListener(_handler.queue, _output_handler())
+        _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """キューに残ったレコードを書き出して書き込みスレッドを止める"""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener:
+        listener.stop()
+
+
+def get_logger(subsystem):
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def dropped_count():
+    """キューがあふれて捨てたレコード数"""
+    return _handler.dropped if _handler else 0
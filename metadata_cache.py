@@ -0,0 +1,205 @@
+"""ファイルID → (パス, MIMEタイプ, サムネイル) のインメモリLRUキャッシュ
+
+/files/<id> と /thumbnails/<id> のたびにデータベースを引かないためのキャッシュ。
+全スレッドで共有し、ファイルの削除・書き換え時に invalidate() で無効化する。
+
+他のワーカープロセスでの書き換え（Live Photos の変換でパスが変わった場合など）は、
+files のトリガーが記録する file_changes を読んで無効化する。start_sync() で起動した
+バックグラウンドのスレッドが METADATA_CACHE_SYNC_INTERVAL 秒ごとに PRAGMA data_version
+（他の接続がコミットすると変わる）を確認し、変わっていた場合だけ前回より後の変更を取り込む。
+リクエストのスレッドはデータベースに触れないので、他のプロセスの変更が反映されるまでには
+最大でこの間隔だけ遅れる（同じプロセスでの変更は invalidate() ですぐに反映される）。
+file_changes の古い行の削除も同じスレッドで行う。
+
+読み込み中に無効化された行を古い内容のまま格納しないよう、無効化のたびに世代を進め、
+読み込みを始めたときと世代が変わっていれば格納しない。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+import logs
+
+log = logs.get_logger('cache')
+
+# file_changes に残す変更の件数（これより遅れたプロセスはキャッシュ全体を捨てる）
+FILE_CHANGES_KEEP = 10000
+# file_changes の古い行を削除する間隔（秒）
+_TRIM_INTERVAL = 60
+# 他のプロセスの変更を確認する間隔（秒）
+METADATA_CACHE_SYNC_INTERVAL = float(os.environ.get('METADATA_CACHE_SYNC_INTERVAL', '0.5'))
+
+
+class FileMeta:
+    """キャッシュエントリ（__slots__ で1件あたりのメモリを抑える）"""
+    __slots__ = (
+        'file_path', 'original_name', 'mime_type', 'thumbnail_path', 'file_type',
+        'file_hash', 'thumbnail_hash', 'derivative'
+    )
+
+    def __init__(self, file_path, original_name, mime_type, thumbnail_path, file_type,
+                 file_hash=None, thumbnail_hash=None, derivative=None):
+        self.file_path = file_path
+        self.original_name = original_name
+        self.mime_type = mime_type
+        self.thumbnail_path = thumbnail_path
+        self.file_type = file_type
+        self.file_hash = file_hash
+        self.thumbnail_hash = thumbnail_hash
+        self.derivative = derivative      # 表示用の派生画像の形式（HEIC_MODE=lazy の HEIC）
+
+
+class MetadataCache:
+    """スレッドセーフな容量制限付きLRUキャッシュ"""
+
+    def __init__(self, max_entries=10000, database_path=None):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        # 他のプロセスの変更の取り込み（database_path を指定した場合のみ）
+        self.database_path = database_path
+        self._sync_lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+        self._last_change = None
+        self._next_trim = time.monotonic() + _TRIM_INTERVAL
+        self._sync_thread = None
+        self._stop = threading.Event()
+        self.synced_changes = 0
+
+    def _connection(self):
+        # data_version は接続ごとの値なので、スレッドごとのプールではなく専用の接続を使う
+        if self._conn is None:
+            self._conn = db.open_connection(self.database_path)
+        return self._conn
+
+    def sync(self):
+        """他の接続がコミットしていれば、その後の files の変更をキャッシュから除く"""
+        if self.database_path is None:
+            return
+        with self._sync_lock:
+            conn = self._connection()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            if self._last_change is None:
+                # 初回: 現在までの変更はキャッシュが空なので読まない
+                self._last_change = conn.execute(
+                    "SELECT COALESCE(MAX(seq), 0) FROM file_changes"
+                ).fetchone()[0]
+                return
+            oldest = conn.execute("SELECT MIN(seq) FROM file_changes").fetchone()[0]
+            rows = conn.execute(
+                "SELECT seq, file_id FROM file_changes WHERE seq > ? ORDER BY seq", (self._last_change,)
+            ).fetchall()
+            if oldest is not None and oldest > self._last_change + 1:
+                # 取り込む前に削除された変更がある
+                self.clear()
+            else:
+                self._invalidate_many(file_id for _, file_id in rows)
+            if rows:
+                self._last_change = rows[-1][0]
+                self.synced_changes += len(rows)
+
+    def trim(self):
+        """取り込み済みの file_changes のうち、FILE_CHANGES_KEEP 件より古い行を削除"""
+        if self.database_path is None:
+            return
+        with self._sync_lock:
+            if self._last_change is None:
+                return
+            conn = self._connection()
+            conn.execute("DELETE FROM file_changes WHERE seq <= ?", (self._last_change - FILE_CHANGES_KEEP,))
+            conn.commit()
+
+    def start_sync(self, interval=METADATA_CACHE_SYNC_INTERVAL):
+        """他のプロセスの変更を取り込むバックグラウンドのスレッドを開始"""
+        if self.database_path is None or self._sync_thread is not None:
+            return
+        self.sync()
+        self._sync_thread = threading.Thread(
+            target=self._sync_loop, args=(interval,), name='metadata-cache-sync', daemon=True
+        )
+        self._sync_thread.start()
+
+    def stop_sync(self):
+        self._stop.set()
+
+    def _sync_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sync()
+                if time.monotonic() > self._next_trim:
+                    self._next_trim = time.monotonic() + _TRIM_INTERVAL
+                    self.trim()
+            except Exception as e:
+                log.warning("file change sync failed", extra={"error": str(e)})
+
+    def get(self, file_id):
+        """キャッシュから取得（なければ None）"""
+        with self._lock:
+            meta = self._entries.get(file_id)
+            if meta is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+            return meta
+
+    def put(self, file_id, meta, generation=None):
+        """キャッシュに追加し、容量を超えた分を古い順に追い出す
+
+        generation を指定した場合、その後に無効化があれば（読み込んだ内容が古い可能性があるので）格納しない。
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[file_id] = meta
+            self._entries.move_to_end(file_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, file_id, loader):
+        """キャッシュになければ loader(file_id) で読み込んで格納する"""
+        meta = self.get(file_id)
+        if meta is None:
+            generation = self._generation
+            meta = loader(file_id)
+            if meta is not None:
+                self.put(file_id, meta, generation)
+        return meta
+
+    def invalidate(self, file_id):
+        self._invalidate_many((file_id,))
+
+    def _invalidate_many(self, file_ids):
+        with self._lock:
+            self._generation += 1
+            for file_id in file_ids:
+                self._entries.pop(file_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """サイズ調整用の統計情報"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "synced_changes": self.synced_changes,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,408 @@
+"""Prometheus 形式のメトリクス
+
+外部ライブラリを使わない最小限のカウンター・ゲージ・ヒストグラムで、
+/metrics から Prometheus のテキスト形式（0.0.4）で出力する。
+
+値はプロセスごとに保持し、METRICS_DIR（既定は storage/metrics）にプロセスごとのファイル
+（<pid>.json）として定期的に書き出す。/metrics はすべてのファイルを読んで集計するので、
+gunicorn のどのワーカーがスクレイプを受けても全ワーカーの合計を返す。
+
+- カウンターとヒストグラムは全プロセスの合計（終了したワーカーの値は archive.json にまとめて残すので、
+  max_requests でワーカーが入れ替わっても値は減らない）
+- ゲージはプロセスごとの現在値なので、生きているプロセスの値を pid ラベル付きで出力する
+- 他のワーカーの値は最大で METRICS_FLUSH_INTERVAL 秒遅れる
+
+METRICS_DIR を空にすると書き出さず、/metrics はそのリクエストを処理したプロセスの値になる。
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+import profiling
+
+# リクエストやクエリなど短い処理用（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# ffmpeg など長い処理用（秒）
+SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# プロセスごとの値を書き出すディレクトリ（空の場合はプロセスごとに出力）
+METRICS_DIR = os.environ.get('METRICS_DIR', 'storage/metrics')
+# 値を書き出す間隔（秒）
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+ARCHIVE_NAME = 'archive.json'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベルは {self.labelnames} を指定してください")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, values):
+        for key, value in values.items():
+            total[key] = total.get(key, 0) + value
+
+    def collect(self, values=None):
+        items = sorted((self.snapshot() if values is None else values).items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Gauge(_Metric):
+    """現在値。callback を渡すと出力のたびに呼び出して値を得る
+
+    callback はラベルなしなら数値を、ラベルありなら {ラベル値のタプル: 数値} を返す。
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def snapshot(self):
+        if self._callback:
+            try:
+                value = self._callback()
+            except Exception as e:
+                print(f"[METRICS] {self.name} の取得に失敗: {e}")
+                return {}
+            return value if isinstance(value, dict) else {(): value}
+        with self._lock:
+            return dict(self._values)
+
+    def collect(self, values=None, labelnames=None):
+        """values を渡した場合はその値を labelnames（既定は自分のラベル）で出力する"""
+        values = self.snapshot() if values is None else values
+        labelnames = labelnames or self.labelnames
+        return [f"{self.name}{_format_labels(labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}  # ラベル → [各バケットの件数..., 合計, 件数]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(state) for key, state in self._values.items()}
+
+    @staticmethod
+    def merge(total, values):
+        for key, state in values.items():
+            current = total.get(key)
+            if current is None or len(current) != len(state):
+                total[key] = list(state)
+            else:
+                total[key] = [a + b for a, b in zip(current, state)]
+
+    def collect(self, values=None):
+        items = sorted((self.snapshot() if values is None else values).items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class _Timer:
+    """with ブロックの経過時間をヒストグラムに記録"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _encode(values):
+    return [[list(key), value] for key, value in values.items()]
+
+
+def _decode(items):
+    return {tuple(key): value for key, value in items}
+
+
+class Registry:
+    def __init__(self, multiprocess_dir=METRICS_DIR):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self.multiprocess_dir = multiprocess_dir
+        self._flusher = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def _registered(self):
+        with self._lock:
+            return list(self._metrics)
+
+    def flush(self):
+        """このプロセスの値を <pid>.json に書き出す（置き換えは不可分なので読み手は途中の内容を見ない）"""
+        if not self.multiprocess_dir:
+            return
+        data = {metric.name: _encode(metric.snapshot()) for metric in self._registered()}
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        path = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def start_flusher(self, interval=METRICS_FLUSH_INTERVAL):
+        """一定間隔で flush() するスレッドを起動"""
+        if not self.multiprocess_dir or self._flusher is not None:
+            return
+        # 同じ pid の終了したプロセスのファイルが残っていれば、上書きせずに集計へ回す
+        path = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        if os.path.exists(path):
+            os.replace(path, os.path.join(self.multiprocess_dir, f"{os.getpid()}.{time.time_ns()}.dead.json"))
+        self.flush()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"[METRICS] 書き出しに失敗: {e}")
+
+        self._flusher = threading.Thread(target=run, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def reset(self):
+        """前回の起動で書き出したファイルを削除（gunicorn のマスタープロセスの起動時に呼ぶ）"""
+        if not self.multiprocess_dir or not os.path.isdir(self.multiprocess_dir):
+            return
+        for name in os.listdir(self.multiprocess_dir):
+            if name.endswith('.json') or name.endswith('.tmp'):
+                try:
+                    os.unlink(os.path.join(self.multiprocess_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def _aggregate(self, metrics):
+        """すべてのプロセスのファイルを集計し、(合計, 生きているプロセスごとのゲージ) を返す"""
+        mergeable = {m.name: m for m in metrics if isinstance(m, (Counter, Histogram))}
+        totals = {name: {} for name in mergeable}
+        gauges = {}
+        directory = self.multiprocess_dir
+        with open(os.path.join(directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                archive_path = os.path.join(directory, ARCHIVE_NAME)
+                try:
+                    with open(archive_path) as f:
+                        archive = {name: _decode(items) for name, items in json.load(f).items()}
+                except (FileNotFoundError, ValueError):
+                    archive = {}
+                archived = False
+                for name in os.listdir(directory):
+                    stem = name[:-5]
+                    dead = stem.endswith('.dead')
+                    if not name.endswith('.json') or not (dead or stem.isdigit()):
+                        continue
+                    pid = int(stem.split('.')[0])
+                    path = os.path.join(directory, name)
+                    try:
+                        with open(path) as f:
+                            data = {key: _decode(items) for key, items in json.load(f).items()}
+                    except (FileNotFoundError, ValueError):
+                        continue
+                    if dead or (pid != os.getpid() and not _process_alive(pid)):
+                        # 終了したワーカーのカウンターとヒストグラムは archive.json に移す
+                        for metric_name, values in data.items():
+                            if metric_name in mergeable:
+                                mergeable[metric_name].merge(archive.setdefault(metric_name, {}), values)
+                        os.unlink(path)
+                        archived = True
+                        continue
+                    for metric_name, values in data.items():
+                        if metric_name in mergeable:
+                            mergeable[metric_name].merge(totals[metric_name], values)
+                        else:
+                            target = gauges.setdefault(metric_name, {})
+                            for key, value in values.items():
+                                target[key + (str(pid),)] = value
+                if archived:
+                    temp_path = f"{archive_path}.tmp"
+                    with open(temp_path, 'w') as f:
+                        json.dump({name: _encode(values) for name, values in archive.items()}, f)
+                    os.replace(temp_path, archive_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        for name, values in archive.items():
+            if name in mergeable:
+                mergeable[name].merge(totals[name], values)
+        return totals, gauges
+
+    def expose(self):
+        """Prometheus のテキスト形式"""
+        metrics = self._registered()
+        lines = []
+        if not self.multiprocess_dir:
+            for metric in metrics:
+                lines.extend(metric.header())
+                lines.extend(metric.collect())
+            return '\n'.join(lines) + '\n'
+
+        # 自分の値も書き出してから読むので、どのワーカーが受けても各プロセスの値は前回以上になる
+        self.flush()
+        totals, gauges = self._aggregate(metrics)
+        for metric in metrics:
+            lines.extend(metric.header())
+            if metric.name in totals:
+                lines.extend(metric.collect(totals[metric.name]))
+            else:
+                lines.extend(metric.collect(gauges.get(metric.name, {}), metric.labelnames + ('pid',)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, callback))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# --- アプリ全体で共有するメトリクス ---
+
+HTTP_REQUESTS = counter(
+    'image_syncer_http_requests_total', 'HTTPリクエスト数', ('method', 'route', 'status'))
+HTTP_DURATION = histogram(
+    'image_syncer_http_request_duration_seconds', 'HTTPリクエストの処理時間', ('method', 'route'))
+HTTP_BYTES = counter(
+    'image_syncer_http_response_bytes_total', 'レスポンス本体の送信バイト数（長さが分かるもの）', ('route',))
+
+DB_QUERY_DURATION = histogram(
+    'image_syncer_db_query_duration_seconds', 'SQL文ごとの実行時間', ('statement',))
+
+INGEST_STAGE_DURATION = histogram(
+    'image_syncer_ingest_stage_duration_seconds', '取り込み処理の段階ごとの時間', ('stage',),
+    buckets=SLOW_BUCKETS)
+SCAN_FILES = counter(
+    'image_syncer_scan_files_total', 'スキャンで処理したファイル数', ('result',))
+
+
+def timed(stage):
+    """関数の実行時間を取り込み段階 stage として記録するデコレータ（トレース中は区間も記録）"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                INGEST_STAGE_DURATION.observe(duration, stage=stage)
+                profiling.record(stage, 'ingest', started, duration)
+        return wrapper
+    return decorator
@@ -0,0 +1,304 @@
+"""番号付きスキーママイグレーション
+
+schema_version テーブルに適用済みのバージョンを記録し、未適用のものだけを番号順に実行する。
+
+既存の行をすべて読むインデックス作成（index_build=True）は、SQLite では作成が終わるまで
+書き込みロックを持ち続ける。作成中もWALモードなので読み込みはできるが、アップロードやスキャンの
+書き込みは待たされ、BUSY_TIMEOUT（30秒）を超えると失敗する。そのため配信を始める前に
+すべて適用する（gunicorn ではワーカーを起動する前にマスタープロセスで1回、開発サーバーでは
+起動時に）。作成にかかる時間の目安は、40万件のライブラリで v2〜v7 の合計が SSD 上で約3.5秒、
+HDD や Raspberry Pi などでは数十秒。
+"""
+import fcntl
+import time
+from contextlib import contextmanager
+
+import db
+
+# (version, description, func, index_build)
+MIGRATIONS = []
+
+
+def migration(version, description, index_build=False):
+    """マイグレーション関数を登録するデコレータ"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func, index_build))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+@migration(1, "初期スキーマ")
+def _initial_schema(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY,
+            original_name TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            relative_path TEXT,
+            date_folder TEXT,
+            thumbnail_path TEXT,
+            file_type TEXT NOT NULL,
+            mime_type TEXT,
+            file_size INTEGER NOT NULL,
+            file_hash TEXT,
+            taken_date TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # マイグレーション導入前のデータベースに不足しているカラムを追加
+    cursor.execute("PRAGMA table_info(files)")
+    columns = [column[1] for column in cursor.fetchall()]
+
+    if 'file_hash' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN file_hash TEXT")
+    if 'relative_path' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN relative_path TEXT")
+    if 'date_folder' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN date_folder TEXT")
+    if 'taken_date' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN taken_date TIMESTAMP")
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hash ON files(file_hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_date_folder ON files(date_folder)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_taken_date ON files(taken_date)")
+
+
+@migration(2, "file_path / relative_path インデックス", index_build=True)
+def _path_indexes(cursor):
+    # スキャン時の重複チェックとクリーンアップでのパス検索用
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_path ON files(file_path)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_relative_path ON files(relative_path)")
+
+
+@migration(3, "一覧表示用カバリングインデックス", index_build=True)
+def _listing_index(cursor):
+    # /files の ORDER BY と SELECT 列をインデックスだけで返せるようにする
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_files_listing ON files(
+            taken_date DESC, created_at DESC,
+            id, original_name, filename, file_type, file_size
+        )
+    """)
+
+
+@migration(4, "サムネイルのハッシュ列")
+def _thumbnail_hash(cursor):
+    # サムネイルURLのバージョン（?v=）に使う。ADD COLUMN は既存行を書き換えないので即座に終わる
+    cursor.execute("ALTER TABLE files ADD COLUMN thumbnail_hash TEXT")
+
+
+@migration(5, "一覧表示用カバリングインデックス（URLバージョン列を追加）", index_build=True)
+def _listing_index_with_versions(cursor):
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_files_listing_v2 ON files(
+            taken_date DESC, created_at DESC,
+            id, original_name, filename, file_type, mime_type, file_size,
+            file_hash, thumbnail_hash
+        )
+    """)
+    cursor.execute("DROP INDEX IF EXISTS idx_files_listing")
+
+
+@migration(6, "知覚ハッシュ（dHash）列")
+def _phash(cursor):
+    # 類似画像検索用。64bit を符号付き INTEGER として保存する（similarity.to_db）
+    cursor.execute("ALTER TABLE files ADD COLUMN phash INTEGER")
+
+
+@migration(7, "知覚ハッシュの部分インデックス", index_build=True)
+def _phash_index(cursor):
+    # 類似検索インデックスの件数確認と読み込みを、phash のある行だけで済ませる
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_phash ON files(phash) WHERE phash IS NOT NULL")
+
+
+@migration(8, "元ファイルの形式と表示用派生画像の形式")
+def _source_format(cursor):
+    # source_format: 取り込んだファイルの形式（heic, jpeg など）
+    # derivative: 表示時に作る派生画像の形式（jpeg / webp）。元ファイルをそのまま表示する場合は NULL
+    cursor.execute("ALTER TABLE files ADD COLUMN source_format TEXT")
+    cursor.execute("ALTER TABLE files ADD COLUMN derivative TEXT")
+
+
+@migration(9, "サムネイルのパックファイルのインデックス")
+def _thumbnail_packs(cursor):
+    # THUMBNAIL_STORE=pack のとき、ファイルIDごとのパック番号・オフセット・長さ（thumbnail_packs.py）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS thumbnail_pack_entries (
+            file_id TEXT PRIMARY KEY,
+            pack INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_thumbnail_pack_entries_pack ON thumbnail_pack_entries(pack)")
+
+
+@migration(10, "バックグラウンドジョブの状態")
+def _jobs(cursor):
+    # どのワーカーからも /jobs/<id> を参照できるようにジョブの状態を保存する（jobs.py）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT NOT NULL,
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            finished_at REAL,
+            pid INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_kind_status ON jobs(kind, status)")
+
+
+@migration(11, "ファイルの変更履歴と Live Photos の変換待ち")
+def _file_changes(cursor):
+    # 配信に使う列の変更と削除を記録し、各ワーカーのメタデータキャッシュが読んで無効化する（metadata_cache.py）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS file_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_files_changed
+        AFTER UPDATE OF file_path, mime_type, thumbnail_path, file_type,
+            file_hash, thumbnail_hash, derivative ON files
+        BEGIN
+            INSERT INTO file_changes (file_id) VALUES (OLD.id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_files_deleted AFTER DELETE ON files
+        BEGIN
+            INSERT INTO file_changes (file_id) VALUES (OLD.id);
+        END
+    """)
+    # 変換キューに入れた Live Photos 動画（ワーカーが再起動しても変換を続けるため、変換が終わるまで残す）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS live_photo_conversions (
+            file_id TEXT PRIMARY KEY,
+            source_path TEXT NOT NULL,
+            owner_pid INTEGER,
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+@migration(12, "行の削除時にサムネイルのパックのエントリを削除")
+def _pack_entry_cleanup(cursor):
+    # どの経路（一括削除・重複の整理・クリーンアップなど）で削除してもパックのエントリを残さない
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_files_deleted_pack_entry AFTER DELETE ON files
+        BEGIN
+            DELETE FROM thumbnail_pack_entries WHERE file_id = OLD.id;
+        END
+    """)
+    cursor.execute("""
+        DELETE FROM thumbnail_pack_entries
+        WHERE NOT EXISTS (SELECT 1 FROM files WHERE files.id = thumbnail_pack_entries.file_id)
+    """)
+
+
+def ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(conn):
+    """適用済みのバージョン番号の集合を返す"""
+    cursor = conn.cursor()
+    ensure_version_table(cursor)
+    cursor.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def pending_migrations(conn):
+    applied = applied_versions(conn)
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+def apply_migration(conn, version, description, func):
+    """1つのマイグレーションを1トランザクションで適用
+
+    複数のワーカープロセスが同時に起動しても二重に適用しないよう、
+    書き込みロックを取ってから適用済みかどうかを確認し直す。
+    """
+    started = time.monotonic()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+        if cursor.fetchone():
+            conn.rollback()
+            return
+        func(cursor)
+        cursor.execute(
+            "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+            (version, description)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    elapsed = time.monotonic() - started
+    print(f"[MIGRATE] v{version} {description} 適用完了 ({elapsed:.2f}秒)")
+
+
+def apply_migrations(conn):
+    """未適用のマイグレーションを番号順にすべて適用"""
+    pending = pending_migrations(conn)
+    # 新しいデータベース（v1 が未適用）では files が空なので作成はすぐに終わる
+    if pending and pending[0][0] > 1 and any(index_build for *_, index_build in pending):
+        rows = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        print(f"[MIGRATE] インデックスを作成します（{rows}件）。完了するまで書き込みは待たされます")
+    for version, description, func, _ in pending:
+        apply_migration(conn, version, description, func)
+
+
+def run_housekeeping(conn):
+    """統計情報の更新（analysis_limit で大きなテーブルでも短時間で終わる）"""
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+
+
+@contextmanager
+def migration_lock(database_path):
+    """マイグレーションをプロセス間で1つずつ行うためのファイルロック
+
+    SQLite の書き込みロック待ちは BUSY_TIMEOUT で失敗するが、こちらは前のプロセスの
+    インデックス作成が終わるまで待つ。
+    """
+    with open(f"{database_path}.migrate.lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def migrate(database_path):
+    """データベースを最新のスキーマにして統計情報を更新（配信を始める前に呼ぶ）"""
+    with migration_lock(database_path):
+        conn = db.open_connection(database_path)
+        try:
+            apply_migrations(conn)
+            try:
+                run_housekeeping(conn)
+            except Exception as e:
+                print(f"[MIGRATE] 統計情報の更新に失敗: {e}")
+        finally:
+            conn.close()
@@ -0,0 +1,233 @@
+"""リクエスト単位のプロファイルと取り込み処理のトレース
+
+どちらもログイン中の管理者がリクエストごとに明示的に有効にした場合だけ動く。
+
+- プロファイル: リクエスト全体を cProfile で計測し、PROFILES_DIR に .prof（pstats 形式）と
+  関数ごとの集計テキストを保存する。
+- トレース: 取り込み処理の各段階（ハッシュ、EXIF、ffprobe、SQL など）を区間（span）として記録し、
+  Chrome のトレース形式（chrome://tracing や Perfetto で開ける JSON）で保存する。
+
+トレースとプロファイルは有効にしたスレッドと、そこから bind_context を通してルートのI/Oワーカーなどに
+渡した処理だけを記録するので、同時に処理されている他のリクエストは混ざらない。
+"""
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILES_DIR = os.environ.get('PROFILES_DIR', 'storage/profiles')
+# 集計テキストに含める関数の数
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', '60'))
+# 1回のトレースで記録する区間の最大数（大きなスキャンでメモリを使いすぎないように）
+TRACE_MAX_EVENTS = int(os.environ.get('TRACE_MAX_EVENTS', '500000'))
+# 保存しておくレポートの最大数（古いものから削除）
+PROFILES_KEEP = int(os.environ.get('PROFILES_KEEP', '50'))
+
+REPORT_NAME_PATTERN = re.compile(r'^[0-9A-Za-z_.-]+\.(prof|txt|json)$')
+
+_local = threading.local()
+# cProfile は同時に1つしか動かせない環境があるため、プロファイルは1リクエストずつ
+_profile_lock = threading.Lock()
+
+
+class Tracer:
+    """Chrome トレース形式のイベントを集める"""
+
+    def __init__(self, name, max_events=TRACE_MAX_EVENTS):
+        self.name = name
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self.pid = os.getpid()
+
+    def add(self, name, category, started, duration, args=None):
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": started * 1e6, "dur": duration * 1e6,
+            "pid": self.pid, "tid": threading.get_ident()
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def to_json(self):
+        return json.dumps({
+            "traceEvents": self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"name": self.name, "dropped": self.dropped}
+        }, ensure_ascii=False, default=str)
+
+
+class Profile(cProfile.Profile):
+    """リクエストのプロファイル（他のスレッドで計測した分は保存時にまとめる）"""
+
+    def __init__(self):
+        super().__init__()
+        self.children = []
+        self._children_lock = threading.Lock()
+
+    def start_child(self):
+        """現在のスレッドの計測を開始（全スレッドを1つのプロファイラで計測する環境などでは None）"""
+        child = cProfile.Profile()
+        try:
+            child.enable()
+        except ValueError:
+            return None
+        return child
+
+    def stop_child(self, child):
+        child.disable()
+        with self._children_lock:
+            self.children.append(child)
+
+
+def active_tracer():
+    return getattr(_local, 'tracer', None)
+
+
+def record(name, category, started, duration, args=None):
+    """time.perf_counter() で測った区間を記録（トレース中でなければ何もしない）"""
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is not None:
+        tracer.add(name, category, started, duration, args)
+
+
+@contextmanager
+def span(name, category='ingest', **args):
+    """with ブロックを区間として記録"""
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.add(name, category, started, time.perf_counter() - started, args or None)
+
+
+def bind_context(func):
+    """現在のスレッドのトレースとプロファイルを引き継いで func を実行する関数を返す
+
+    エグゼキューターに渡す前に呼ぶ（どちらも動いていなければ func をそのまま返す）。
+    """
+    tracer = getattr(_local, 'tracer', None)
+    profiler = getattr(_local, 'profiler', None)
+    if tracer is None and profiler is None:
+        return func
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        previous = getattr(_local, 'tracer', None)
+        _local.tracer = tracer
+        child = profiler.start_child() if profiler is not None else None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if child is not None:
+                profiler.stop_child(child)
+            _local.tracer = previous
+    return run
+
+
+def start_trace(name):
+    tracer = Tracer(name)
+    _local.tracer = tracer
+    return tracer
+
+
+def stop_trace():
+    tracer = getattr(_local, 'tracer', None)
+    _local.tracer = None
+    return tracer
+
+
+def start_profile():
+    """現在のスレッドでプロファイルを開始（他のプロファイルが実行中なら None）"""
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 別のプロファイラ（デバッガなど）が動いている
+        _profile_lock.release()
+        return None
+    _local.profiler = profiler
+    return profiler
+
+
+def stop_profile(profiler):
+    profiler.disable()
+    _local.profiler = None
+    _profile_lock.release()
+
+
+def _report_base(label):
+    safe = re.sub(r'[^0-9A-Za-z]+', '_', label).strip('_')[:60] or 'request'
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}_{safe}"
+
+
+def _prune():
+    try:
+        names = sorted(os.listdir(PROFILES_DIR))
+    except FileNotFoundError:
+        return
+    for name in names[:max(0, len(names) - PROFILES_KEEP * 2)]:
+        try:
+            os.unlink(os.path.join(PROFILES_DIR, name))
+        except OSError:
+            pass
+
+
+def save_profile(profiler, label):
+    """.prof と集計テキストを保存し、テキストのファイル名を返す（他のスレッドで計測した分も含める）"""
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    base = _report_base(label)
+    text = io.StringIO()
+    text.write(f"# {label}\n")
+    stats = pstats.Stats(profiler, stream=text)
+    for child in getattr(profiler, 'children', ()):
+        stats.add(child)
+    stats.dump_stats(os.path.join(PROFILES_DIR, base + '.prof'))
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    with open(os.path.join(PROFILES_DIR, base + '.txt'), 'w', encoding='utf-8') as f:
+        f.write(text.getvalue())
+    _prune()
+    return base + '.txt'
+
+
+def save_trace(tracer):
+    """トレースを保存してファイル名を返す"""
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    name = _report_base(tracer.name) + '.json'
+    with open(os.path.join(PROFILES_DIR, name), 'w', encoding='utf-8') as f:
+        f.write(tracer.to_json())
+    _prune()
+    return name
+
+
+def report_path(name):
+    """保存したレポートのパス（不正な名前や存在しない場合は None）"""
+    if not REPORT_NAME_PATTERN.match(name):
+        return None
+    path = os.path.join(PROFILES_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def list_reports():
+    try:
+        names = os.listdir(PROFILES_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((n for n in names if REPORT_NAME_PATTERN.match(n)), reverse=True)
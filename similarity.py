@@ -0,0 +1,309 @@
+"""知覚ハッシュ（dHash）による類似画像の検索
+
+リサイズや再エクスポート、HEIC→JPEG変換したコピーは file_hash（SHA256）では
+重複として検出できないため、画像ごとに 64bit の dHash を計算して files.phash に保存する。
+
+検索にはマルチインデックスハッシング（MIH）を使う。64bit を CHUNK_COUNT 個のチャンクに分け、
+チャンクごとに値 → ハッシュ の辞書を持つ。ハミング距離が r 以下の2つのハッシュは、
+鳩の巣原理により少なくとも1つのチャンクで距離 r // CHUNK_COUNT 以下になるので、
+そのチャンク値の近傍だけを辞書で引けば全件比較せずに候補を絞り込める。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+
+import db
+import imaging
+import logs
+
+log = logs.get_logger('phash')
+
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+CHUNK_COUNT = 4
+CHUNK_BITS = HASH_BITS // CHUNK_COUNT
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# 近似重複とみなす既定のハミング距離（64bit中）
+DEFAULT_DISTANCE = 6
+# ライブラリ全体のグループ化の既定値。CHUNK_COUNT 未満ならチャンクの完全一致だけで候補が揃う
+DEFAULT_GROUP_DISTANCE = 3
+MAX_DISTANCE = 16
+
+
+def dhash(file_path):
+    """画像の dHash（64bit整数）を計算
+
+    9x8 のグレースケールに縮小し、横に隣り合う画素の明暗の大小をビットにする。
+    JPEG は draft() で縮小デコードするので、大きな写真でもフルサイズには展開しない。
+    """
+    with imaging.pil().open(file_path) as img:
+        img.draft('L', (64, 64))
+        return dhash_image(img)
+
+
+def dhash_image(img):
+    """デコード済みの PIL 画像の dHash（派生画像の作成時などに再デコードせずに計算する）"""
+    from PIL import ImageOps
+    img = ImageOps.exif_transpose(img)
+    pixels = img.convert('L').resize((9, 8), imaging.pil().Resampling.BOX).tobytes()
+
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def to_db(value):
+    """SQLite の INTEGER（符号付き64bit）に収まる形に変換"""
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+
+def from_db(value):
+    return value & HASH_MASK
+
+
+def _chunks(value):
+    return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNK_COUNT)]
+
+
+_flip_masks_cache = {}
+
+
+def _flip_masks(radius):
+    """チャンク内でビットを1〜radius 個反転させるマスクの一覧（0 は含まない）"""
+    masks = _flip_masks_cache.get(radius)
+    if masks is None:
+        masks = [
+            sum(1 << bit for bit in bits)
+            for flips in range(1, radius + 1)
+            for bits in combinations(range(CHUNK_BITS), flips)
+        ]
+        _flip_masks_cache[radius] = masks
+    return masks
+
+
+class HammingIndex:
+    """マルチインデックスハッシングによるハミング距離検索
+
+    同じハッシュを持つファイルは1つのキーにまとめ、検索はハッシュ単位で行う。
+    """
+
+    def __init__(self):
+        self._ids_by_hash = {}
+        self._hash_by_id = {}
+        self._tables = [{} for _ in range(CHUNK_COUNT)]
+
+    def __len__(self):
+        return len(self._hash_by_id)
+
+    def add(self, file_id, value):
+        if file_id in self._hash_by_id:
+            self.remove(file_id)
+        self._hash_by_id[file_id] = value
+        ids = self._ids_by_hash.get(value)
+        if ids is None:
+            ids = self._ids_by_hash[value] = set()
+            for table, chunk in zip(self._tables, _chunks(value)):
+                table.setdefault(chunk, []).append(value)
+        ids.add(file_id)
+
+    def remove(self, file_id):
+        value = self._hash_by_id.pop(file_id, None)
+        if value is None:
+            return
+        ids = self._ids_by_hash[value]
+        ids.discard(file_id)
+        if ids:
+            return
+        del self._ids_by_hash[value]
+        for table, chunk in zip(self._tables, _chunks(value)):
+            bucket = table[chunk]
+            bucket.remove(value)
+            if not bucket:
+                del table[chunk]
+
+    def get(self, file_id):
+        return self._hash_by_id.get(file_id)
+
+    def hashes_within(self, value, distance):
+        """value から距離 distance 以内のハッシュを {ハッシュ: 距離} で返す"""
+        masks = _flip_masks(distance // CHUNK_COUNT)
+        found = {}
+        for table, chunk in zip(self._tables, _chunks(value)):
+            for candidate_chunk in [chunk] + [chunk ^ mask for mask in masks]:
+                for candidate in table.get(candidate_chunk, ()):
+                    if candidate not in found:
+                        d = (value ^ candidate).bit_count()
+                        if d <= distance:
+                            found[candidate] = d
+        return found
+
+    def similar(self, file_id, distance):
+        """file_id に似たファイルを [(id, 距離), ...] で返す（距離の小さい順、自身は除く）"""
+        value = self._hash_by_id.get(file_id)
+        if value is None:
+            return []
+        results = []
+        for candidate, d in self.hashes_within(value, distance).items():
+            for other_id in self._ids_by_hash[candidate]:
+                if other_id != file_id:
+                    results.append((other_id, d))
+        results.sort(key=lambda item: (item[1], item[0]))
+        return results
+
+    def _candidate_pairs(self, distance):
+        """距離 distance 以内になりうるハッシュの組を列挙
+
+        全件を1件ずつ検索する代わりに、チャンクのバケット同士を結合する。
+        バケット内の組と、チャンク値が radius ビット以内で異なるバケット間の組だけを調べる。
+        """
+        masks = _flip_masks(distance // CHUNK_COUNT)
+        for table in self._tables:
+            for chunk, bucket in table.items():
+                for i in range(1, len(bucket)):
+                    a = bucket[i]
+                    for b in bucket[:i]:
+                        yield a, b
+                for mask in masks:
+                    other_chunk = chunk ^ mask
+                    if other_chunk < chunk:
+                        continue
+                    other = table.get(other_chunk)
+                    if other:
+                        for a in bucket:
+                            for b in other:
+                                yield a, b
+
+    def groups(self, distance):
+        """距離 distance 以内で推移的につながるファイルのグループ（2件以上のもの）"""
+        parent = {}
+
+        def find(value):
+            root = value
+            while root in parent:
+                root = parent[root]
+            while value != root:
+                parent[value], value = root, parent[value]
+            return root
+
+        for a, b in self._candidate_pairs(distance):
+            if (a ^ b).bit_count() <= distance:
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[root_b] = root_a
+
+        members = {}
+        for value, ids in self._ids_by_hash.items():
+            members.setdefault(find(value), []).extend(ids)
+        return [sorted(ids) for ids in members.values() if len(ids) > 1]
+
+
+class NearDuplicateIndex:
+    """データベースと同期する HammingIndex
+
+    初回の検索時にデータベースから全件を読み込み、以降は rowid が前回より大きい行だけを
+    差分で取り込む（他のワーカープロセスが追加した行も検索前に反映される）。
+    差分を取り込んでも件数が合わない場合（他のプロセスでの削除や既存行への phash の
+    書き込み）は全件を読み直す。件数は idx_phash の部分インデックスだけで数えられる。
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._index = HammingIndex()
+        self._last_rowid = 0
+        self._lock = threading.Lock()
+
+    def _load(self, conn):
+        cursor = conn.execute("""
+            SELECT rowid, id, phash FROM files
+            WHERE rowid > ? AND phash IS NOT NULL ORDER BY rowid
+        """, (self._last_rowid,))
+        while True:
+            rows = cursor.fetchmany(5000)
+            if not rows:
+                break
+            for rowid, file_id, value in rows:
+                self._index.add(file_id, from_db(value))
+            self._last_rowid = rows[-1][0]
+
+    def refresh(self):
+        with self._lock, self.pool.connection() as conn:
+            self._load(conn)
+            count = conn.execute(db.SQL_COUNT_PHASHES).fetchone()[0]
+            if count != len(self._index):
+                self._index = HammingIndex()
+                self._last_rowid = 0
+                self._load(conn)
+
+    def add(self, file_id, value):
+        """このプロセスで追加した行を即座に反映（rowid の差分取り込みでも重複しない）"""
+        with self._lock:
+            self._index.add(file_id, value)
+
+    def remove(self, file_ids):
+        with self._lock:
+            for file_id in file_ids:
+                self._index.remove(file_id)
+
+    def get(self, file_id):
+        with self._lock:
+            return self._index.get(file_id)
+
+    def similar(self, file_id, distance=DEFAULT_DISTANCE):
+        self.refresh()
+        with self._lock:
+            return self._index.similar(file_id, distance)
+
+    def groups(self, distance=DEFAULT_DISTANCE):
+        self.refresh()
+        with self._lock:
+            return self._index.groups(distance)
+
+    def stats(self):
+        with self._lock:
+            return {"indexed": len(self._index), "last_rowid": self._last_rowid}
+
+
+def backfill(job, pool, index, workers=4, chunk_size=500):
+    """phash が未計算の画像について計算して保存する（ジョブとして実行）"""
+    def compute(row):
+        file_id, file_path = row
+        try:
+            return file_id, dhash(file_path)
+        except Exception as e:
+            log.warning("phash failed", extra={"file_id": file_id, "path": file_path, "error": str(e)})
+            return file_id, None
+
+    computed = failed = 0
+    last_id = ''
+    with pool.connection() as conn, ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='phash'
+    ) as executor:
+        total = conn.execute(
+            "SELECT COUNT(*) FROM files WHERE file_type = 'image' AND phash IS NULL"
+        ).fetchone()[0]
+        job.update(total=total, computed=0, failed=0)
+        while True:
+            rows = conn.execute("""
+                SELECT id, file_path FROM files
+                WHERE file_type = 'image' AND phash IS NULL AND id > ?
+                ORDER BY id LIMIT ?
+            """, (last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            results = list(executor.map(compute, rows))
+            done = [(to_db(value), file_id) for file_id, value in results if value is not None]
+            conn.executemany("UPDATE files SET phash = ? WHERE id = ?", done)
+            conn.commit()
+            for value, file_id in done:
+                index.add(file_id, from_db(value))
+            computed += len(done)
+            failed += len(results) - len(done)
+            job.update(computed=computed, failed=failed)
+
+    log.info("phash backfill finished", extra={"computed": computed, "failed": failed})
+    return {"computed": computed, "failed": failed}
@@ -418,7 +418,7 @@ class PhotoApp {
         
         photoItem.innerHTML = `
             ${isVideo ? 
-                `<img data-src="/thumbnails/${file.id}" 
+                `<img data-src="${file.thumbnail_url || `/thumbnails/${file.id}`}" 
                       alt="${file.original_name}"
                       loading="lazy"
                       onerror="this.src='/static/icon-192.png'">
@@ -428,7 +428,7 @@ class PhotoApp {
                     </svg>
                     動画
                 </div>` :
-                `<img data-src="/thumbnails/${file.id}" 
+                `<img data-src="${file.thumbnail_url || `/thumbnails/${file.id}`}" 
                       alt="${file.original_name}"
                       loading="lazy"
                       onerror="this.src='/static/icon-192.png'">`
@@ -615,12 +615,19 @@ class PhotoApp {
                                 file.original_name.includes('Live') ||
                                 file.mime_type === 'video/quicktime';
             
+            // 大きな動画はHLS（回線に合わせて画質が切り替わる）を優先し、
+            // 対象外や非対応の場合は次の<source>（元ファイル）にフォールバック
+            const hlsSource = file.hls_url && this.supportsNativeHls()
+                ? `<source src="${file.hls_url}" type="application/vnd.apple.mpegurl">`
+                : '';
+            
             this.viewerContent.innerHTML = `
                 <video controls muted playsinline preload="metadata" 
                        ${isShortVideo ? 'loop' : ''} 
                        style="max-width: 100%; max-height: 100%;">
-                    <source src="/files/${file.id}" type="${file.mime_type || 'video/mp4'}">
-                    <source src="/files/${file.id}" type="video/mp4">
+                    ${hlsSource}
+                    <source src="${this.fileUrl(file)}" type="${file.mime_type || 'video/mp4'}">
+                    <source src="${this.fileUrl(file)}" type="video/mp4">
                     <p>お使いのブラウザは動画再生をサポートしていません。</p>
                 </video>`;
             
@@ -648,7 +655,7 @@ class PhotoApp {
                 });
             }
         } else {
-            this.viewerContent.innerHTML = `<img src="/files/${file.id}" alt="${file.original_name}" loading="eager">`;
+            this.viewerContent.innerHTML = `<img src="${this.fileUrl(file)}" alt="${file.original_name}" loading="eager">`;
         }
     }
     
@@ -684,7 +691,7 @@ class PhotoApp {
         
         if (navigator.share) {
             try {
-                const response = await fetch(`/files/${file.id}`);
+                const response = await fetch(this.fileUrl(file));
                 const blob = await response.blob();
                 const shareFile = new File([blob], file.original_name, { type: file.mime_type });
                 
@@ -726,22 +733,25 @@ class PhotoApp {
         }
     }
     
-    // 選択されたファイルをダウンロード
+    // 選択されたファイルをダウンロード（サーバー側でZIPにまとめて1回の転送で取得）
     async downloadSelectedFiles() {
         if (this.selectedFiles.size === 0) return;
         
-        for (const fileId of this.selectedFiles) {
-            const file = this.files.find(f => f.id === fileId);
-            if (file) {
-                // ファイルをダウンロード
-                const link = document.createElement('a');
-                link.href = `/files/${file.id}`;
-                link.download = file.original_name;
-                document.body.appendChild(link);
-                link.click();
-                document.body.removeChild(link);
-            }
-        }
+        // フォーム送信にするとブラウザのダウンロード機能でそのままストリーミング保存される
+        const form = document.createElement('form');
+        form.method = 'POST';
+        form.action = '/download';
+        form.style.display = 'none';
+        
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'ids';
+        input.value = Array.from(this.selectedFiles).join(',');
+        form.appendChild(input);
+        
+        document.body.appendChild(form);
+        form.submit();
+        document.body.removeChild(form);
         
         this.showMessage(`${this.selectedFiles.size}個のファイルをダウンロードしました`);
     }
@@ -753,11 +763,19 @@ class PhotoApp {
         if (!confirm(`選択した${this.selectedFiles.size}個のファイルを削除しますか？`)) return;
         
         try {
-            const deletePromises = Array.from(this.selectedFiles).map(fileId => 
-                fetch(`/files/${fileId}`, { method: 'DELETE' })
-            );
+            // 1回のリクエストでまとめて削除
+            const response = await fetch('/files/batch-delete', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ ids: Array.from(this.selectedFiles) })
+            });
             
-            await Promise.all(deletePromises);
+            if (!response.ok) {
+                const result = await response.json();
+                throw new Error(result.error || `HTTP error! status: ${response.status}`);
+            }
             
             this.selectedFiles.clear();
             this.toggleSelectionMode(); // 選択モードを終了
@@ -798,6 +816,21 @@ class PhotoApp {
     }
     
     // ユーティリティ関数
+    
+    // バージョン付きURL（内容が変わらない限りブラウザキャッシュから再検証なしで表示される）
+    fileUrl(file) {
+        return file.url || `/files/${file.id}`;
+    }
+    
+    // ブラウザがHLSを直接再生できるか（Safari、iOS、Android の Chrome など）
+    supportsNativeHls() {
+        if (this._nativeHls === undefined) {
+            const video = document.createElement('video');
+            this._nativeHls = video.canPlayType('application/vnd.apple.mpegurl') !== '';
+        }
+        return this._nativeHls;
+    }
+    
     formatFileSize(bytes) {
         if (bytes === 0) return '0 Bytes';
         const k = 1024;
@@ -0,0 +1,272 @@
+"""複数のライブラリのルート（ディスク）とルートごとのI/Oキュー
+
+写真が複数のディスクに分かれている場合は STORAGE_ROOTS に「名前=パス」をカンマ区切りで指定する。
+
+    STORAGE_ROOTS=disk1=/mnt/disk1/photos,disk2=/mnt/disk2/photos,disk3=/mnt/disk3/photos
+
+未設定なら EXTERNAL_STORAGE_PATH（既定は storage）の1つだけを main として使う。
+
+各ルートには専用のI/Oキューとワーカー（既定は1スレッド）がある。スキャン、ファイルの削除、
+ホット層へのコピーなど、ディスクを読み書きするバックグラウンド処理はすべてそのルートのキューで
+実行するので、1台のディスクには1本の順次読み込みだけが走り、別のディスクの処理は並行して進む。
+キューでは短い処理（削除やコピー）をスキャンより先に取り出し、実行中のスキャンもファイルごとに
+run_pending() で積まれた短い処理を先に実行するので、長いスキャンの間も削除やコピーは待たされない。
+
+新しいアップロードの保存先は UPLOAD_ROOT で決める。
+- ルート名: そのルート（空き容量が UPLOAD_MIN_FREE_BYTES 未満なら次のルート）
+- most_free: 空き容量が最も大きいルート
+- round_robin: 空き容量のあるルートに順番に
+- 未設定: 先頭のルート
+"""
+import itertools
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from pathlib import Path
+
+import profiling
+
+STORAGE_ROOTS = os.environ.get('STORAGE_ROOTS', '')
+EXTERNAL_STORAGE_PATH = os.environ.get('EXTERNAL_STORAGE_PATH', 'storage')
+# ルートごとのI/Oワーカーのスレッド数（回転するディスクでは1が最も速い）
+ROOT_IO_WORKERS = int(os.environ.get('ROOT_IO_WORKERS', '1'))
+UPLOAD_ROOT = os.environ.get('UPLOAD_ROOT', '').strip()
+UPLOAD_MIN_FREE_BYTES = int(os.environ.get('UPLOAD_MIN_FREE_BYTES', str(1024 ** 3)))
+
+# ルートの file_path の範囲（'<ルート>/' 以上 '<ルート>0' 未満、'0' は '/' の次の文字）で数える
+SQL_ROOT_USAGE = """
+    SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM files
+    WHERE file_path >= ? AND file_path < ?
+"""
+
+
+def parse_roots(value, default_path=EXTERNAL_STORAGE_PATH):
+    """'名前=パス,...' を [(名前, パス), ...] に変換（名前を省略した場合は rootN）"""
+    roots = []
+    for index, item in enumerate(value.split(','), 1):
+        item = item.strip()
+        if not item:
+            continue
+        name, path = item.split('=', 1) if '=' in item else (f"root{index}", item)
+        roots.append((name.strip(), path.strip()))
+    return roots or [('main', default_path)]
+
+
+class IOQueue:
+    """1台のディスクの処理を直列に実行するキュー（短い処理をスキャンなどの長い処理より優先）"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._short = deque()
+        self._long = deque()
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """短い処理（削除、コピーなど）を積む"""
+        return self._put(self._short, func, args, kwargs)
+
+    def submit_long(self, func, *args, **kwargs):
+        """長い処理（スキャン）を積む。処理の途中で run_pending() を呼ぶこと"""
+        return self._put(self._long, func, args, kwargs)
+
+    def _put(self, items, func, args, kwargs):
+        future = Future()
+        with self._cond:
+            # ワーカーは最初の処理を積んだときに起動する
+            if not self._threads:
+                for index in range(self.workers):
+                    thread = threading.Thread(target=self._worker, name=f"io-{self.name}_{index}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            items.append((future, func, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._short and not self._long:
+                    self._cond.wait()
+                item = (self._short or self._long).popleft()
+            self._run(item)
+
+    def run_pending(self):
+        """積まれている短い処理を呼び出し元のスレッドで実行する（長い処理の区切りごとに呼ぶ）"""
+        while True:
+            with self._cond:
+                if not self._short:
+                    return
+                item = self._short.popleft()
+            self._run(item)
+
+    @staticmethod
+    def _run(item):
+        future, func, args, kwargs = item
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def queued(self):
+        return len(self._short)
+
+    def long_queued(self):
+        return len(self._long)
+
+
+class StorageRoot:
+    """1つのルートとそのI/Oキュー"""
+
+    def __init__(self, name, path, workers=ROOT_IO_WORKERS):
+        self.name = name
+        self.path = Path(path)
+        self.prefix = os.path.abspath(path).rstrip(os.sep) + os.sep
+        # データベースの file_path はルートの設定どおりのパス（相対パスの場合もある）で始まる
+        self.db_prefix = str(self.path).rstrip(os.sep) + os.sep
+        self.io_queue = IOQueue(name, workers)
+        self._lock = threading.Lock()
+        self.last_scan = None
+        self.uploads = 0
+
+    def submit(self, func, *args, **kwargs):
+        # トレース・プロファイル中のリクエストから渡された処理はワーカーでも計測を続ける
+        return self.io_queue.submit(profiling.bind_context(func), *args, **kwargs)
+
+    def submit_scan(self, func, *args, **kwargs):
+        """スキャンを同じキューで実行（func はファイルごとに run_pending() を呼ぶ）"""
+        return self.io_queue.submit_long(profiling.bind_context(func), *args, **kwargs)
+
+    def run_pending(self):
+        """スキャンの途中で、積まれている削除やコピーを先に実行する"""
+        self.io_queue.run_pending()
+
+    def queued(self):
+        return self.io_queue.queued()
+
+    def scans_queued(self):
+        return self.io_queue.long_queued()
+
+    def contains(self, path):
+        return os.path.abspath(path).startswith(self.prefix)
+
+    def free_bytes(self):
+        try:
+            return shutil.disk_usage(self.path).free
+        except OSError:
+            return 0
+
+    def record_scan(self, scanned, added, seconds, error=None):
+        with self._lock:
+            self.last_scan = {
+                "scanned": scanned,
+                "added": added,
+                "seconds": round(seconds, 3),
+                "finished_at": time.time(),
+                "error": error
+            }
+
+    def stats(self, conn):
+        files, size = conn.execute(
+            SQL_ROOT_USAGE, (self.db_prefix, self.db_prefix[:-1] + chr(ord(os.sep) + 1))
+        ).fetchone()
+        try:
+            usage = shutil.disk_usage(self.path)
+            disk = {"total_bytes": usage.total, "free_bytes": usage.free}
+        except OSError:
+            disk = {"total_bytes": None, "free_bytes": None}
+        with self._lock:
+            return dict({
+                "name": self.name,
+                "path": str(self.path),
+                "files": files,
+                "bytes": size,
+                "queued": self.queued(),
+                "scans_queued": self.scans_queued(),
+                "uploads": self.uploads,
+                "last_scan": self.last_scan
+            }, **disk)
+
+
+class StorageRoots:
+    """設定されたすべてのルート"""
+
+    def __init__(self, spec=None, upload_root=UPLOAD_ROOT, min_free=UPLOAD_MIN_FREE_BYTES,
+                 workers=ROOT_IO_WORKERS):
+        self.roots = [StorageRoot(name, path, workers) for name, path in (spec or parse_roots(STORAGE_ROOTS))]
+        names = [root.name for root in self.roots]
+        if len(set(names)) != len(names):
+            raise ValueError(f"STORAGE_ROOTS のルート名が重複しています: {names}")
+        self.upload_root = upload_root
+        self.min_free = min_free
+        self._round_robin = itertools.count()
+        self._lock = threading.Lock()
+        # 長いパスから照合する（入れ子のルートでは内側を優先）
+        self._by_prefix = sorted(self.roots, key=lambda root: len(root.prefix), reverse=True)
+
+    def __iter__(self):
+        return iter(self.roots)
+
+    def __len__(self):
+        return len(self.roots)
+
+    @property
+    def primary(self):
+        return self.roots[0]
+
+    def get(self, name):
+        return next((root for root in self.roots if root.name == name), None)
+
+    def for_path(self, path):
+        """パスを含むルート（どのルートにも含まれなければ None、ディスクにはアクセスしない）"""
+        for root in self._by_prefix:
+            if root.contains(path):
+                return root
+        return None
+
+    def relative_path(self, path):
+        """ルートからの相対パス（どのルートにも含まれなければ None）"""
+        root = self.for_path(path)
+        return os.path.relpath(os.path.abspath(path), root.prefix) if root else None
+
+    def submit(self, path, func, *args, fallback=None, **kwargs):
+        """path のあるルートのキューで func を実行（ルート外なら fallback のエグゼキューター）"""
+        root = self.for_path(path)
+        if root is not None:
+            return root.submit(func, *args, **kwargs)
+        if fallback is not None:
+            return fallback.submit(profiling.bind_context(func), *args, **kwargs)
+        return self.primary.submit(func, *args, **kwargs)
+
+    def choose_upload_root(self):
+        """新しいアップロードを保存するルート"""
+        roots = self.roots
+        if self.upload_root == 'most_free':
+            root = max(roots, key=lambda r: r.free_bytes())
+        elif self.upload_root == 'round_robin':
+            with self._lock:
+                start = next(self._round_robin) % len(roots)
+            candidates = roots[start:] + roots[:start]
+            root = next((r for r in candidates if r.free_bytes() >= self.min_free), candidates[0])
+        else:
+            preferred = self.get(self.upload_root) or self.primary
+            # 空きがなければ設定順で次のルート
+            ordered = roots[roots.index(preferred):] + roots[:roots.index(preferred)]
+            root = next((r for r in ordered if r.free_bytes() >= self.min_free), preferred)
+        with root._lock:
+            root.uploads += 1
+        return root
+
+    def stats(self, conn):
+        return {
+            "upload_root": self.upload_root or self.primary.name,
+            "roots": [root.stats(conn) for root in self.roots]
+        }
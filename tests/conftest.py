@@ -0,0 +1,80 @@
+"""テスト共通の設定
+
+app モジュールは読み込み時に環境変数を読み、カレントディレクトリにデータベースや storage を作るので、
+一時ディレクトリに移動して環境変数を設定してから読み込む。設定はテスト全体で共通
+（ルートは disk1・disk2 の2つ、サムネイルはパック方式）。
+"""
+import http.cookiejar
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+from werkzeug.serving import make_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    work = tmp_path_factory.mktemp('app')
+    os.chdir(work)
+    os.environ.update({
+        'STORAGE_ROOTS': f"disk1={work / 'disk1'},disk2={work / 'disk2'}",
+        'THUMBNAILS_DIR': str(work / 'thumbnails'),
+        'THUMBNAIL_STORE': 'pack',
+        'PROFILES_DIR': str(work / 'profiles'),
+        'METRICS_DIR': '',
+        'ADMIN_USERNAME': 'admin',
+        'ADMIN_PASSWORD': 'password',
+    })
+    import app
+    app.create_app()
+    return app
+
+
+class HttpClient:
+    """ログイン済みのセッションで実際の HTTP サーバーにリクエストする"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, method, path, data=None, headers=None):
+        """(ステータス, ヘッダー, 本体) を返す（エラーのステータスも例外にしない）"""
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {}, method=method)
+        try:
+            with self.opener.open(req) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def get(self, path, headers=None):
+        return self.request('GET', path, headers=headers)
+
+    def post(self, path, data=b'', headers=None):
+        return self.request('POST', path, data=data, headers=headers)
+
+
+@pytest.fixture(scope='session')
+def server(app_module):
+    """werkzeug の開発サーバー（WSGI のレスポンスの型を検査する）で app を起動"""
+    httpd = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture
+def client(server):
+    client = HttpClient(server)
+    status, _, _ = client.post('/login', data=b'username=admin&password=password',
+                               headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    assert status == 200
+    return client
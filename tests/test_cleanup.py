@@ -0,0 +1,58 @@
+"""クリーンアップの孤立サムネイルの検出とサムネイルの移行"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jobs import Job
+
+
+def find_thumbnail_orphans(app_module, thumbnails_dir, thumbnails_busy=None):
+    import cleanup
+    with app_module.db_pool.connection() as conn, ThreadPoolExecutor(max_workers=2) as executor:
+        return cleanup.find_orphans(
+            Job('cleanup'), conn, executor, [], str(thumbnails_dir), set(),
+            delete_orphan_thumbnails=True, thumbnails_busy=thumbnails_busy
+        )['thumbnails']
+
+
+def old_file(path):
+    path.write_bytes(b'jpg')
+    stale = time.time() - 3600
+    os.utime(path, (stale, stale))
+    return path
+
+
+def test_recently_moved_thumbnail_is_not_an_orphan(app_module, tmp_path):
+    thumbnails_dir = tmp_path / 'thumbnails'
+    (thumbnails_dir / 'ab').mkdir(parents=True)
+    source = old_file(tmp_path / 'moved.jpg')
+    # 移行と同じく移動（mtime は古いまま、行の更新はまだ）
+    moved = thumbnails_dir / 'ab' / 'moved.jpg'
+    os.replace(source, moved)
+
+    result = find_thumbnail_orphans(app_module, thumbnails_dir)
+
+    assert result['count'] == 0
+    assert moved.exists()
+
+
+def test_thumbnail_orphans_are_left_alone_during_a_migration(app_module, tmp_path, monkeypatch):
+    import cleanup
+    # 作ったばかりのファイル（ctime が新しい）も孤立扱いできるようにする
+    monkeypatch.setattr(cleanup, 'ORPHAN_MIN_AGE', -60)
+    thumbnails_dir = tmp_path / 'thumbnails'
+    thumbnails_dir.mkdir()
+    orphan = old_file(thumbnails_dir / 'orphan.jpg')
+    migrating = lambda: app_module.job_manager.is_running(app_module.THUMBNAIL_MIGRATION_JOB)
+
+    lock = app_module.job_manager._try_lock(app_module.THUMBNAIL_MIGRATION_JOB)
+    try:
+        result = find_thumbnail_orphans(app_module, thumbnails_dir, migrating)
+    finally:
+        lock.close()
+    assert result['skipped'] == 'thumbnail_migration'
+    assert orphan.exists()
+
+    result = find_thumbnail_orphans(app_module, thumbnails_dir, migrating)
+    assert result['deleted'] == 1
+    assert not orphan.exists()
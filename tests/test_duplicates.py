@@ -0,0 +1,69 @@
+"""重複ファイルの整理"""
+import os
+import uuid
+
+import pytest
+
+from jobs import Job
+
+
+def add_row(app_module, file_hash, file_path, created_at):
+    file_id = str(uuid.uuid4())
+    with app_module.db_pool.connection() as conn:
+        conn.execute("""
+            INSERT INTO files (id, original_name, filename, file_path, file_type, mime_type,
+                file_size, file_hash, created_at)
+            VALUES (?, ?, ?, ?, 'image', 'image/jpeg', 4, ?, ?)
+        """, (file_id, os.path.basename(file_path), os.path.basename(file_path),
+              str(file_path), file_hash, created_at))
+        conn.commit()
+    return file_id
+
+
+def remaining(app_module, file_hash):
+    with app_module.db_pool.connection() as conn:
+        return {row[0] for row in conn.execute("SELECT id FROM files WHERE file_hash = ?", (file_hash,))}
+
+
+def reclaim(app_module, file_hash, keep='oldest'):
+    import duplicates
+    return duplicates.reclaim(Job('dedupe'), app_module.db_pool, keep=keep, hashes=[file_hash],
+                              on_removed=app_module.forget_files, unlink=app_module.unlink_quietly)
+
+
+@pytest.mark.parametrize('keep', ['oldest', 'newest'])
+def test_reclaim_keeps_an_existing_file_when_the_oldest_row_is_stale(app_module, tmp_path, keep):
+    file_hash = uuid.uuid4().hex
+    first, second = tmp_path / 'first.jpg', tmp_path / 'second.jpg'
+    first.write_bytes(b'same')
+    second.write_bytes(b'same')
+    stale = add_row(app_module, file_hash, tmp_path / 'moved-away.jpg', '2020-01-01 00:00:00')
+    first_id = add_row(app_module, file_hash, first, '2021-01-01 00:00:00')
+    second_id = add_row(app_module, file_hash, second, '2022-01-01 00:00:00')
+    newest_stale = add_row(app_module, file_hash, tmp_path / 'gone.jpg', '2023-01-01 00:00:00')
+
+    result = reclaim(app_module, file_hash, keep)
+
+    kept_id, kept_path, removed_path = (
+        (first_id, first, second) if keep == 'oldest' else (second_id, second, first)
+    )
+    assert result['results'][0]['kept'] == kept_id
+    assert remaining(app_module, file_hash) == {kept_id}
+    assert kept_path.exists()
+    assert not removed_path.exists()
+    # 存在しないファイルの分は解放量に数えない
+    assert result['reclaimed_bytes'] == 4
+    assert {stale, newest_stale} <= set(result['results'][0]['deleted'])
+
+
+def test_reclaim_skips_a_group_without_any_existing_file(app_module, tmp_path):
+    file_hash = uuid.uuid4().hex
+    ids = {add_row(app_module, file_hash, tmp_path / f'missing-{i}.jpg', f'202{i}-01-01 00:00:00')
+           for i in range(2)}
+
+    result = reclaim(app_module, file_hash)
+
+    assert result['removed'] == 0
+    assert result['skipped_groups'] == 1
+    assert result['results'][0]['skipped'] == 'missing_files'
+    assert remaining(app_module, file_hash) == ids
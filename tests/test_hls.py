@@ -0,0 +1,47 @@
+"""HLS の生成ロックと生成中のプレイリストの応答"""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def packager(app_module, tmp_path, monkeypatch):
+    import hls
+    packager = hls.HlsPackager(cache_dir=str(tmp_path / 'hls'))
+    monkeypatch.setattr(app_module, 'hls_packager', packager)
+    return packager
+
+
+def test_generation_lock_is_held_until_the_encode_finishes(packager):
+    import hls
+    directory = packager.directory('ab' * 32)
+    lock = packager._acquire(directory)
+    assert lock is not None
+    # 別のプロセス（別のパッケージャー）は何時間経っても生成を始めない
+    other = hls.HlsPackager(cache_dir=packager.cache_dir)
+    assert other._acquire(directory) is None
+    assert other.is_generating(hls.cache_key('ab' * 32))
+
+    lock.close()
+    assert not other.is_generating(hls.cache_key('ab' * 32))
+    second = other._acquire(directory)
+    assert second is not None
+    second.close()
+
+
+def test_missing_playlist_is_503_while_generating_without_waiting(packager, client):
+    import hls
+    key = hls.cache_key('cd' * 32)
+
+    status, _, _ = client.get(f'/hls/{key}/0/index.m3u8')
+    assert status == 404
+
+    lock = packager._acquire(packager.directory('cd' * 32))
+    try:
+        started = time.monotonic()
+        status, headers, _ = client.get(f'/hls/{key}/0/index.m3u8')
+        assert time.monotonic() - started < 1
+    finally:
+        lock.close()
+    assert status == 503
+    assert headers['Retry-After'] == str(hls.PLAYLIST_RETRY_AFTER)
@@ -0,0 +1,121 @@
+"""一覧用のメモリ上のインデックスとデータベースの問い合わせの一致"""
+import random
+import uuid
+
+import pytest
+
+FILE_TYPES = ('image', 'video')
+
+
+@pytest.fixture
+def database(app_module, tmp_path):
+    import db
+    import migrations
+    path = str(tmp_path / 'index.db')
+    migrations.migrate(path)
+    conn = db.open_connection(path)
+    yield path, conn
+    conn.close()
+
+
+def random_date(rng):
+    if rng.random() < 0.1:
+        return None
+    # 同じ日時の行も作って並び順の同点を確かめる
+    value = f"20{rng.randint(20, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 3):02d} 12:00:{rng.randint(0, 2):02d}"
+    if rng.random() < 0.2:
+        value += f".{rng.randint(0, 999999):06d}"
+    return value
+
+
+def insert_rows(conn, rng, count, file_id=None):
+    ids = []
+    for _ in range(count):
+        ids.append(file_id or str(uuid.UUID(int=rng.getrandbits(128))))
+        conn.execute("""
+            INSERT INTO files (id, original_name, filename, file_path, file_type, mime_type,
+                file_size, taken_date, created_at)
+            VALUES (?, 'x', 'x', ?, ?, 'image/jpeg', 1, ?, ?)
+        """, (ids[-1], f"/photos/{ids[-1]}", rng.choice(FILE_TYPES), random_date(rng),
+              random_date(rng) or '2024-06-01 00:00:00'))
+    conn.commit()
+    return ids
+
+
+def assert_matches_database(index, conn):
+    import db
+    index.refresh()
+    for file_type in (None,) + FILE_TYPES:
+        if file_type:
+            total = conn.execute(db.SQL_COUNT_FILES_BY_TYPE, (file_type,)).fetchone()[0]
+            listed = [row[0] for row in conn.execute(db.SQL_LIST_FILES_BY_TYPE, (file_type, -1, 0))]
+            where, params = "WHERE file_type = ?", (file_type,)
+        else:
+            total = conn.execute(db.SQL_COUNT_FILES).fetchone()[0]
+            listed = [row[0] for row in conn.execute(db.SQL_LIST_FILES, (-1, 0))]
+            where, params = "", ()
+        assert index.page(0, len(listed) + 1, file_type) == (total, listed)
+        assert index.page(7, 5, file_type) == (total, listed[7:12])
+        assert index.timeline(file_type) == conn.execute(db.SQL_TIMELINE.format(where=where), params).fetchall()
+
+
+def test_index_follows_inserts_deletes_and_updates_without_reloading(database):
+    from library_index import LibraryIndex
+    path, conn = database
+    rng = random.Random(46)
+    ids = insert_rows(conn, rng, 300)
+    index = LibraryIndex(path)
+    assert_matches_database(index, conn)
+
+    ids += insert_rows(conn, rng, 150)
+    assert_matches_database(index, conn)
+
+    conn.executemany("DELETE FROM files WHERE id = ?", [(file_id,) for file_id in rng.sample(ids, 80)])
+    conn.commit()
+    assert_matches_database(index, conn)
+
+    conn.execute("UPDATE files SET file_type = 'video' WHERE file_type = 'image' AND rowid % 7 = 0")
+    conn.commit()
+    assert_matches_database(index, conn)
+    assert index.reloads == 1
+
+
+def test_index_picks_up_reused_rowids(database):
+    from library_index import LibraryIndex
+    path, conn = database
+    rng = random.Random(7)
+    ids = insert_rows(conn, rng, 20)
+    index = LibraryIndex(path)
+    assert_matches_database(index, conn)
+    last_rowid = index.stats()['last_rowid']
+
+    # 末尾の行を削除して追加すると同じ rowid が使われる
+    conn.execute("DELETE FROM files WHERE id = ?", (ids[-1],))
+    conn.commit()
+    insert_rows(conn, rng, 1)
+    assert conn.execute("SELECT MAX(rowid) FROM files").fetchone()[0] == last_rowid
+    assert_matches_database(index, conn)
+
+    # このプロセスでの削除（remove）の後も同じ
+    newest = conn.execute("SELECT id FROM files WHERE rowid = ?", (last_rowid,)).fetchone()[0]
+    conn.execute("DELETE FROM files WHERE id = ?", (newest,))
+    conn.commit()
+    index.remove([newest])
+    insert_rows(conn, rng, 1)
+    assert_matches_database(index, conn)
+    assert index.reloads == 1
+
+
+def test_index_reloads_when_changes_were_trimmed(database):
+    from library_index import LibraryIndex
+    path, conn = database
+    rng = random.Random(3)
+    ids = insert_rows(conn, rng, 30)
+    index = LibraryIndex(path)
+    assert_matches_database(index, conn)
+
+    conn.executemany("DELETE FROM files WHERE id = ?", [(file_id,) for file_id in ids[:5]])
+    conn.execute("DELETE FROM file_changes")
+    conn.commit()
+    assert_matches_database(index, conn)
+    assert index.reloads == 2
@@ -0,0 +1,74 @@
+"""メタデータキャッシュと他のプロセスの変更の取り込み"""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def database(app_module, tmp_path):
+    import db
+    import migrations
+    path = str(tmp_path / 'cache.db')
+    migrations.migrate(path)
+    conn = db.open_connection(path)
+    conn.execute("""
+        INSERT INTO files (id, original_name, filename, file_path, file_type, mime_type, file_size)
+        VALUES ('a', 'a.mov', 'a.mov', '/photos/a.mov', 'video', 'video/quicktime', 1)
+    """)
+    conn.commit()
+    yield path, conn
+    conn.close()
+
+
+def loader_for(conn, calls):
+    from metadata_cache import FileMeta
+
+    def load(file_id):
+        calls.append(file_id)
+        row = conn.execute(
+            "SELECT file_path, original_name, mime_type, thumbnail_path, file_type FROM files WHERE id = ?",
+            (file_id,)
+        ).fetchone()
+        return FileMeta(*row) if row else None
+    return load
+
+
+def rename(conn, path):
+    conn.execute("UPDATE files SET file_path = ? WHERE id = 'a'", (path,))
+    conn.commit()
+
+
+def test_lookups_do_not_sync_and_sync_invalidates_changed_rows(database):
+    from metadata_cache import MetadataCache
+    path, writer = database
+    calls = []
+    cache = MetadataCache(100, path)
+    cache.sync()
+    load = loader_for(writer, calls)
+
+    assert cache.get_or_load('a', load).file_path == '/photos/a.mov'
+    rename(writer, '/photos/a.mp4')
+    # 取り込むまではキャッシュから返す（リクエストのスレッドはデータベースを見ない）
+    assert cache.get_or_load('a', load).file_path == '/photos/a.mov'
+    assert calls == ['a']
+
+    cache.sync()
+    assert cache.get_or_load('a', load).file_path == '/photos/a.mp4'
+    assert cache.stats()['synced_changes'] == 1
+
+
+def test_background_sync_picks_up_changes(database):
+    from metadata_cache import MetadataCache
+    path, writer = database
+    cache = MetadataCache(100, path)
+    load = loader_for(writer, [])
+    cache.start_sync(interval=0.01)
+    try:
+        assert cache.get_or_load('a', load).file_path == '/photos/a.mov'
+        rename(writer, '/photos/a.mp4')
+        deadline = time.monotonic() + 2
+        while cache.get('a') is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.get_or_load('a', load).file_path == '/photos/a.mp4'
+    finally:
+        cache.stop_sync()
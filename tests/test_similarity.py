@@ -0,0 +1,95 @@
+"""マルチインデックスハッシングの検索と総当たりのハミング距離の一致"""
+import random
+
+import pytest
+
+
+def flip(rng, value, bits):
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture
+def hashes(app_module):
+    """{id: ハッシュ}。ランダムなハッシュに加え、0〜MAX_DISTANCE ビットずつ違う近傍と同じハッシュを含める"""
+    import similarity
+    rng = random.Random(35)
+    values = {}
+    for seed_index in range(12):
+        seed = rng.getrandbits(64)
+        values[f"seed{seed_index}"] = seed
+        values[f"seed{seed_index}-copy"] = seed
+        for bits in range(similarity.MAX_DISTANCE + 2):
+            values[f"seed{seed_index}-{bits}"] = flip(rng, seed, bits)
+    for i in range(150):
+        values[f"random{i}"] = rng.getrandbits(64)
+    return values
+
+
+def brute_force_similar(values, file_id, distance):
+    value = values[file_id]
+    results = [
+        (other_id, (value ^ other).bit_count())
+        for other_id, other in values.items() if other_id != file_id
+    ]
+    return sorted((item for item in results if item[1] <= distance), key=lambda item: (item[1], item[0]))
+
+
+def brute_force_groups(values, distance):
+    parent = {file_id: file_id for file_id in values}
+
+    def find(file_id):
+        while parent[file_id] != file_id:
+            file_id = parent[file_id]
+        return file_id
+
+    ids = list(values)
+    for i, a in enumerate(ids):
+        for b in ids[:i]:
+            if (values[a] ^ values[b]).bit_count() <= distance:
+                parent[find(b)] = find(a)
+    members = {}
+    for file_id in ids:
+        members.setdefault(find(file_id), []).append(file_id)
+    return sorted(sorted(group) for group in members.values() if len(group) > 1)
+
+
+def test_similar_matches_brute_force_for_every_distance(hashes):
+    import similarity
+    index = similarity.HammingIndex()
+    for file_id, value in hashes.items():
+        index.add(file_id, value)
+    queries = [file_id for file_id in hashes if file_id.startswith('seed')][::3] + ['random0', 'random1']
+
+    for distance in range(similarity.MAX_DISTANCE + 1):
+        for file_id in queries:
+            assert index.similar(file_id, distance) == brute_force_similar(hashes, file_id, distance), \
+                (file_id, distance)
+
+
+def test_groups_match_brute_force_for_every_distance(hashes):
+    import similarity
+    index = similarity.HammingIndex()
+    for file_id, value in hashes.items():
+        index.add(file_id, value)
+
+    for distance in range(similarity.MAX_DISTANCE + 1):
+        assert sorted(index.groups(distance)) == brute_force_groups(hashes, distance), distance
+
+
+def test_removed_ids_are_not_found(hashes):
+    import similarity
+    index = similarity.HammingIndex()
+    for file_id, value in hashes.items():
+        index.add(file_id, value)
+    for file_id in ['seed0', 'seed0-2', 'seed1-copy']:
+        index.remove(file_id)
+        del hashes[file_id]
+    # 同じハッシュの別の ID が残っている場合も、消えた場合も総当たりと一致する
+    index.add('seed1-2', hashes['seed1-2'] ^ 1)
+    hashes['seed1-2'] ^= 1
+
+    for distance in (0, 3, 8, similarity.MAX_DISTANCE):
+        for file_id in ['seed0-copy', 'seed0-1', 'seed1', 'seed1-2']:
+            assert index.similar(file_id, distance) == brute_force_similar(hashes, file_id, distance)
@@ -0,0 +1,75 @@
+"""複数ルートのスキャンとルートごとのI/Oワーカー"""
+import json
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+
+def add_image(app_module, root_name, folder='202401'):
+    root = app_module.storage.get(root_name)
+    path = root.path / folder / f"{uuid.uuid4().hex}.jpg"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new('RGB', (64, 48), (200, 120, 40)).save(path, 'JPEG')
+    return path
+
+
+def scan(client, profile, force=False):
+    status, headers, body = client.post(
+        '/scan', data=json.dumps({"force": force}).encode(),
+        headers={'Content-Type': 'application/json', 'X-Profile': profile}
+    )
+    assert status == 200, body
+    status, _, report = client.get(headers['X-Profile-Report'])
+    assert status == 200
+    return report
+
+
+def test_traced_scan_records_spans_from_every_root(app_module, client):
+    paths = [add_image(app_module, 'disk1'), add_image(app_module, 'disk2')]
+
+    events = json.loads(scan(client, 'trace'))['traceEvents']
+
+    hashes = [event for event in events if event['cat'] == 'ingest' and event['name'] == 'hash']
+    assert len(hashes) >= len(paths)
+    # ルートごとのワーカースレッドで記録される
+    assert len({event['tid'] for event in hashes}) == 2
+    assert any(event['cat'] == 'sql' for event in events)
+    assert any(event['name'] == 'scan' for event in events)
+
+
+def test_profiled_scan_includes_root_workers(app_module, client):
+    add_image(app_module, 'disk1', '202402')
+
+    text = scan(client, 'cprofile', force=True).decode()
+
+    assert '_scan_external_storage' in text
+
+
+def test_short_io_runs_between_scan_files_on_the_same_worker(app_module, tmp_path):
+    from storage_roots import StorageRoot
+    root = StorageRoot('disk', tmp_path, workers=1)
+    started, release = threading.Event(), threading.Event()
+
+    def scan():
+        started.set()
+        while not release.is_set():
+            # ファイル1件ごとの区切り
+            root.run_pending()
+            time.sleep(0.005)
+        return threading.get_ident()
+
+    scanning = root.submit_scan(scan)
+    queued_scan = root.submit_scan(threading.get_ident)
+    assert started.wait(2)
+    try:
+        deleted = root.submit(threading.get_ident)
+        deleted_on = deleted.result(timeout=2)
+        assert not scanning.done()
+        assert root.scans_queued() == 1
+    finally:
+        release.set()
+    # 同じディスクの処理は1本のワーカーで直列に実行される
+    assert scanning.result(timeout=2) == deleted_on
+    assert queued_scan.result(timeout=2) == deleted_on
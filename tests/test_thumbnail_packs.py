@@ -0,0 +1,70 @@
+"""パック方式のサムネイルの配信と圧縮"""
+import os
+import time
+import uuid
+
+from jobs import Job
+
+
+def add_packed_video(app_module, data):
+    """パックにサムネイルを保存した動画の行を追加して ID を返す"""
+    import thumbnails
+    file_id = str(uuid.uuid4())
+    with app_module.db_pool.connection() as conn:
+        conn.execute("""
+            INSERT INTO files (id, original_name, filename, file_path, file_type, mime_type,
+                file_size, thumbnail_path, thumbnail_hash)
+            VALUES (?, ?, ?, ?, 'video', 'video/mp4', 1, ?, ?)
+        """, (file_id, f"{file_id}.mp4", f"{file_id}.mp4", f"/missing/{file_id}.mp4",
+              thumbnails.PACK_PREFIX + file_id, uuid.uuid4().hex))
+        thumbnails.packs.append(conn, file_id, data)
+        conn.commit()
+    return file_id
+
+
+def test_packed_thumbnail_body_over_http(app_module, client):
+    data = b'\xff\xd8' + os.urandom(12000) + b'\xff\xd9'
+    file_id = add_packed_video(app_module, data)
+
+    status, headers, body = client.get(f'/thumbnails/{file_id}')
+
+    assert status == 200
+    assert headers['Content-Type'] == 'image/jpeg'
+    assert int(headers['Content-Length']) == len(data)
+    assert body == data
+
+    status, _, body = client.get(f'/thumbnails/{file_id}', headers={'If-None-Match': headers['ETag']})
+    assert status == 304
+    assert body == b''
+
+
+def test_compact_skips_recent_packs_and_keeps_live_thumbnails(app_module, client):
+    import thumbnails
+    packs = thumbnails.packs
+    live = {add_packed_video(app_module, os.urandom(3000)): None for _ in range(3)}
+    with app_module.db_pool.connection() as conn:
+        for file_id in live:
+            live[file_id] = bytes(packs.read(conn, file_id))
+        # 削除した行の分を空きにする
+        for _ in range(20):
+            packs.append(conn, f"dead-{uuid.uuid4()}", os.urandom(3000))
+        conn.commit()
+    before = packs.packs()
+
+    # 追記したばかりのパックは対象外
+    result = packs.compact(Job('thumbnail_compaction'), app_module.db_pool)
+    assert result['compacted_packs'] == 0
+    assert packs.packs() == before
+
+    # 最後の追記から時間が経てば詰め直す
+    old = time.time() - 3600
+    for pack in before:
+        os.utime(packs.pack_path(pack), (old, old))
+    result = packs.compact(Job('thumbnail_compaction'), app_module.db_pool)
+    assert result['compacted_packs'] == len(before)
+    assert not set(before) & set(packs.packs())
+
+    for file_id, data in live.items():
+        status, _, body = client.get(f'/thumbnails/{file_id}')
+        assert status == 200
+        assert body == data
@@ -0,0 +1,231 @@
+"""動画サムネイルのパックファイル（THUMBNAIL_STORE=pack）
+
+10KB 前後のサムネイルを1ファイルずつ置くと、inode を消費し、配信のたびに
+open・fstat・read・close のシステムコールが発生する。パック方式では、サムネイルを
+大きなパックファイル（packs/pack-000001.dat …）の末尾に追記し、ファイルIDごとの
+(パック番号, オフセット, 長さ) を SQLite の thumbnail_pack_entries に記録する。
+
+- 読み込みはパックファイルを mmap し、open・read・close なしでスライスを取り出す
+- 追記はロックファイルの flock で、ワーカープロセスをまたいで1つずつ行う
+- パックが THUMBNAIL_PACK_SIZE を超えたら次の番号のパックに切り替える
+- 削除したファイルのサムネイルは空きとして残り、compact() で有効なものだけを新しいパックへ
+  移して古いパックを削除する
+- バックアップはいくつかの大きなファイルのコピーになる（インデックスはデータベースにある）
+"""
+import fcntl
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 1つのパックファイルの上限（バイト）
+THUMBNAIL_PACK_SIZE = int(os.environ.get('THUMBNAIL_PACK_SIZE', str(256 * 1024 ** 2)))
+# 有効なデータの割合がこれを下回ったパックを圧縮の対象にする
+THUMBNAIL_PACK_MIN_LIVE = float(os.environ.get('THUMBNAIL_PACK_MIN_LIVE', '0.5'))
+# 最後の追記からこの秒数が経ったパックだけを圧縮する。追記したエントリの行はアップロードやスキャンの
+# コミットまで見えないので、リクエストのタイムアウト（GUNICORN_TIMEOUT）より長くする
+THUMBNAIL_PACK_COMPACT_GRACE = float(os.environ.get('THUMBNAIL_PACK_COMPACT_GRACE', '600'))
+
+SQL_PACK_ENTRY = "SELECT pack, offset, length FROM thumbnail_pack_entries WHERE file_id = ?"
+SQL_PUT_PACK_ENTRY = """
+    INSERT OR REPLACE INTO thumbnail_pack_entries (file_id, pack, offset, length)
+    VALUES (?, ?, ?, ?)
+"""
+# 削除された行のエントリ（通常は行の削除時にトリガーで消えるが、念のため圧縮時にも消す）
+SQL_DELETE_DEAD_ENTRIES = """
+    DELETE FROM thumbnail_pack_entries
+    WHERE NOT EXISTS (SELECT 1 FROM files WHERE files.id = thumbnail_pack_entries.file_id)
+"""
+SQL_LIVE_BY_PACK = """
+    SELECT pack, COUNT(*), SUM(length) FROM thumbnail_pack_entries GROUP BY pack
+"""
+
+# 他のプロセスが圧縮で削除したパックの mmap を手放す間隔（秒）
+_PRUNE_INTERVAL = 60
+# 圧縮で1回のロックの間に移すエントリ数
+_COMPACT_BATCH = 256
+
+
+class ThumbnailPacks:
+    """パックファイルへの追記と mmap での読み込み"""
+
+    def __init__(self, directory, pack_size=THUMBNAIL_PACK_SIZE):
+        self.directory = str(directory)
+        self.pack_size = pack_size
+        self._lock = threading.Lock()
+        self._maps = {}  # パック番号 → mmap
+        self._next_prune = time.monotonic() + _PRUNE_INTERVAL
+
+    def pack_path(self, pack):
+        return os.path.join(self.directory, f"pack-{pack:06d}.dat")
+
+    def packs(self):
+        """存在するパックの番号（昇順）"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            int(name[5:-4]) for name in names
+            if name.startswith('pack-') and name.endswith('.dat') and name[5:-4].isdigit()
+        )
+
+    @contextmanager
+    def _append_lock(self):
+        """追記と新しいパックへの切り替えをプロセス間で直列にする"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _append_locked(self, data):
+        packs = self.packs()
+        pack = packs[-1] if packs else 1
+        path = self.pack_path(pack)
+        size = os.path.getsize(path) if packs else 0
+        if size and size + len(data) > self.pack_size:
+            pack, size = pack + 1, 0
+            path = self.pack_path(pack)
+        with open(path, 'ab') as f:
+            f.write(data)
+        return pack, size
+
+    def append(self, conn, file_id, data):
+        """サムネイルを追記してインデックスに登録（コミットは呼び出し側）"""
+        with self._append_lock():
+            pack, offset = self._append_locked(data)
+        conn.execute(SQL_PUT_PACK_ENTRY, (file_id, pack, offset, len(data)))
+        return pack, offset
+
+    def _map(self, pack, end):
+        mm = self._maps.get(pack)
+        if mm is not None and len(mm) >= end:
+            return mm
+        with self._lock:
+            mm = self._maps.get(pack)
+            if mm is None or len(mm) < end:
+                # 追記で伸びたパックは開き直す（古い mmap は使用中のレスポンスが終われば解放される）
+                try:
+                    with open(self.pack_path(pack), 'rb') as f:
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (FileNotFoundError, ValueError):
+                    return None
+                if len(mm) < end:
+                    return None
+                self._maps[pack] = mm
+            return mm
+
+    def _prune(self):
+        """削除されたパックの mmap を手放す"""
+        self._next_prune = time.monotonic() + _PRUNE_INTERVAL
+        with self._lock:
+            for pack in list(self._maps):
+                if not os.path.exists(self.pack_path(pack)):
+                    del self._maps[pack]
+
+    def read(self, conn, file_id):
+        """サムネイルの内容（bytes、ない場合は None）
+
+        mmap のスライスはコピーになるが、10KB 前後なので open・read・close のシステムコールより安い。
+        memoryview のまま返すと WSGI サーバーがレスポンスの本体として受け付けない。
+        """
+        if time.monotonic() > self._next_prune:
+            self._prune()
+        # 圧縮でパックが移った直後はインデックスを読み直す
+        for _ in range(2):
+            row = conn.execute(SQL_PACK_ENTRY, (file_id,)).fetchone()
+            if row is None:
+                return None
+            pack, offset, length = row
+            mm = self._map(pack, offset + length)
+            if mm is not None:
+                return mm[offset:offset + length]
+        return None
+
+    def stats(self, conn):
+        packs = self.packs()
+        total = sum(os.path.getsize(self.pack_path(pack)) for pack in packs
+                    if os.path.exists(self.pack_path(pack)))
+        entries, live = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM thumbnail_pack_entries"
+        ).fetchone()
+        return {
+            "packs": len(packs),
+            "entries": entries,
+            "bytes": total,
+            "live_bytes": live,
+            "mapped": len(self._maps)
+        }
+
+    def compact(self, job, pool, min_live=THUMBNAIL_PACK_MIN_LIVE, grace=THUMBNAIL_PACK_COMPACT_GRACE):
+        """有効なデータの割合が min_live 未満のパックを詰め直す（ジョブとして実行）
+
+        最後の追記から grace 秒以上経ったパックだけを対象にするので、追記した後にまだコミットされて
+        いないエントリが対象のパックに残ることはない。エントリはパックに残っている分がなくなるまで
+        読み直して移すので、最初の読み込みの後にコミットされたエントリも取りこぼさない。
+        """
+        compacted = moved = 0
+        reclaimed = 0
+        with pool.connection() as conn:
+            dropped = conn.execute(SQL_DELETE_DEAD_ENTRIES).rowcount
+            conn.commit()
+            live = {pack: (count, size) for pack, count, size in conn.execute(SQL_LIVE_BY_PACK)}
+
+            candidates = []
+            now = time.time()
+            for pack in self.packs():
+                stat = os.stat(self.pack_path(pack))
+                live_size = live.get(pack, (0, 0))[1]
+                if stat.st_size and live_size < stat.st_size * min_live and now - stat.st_mtime >= grace:
+                    candidates.append((pack, stat.st_size))
+            job.update(dropped_entries=dropped, candidates=len(candidates), compacted=0)
+
+            if candidates:
+                # 追記先のパックも対象なら新しいパックに切り替え、以降の追記が対象に入らないようにする
+                with self._append_lock():
+                    packs = self.packs()
+                    if packs and packs[-1] == candidates[-1][0]:
+                        open(self.pack_path(packs[-1] + 1), 'ab').close()
+
+            for pack, size in candidates:
+                mm = self._map(pack, size)
+                if mm is None:
+                    print(f"[THUMBNAIL] パックを読めないため圧縮をスキップ: {pack}")
+                    continue
+                pack_moved = 0
+                # ロックはまとまった件数ごとに取り直し、その間のアップロードを長く待たせない
+                while True:
+                    updates = []
+                    with self._append_lock():
+                        entries = conn.execute("""
+                            SELECT file_id, offset, length FROM thumbnail_pack_entries
+                            WHERE pack = ? LIMIT ?
+                        """, (pack, _COMPACT_BATCH)).fetchall()
+                        if not entries:
+                            # 残りがないことの確認と削除は同じロックの中で行う
+                            os.unlink(self.pack_path(pack))
+                            break
+                        for file_id, offset, length in entries:
+                            new_pack, new_offset = self._append_locked(mm[offset:offset + length])
+                            updates.append((new_pack, new_offset, file_id, pack, offset))
+                    # 詰め直しの間にサムネイルが作り直されていた場合は上書きしない
+                    conn.executemany("""
+                        UPDATE thumbnail_pack_entries SET pack = ?, offset = ?
+                        WHERE file_id = ? AND pack = ? AND offset = ?
+                    """, updates)
+                    conn.commit()
+                    pack_moved += len(entries)
+                with self._lock:
+                    self._maps.pop(pack, None)
+                compacted += 1
+                moved += pack_moved
+                reclaimed += size - live.get(pack, (0, 0))[1]
+                job.update(compacted=compacted, moved_entries=moved, reclaimed_bytes=reclaimed)
+
+        print(f"[THUMBNAIL] パックの圧縮完了: {compacted}個, 移動{moved}件, 解放{reclaimed}バイト")
+        return {"dropped_entries": dropped, "compacted_packs": compacted,
+                "moved_entries": moved, "reclaimed_bytes": reclaimed}
@@ -0,0 +1,206 @@
+"""動画サムネイルの保存先
+
+サムネイルは THUMBNAILS_DIR の下に、ファイルIDのハッシュで2段に分けたディレクトリに置く
+（例: thumbnails/3f/a2/<id>.jpg）。1つのディレクトリに数十万件が並ぶと、ファイル名の検索や
+クリーンアップの一覧、バックアップが遅くなるため。
+
+書き込みも読み込みもこのモジュールの関数でパスを決める。以前のフラットな配置
+（thumbnails/<id>.jpg, thumbnails/thumb_<id>.jpg）のサムネイルは migrate() で
+サービスを止めずに移動できる。移動中もデータベースのパスと新しいパスの両方を探すので配信は途切れない。
+
+THUMBNAIL_STORE=pack の場合は、ファイルごとではなくパックファイルにまとめて保存する
+（thumbnail_packs.py）。データベースの thumbnail_path は 'pack:<id>' になる。
+migrate() は現在の保存方式に合わせて、ファイルとパックの間でサムネイルを移す。
+"""
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import thumbnail_packs
+
+THUMBNAILS_DIR = Path(os.environ.get('THUMBNAILS_DIR', 'storage/thumbnails'))
+# files: 1ファイルずつ分割した配置に保存 / pack: パックファイルに追記
+THUMBNAIL_STORE = os.environ.get('THUMBNAIL_STORE', 'files')
+PACK_PREFIX = 'pack:'
+PACKS_DIRNAME = 'packs'
+
+packs = thumbnail_packs.ThumbnailPacks(THUMBNAILS_DIR / PACKS_DIRNAME)
+
+
+def shard(file_id):
+    """ファイルIDから2段のディレクトリ名（'3f', 'a2'）"""
+    digest = hashlib.sha1(str(file_id).encode('utf-8')).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+def path_for(file_id, thumbnails_dir=None):
+    """ファイルIDのサムネイルのパス（分割した配置）"""
+    first, second = shard(file_id)
+    return Path(thumbnails_dir or THUMBNAILS_DIR) / first / second / f"{file_id}.jpg"
+
+
+def new_path(file_id):
+    """サムネイルを書き込むパス（ディレクトリを作成する）"""
+    path = path_for(file_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def temp_path(file_id):
+    """作成中のサムネイルのパス（save() で保存先へ移す）"""
+    THUMBNAILS_DIR.mkdir(parents=True, exist_ok=True)
+    return THUMBNAILS_DIR / f"tmp_{file_id}.jpg"
+
+
+def is_packed(stored_path):
+    return bool(stored_path) and str(stored_path).startswith(PACK_PREFIX)
+
+
+def save(conn, file_id, source_path):
+    """作成したサムネイルを現在の保存方式で保存し、thumbnail_path に記録する値を返す
+
+    パックの場合はインデックスの行を conn に追加する（コミットは呼び出し側）。
+    """
+    if THUMBNAIL_STORE == 'pack':
+        with open(source_path, 'rb') as f:
+            packs.append(conn, file_id, f.read())
+        os.unlink(source_path)
+        return PACK_PREFIX + str(file_id)
+    target = new_path(file_id)
+    os.replace(source_path, target)
+    return str(target)
+
+
+def read_packed(conn, file_id):
+    """パックに保存したサムネイルの内容（bytes、ない場合は None）"""
+    return packs.read(conn, file_id)
+
+
+def locate(file_id, stored_path=None):
+    """配信するサムネイルのパス（データベースのパス → 分割した配置の順に探し、なければ None）
+
+    パックに保存したサムネイルは None（read_packed() で読む）。
+    """
+    if is_packed(stored_path):
+        return None
+    for path in (stored_path, path_for(file_id)):
+        if path and os.path.exists(path):
+            return str(path)
+    return None
+
+
+def remove(file_id, stored_path=None):
+    """サムネイルを削除（移動中の場合もあるので両方のパスを消す）
+
+    行を削除するときはパスを直接消さずに必ずこの関数を使う。パックのエントリは files の行の削除時に
+    トリガーで消え、パック内の空きは compact() で回収するので、ここでは何もしない。
+    """
+    if is_packed(stored_path):
+        return
+    for path in {str(p) for p in (stored_path, path_for(file_id)) if p}:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _to_pack(conn, file_id, stored_path):
+    """ファイルのサムネイルをパックに追記（(新しい値, 後で消すパス)、見つからなければ None）"""
+    path = locate(file_id, stored_path)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        packs.append(conn, file_id, f.read())
+    return PACK_PREFIX + str(file_id), path
+
+
+def _to_file(conn, file_id, stored_path):
+    """分割した配置へ移動（パックからは書き出す）。(新しい値, 後で消すパス)、見つからなければ None"""
+    target = path_for(file_id)
+    if is_packed(stored_path):
+        data = read_packed(conn, file_id)
+        if data is None:
+            return None
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, target)
+        return str(target), None
+    if os.path.exists(stored_path):
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # 別のファイルシステムへの移動はコピーになる（移動先への置き換えは不可分）
+        shutil.move(stored_path, target)
+    elif not target.exists():
+        return None
+    return str(target), None
+
+
+def migrate(job, pool, on_moved=None, chunk_size=500):
+    """サムネイルを現在の保存方式（分割した配置またはパック）へ移してデータベースを更新する（ジョブとして実行）
+
+    ファイルを移動してから行を更新するので、その間の読み込みは locate() が新しいパスで見つける。
+    パックへ移す場合は、行の更新をコミットしてから元のファイルを消す。
+    on_moved(ids) は行を更新した後に呼ばれる（メタデータキャッシュの無効化用）。
+    """
+    to_pack = THUMBNAIL_STORE == 'pack'
+    moved = missing = 0
+    last_id = ''
+    with pool.connection() as conn:
+        total = conn.execute(
+            "SELECT COUNT(*) FROM files WHERE thumbnail_path IS NOT NULL"
+        ).fetchone()[0]
+        job.update(total=total, checked=0, moved=0, missing=0, store=THUMBNAIL_STORE)
+        checked = 0
+        while True:
+            rows = conn.execute("""
+                SELECT id, thumbnail_path FROM files
+                WHERE thumbnail_path IS NOT NULL AND id > ?
+                ORDER BY id LIMIT ?
+            """, (last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            changes, leftovers = [], []
+            for file_id, stored_path in rows:
+                if to_pack:
+                    if is_packed(stored_path):
+                        continue
+                    result = _to_pack(conn, file_id, stored_path)
+                else:
+                    if not is_packed(stored_path) and \
+                            os.path.abspath(stored_path) == os.path.abspath(path_for(file_id)):
+                        continue
+                    result = _to_file(conn, file_id, stored_path)
+                if result is None:
+                    missing += 1
+                    continue
+                value, leftover = result
+                changes.append((value, file_id))
+                if leftover:
+                    leftovers.append(leftover)
+            if changes:
+                conn.executemany("""
+                    UPDATE files SET thumbnail_path = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, changes)
+                if not to_pack:
+                    conn.executemany(
+                        "DELETE FROM thumbnail_pack_entries WHERE file_id = ?",
+                        [(file_id,) for _, file_id in changes]
+                    )
+                conn.commit()
+                moved += len(changes)
+                if on_moved:
+                    on_moved([file_id for _, file_id in changes])
+                for path in leftovers:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+            checked += len(rows)
+            job.update(checked=checked, moved=moved, missing=missing)
+
+    print(f"[THUMBNAIL] 保存方式の移行完了（{THUMBNAIL_STORE}）: {moved}件移動, 見つからない{missing}件")
+    return {"store": THUMBNAIL_STORE, "moved": moved, "missing": missing}
@@ -0,0 +1,146 @@
+"""動画のブラウザ互換形式（MP4）への変換
+
+コーデックがすでにブラウザで再生できる場合（H.264 + AAC など）はコンテナだけを
+MP4 に詰め替え（-c copy、再エンコードなし）、そうでない場合だけ libx264 で再エンコードする。
+
+変換はリクエストやスキャンの処理とは別の、同時実行数を制限したスレッドプールで行い、
+ffmpeg は nice 値を下げて起動するので、変換がリクエスト処理のCPUを奪わない。
+"""
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 同時に実行する変換の数
+TRANSCODE_CONCURRENCY = int(os.environ.get('TRANSCODE_CONCURRENCY', max(1, (os.cpu_count() or 2) // 2)))
+# ffmpeg の nice 値（大きいほど優先度が低い）
+TRANSCODE_NICE = int(os.environ.get('TRANSCODE_NICE', '10'))
+# 再エンコード時の x264 プリセット
+TRANSCODE_PRESET = os.environ.get('TRANSCODE_PRESET', 'medium')
+
+# 変換中の一時ファイルの接尾辞（スキャンと孤立ファイルの検出では無視する）
+TEMP_SUFFIX = '.converting.mp4'
+
+# MP4 に詰め替えるだけで主要ブラウザが再生できるコーデック
+REMUXABLE_VIDEO_CODECS = {'h264'}
+REMUXABLE_PIXEL_FORMATS = {'yuv420p', 'yuvj420p'}
+REMUXABLE_AUDIO_CODECS = {'aac', 'mp3'}
+
+
+def probe(path):
+    """ffprobe の結果（format と streams）"""
+    import ffmpeg
+    return ffmpeg.probe(str(path))
+
+
+def probe_streams(path):
+    """ffprobe でストリーム情報を取得"""
+    return probe(path).get('streams', [])
+
+
+def can_remux(streams):
+    """再エンコードせずにコンテナの詰め替えだけでブラウザ互換になるか"""
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+    if not video:
+        return False
+    first = video[0]
+    if first.get('codec_name') not in REMUXABLE_VIDEO_CODECS:
+        return False
+    if first.get('pix_fmt') not in REMUXABLE_PIXEL_FORMATS:
+        return False
+    return not audio or audio[0].get('codec_name') in REMUXABLE_AUDIO_CODECS
+
+
+def remux_command(input_path, output_path):
+    # Live Photos の MOV に含まれるメタデータトラックは MP4 に入らないので映像と音声だけを取り出す
+    return [
+        'ffmpeg', '-i', str(input_path),
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy',
+        '-tag:v', 'avc1',
+        '-movflags', '+faststart',
+        '-y', str(output_path)
+    ]
+
+
+def reencode_command(input_path, output_path):
+    return [
+        'ffmpeg', '-i', str(input_path),
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c:v', 'libx264',          # H.264エンコーダ
+        '-c:a', 'aac',              # AACオーディオ
+        '-movflags', '+faststart',  # ストリーミング最適化
+        '-pix_fmt', 'yuv420p',      # 互換性の高いピクセル形式
+        '-crf', '23',               # 品質設定
+        '-preset', TRANSCODE_PRESET,
+        '-y', str(output_path)
+    ]
+
+
+def run_ffmpeg(command):
+    """ffmpeg を優先度を下げて実行し、(終了コード, 標準エラー) を返す"""
+    process = subprocess.Popen(
+        command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, text=True
+    )
+    if TRANSCODE_NICE and hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, TRANSCODE_NICE)
+        except OSError:
+            pass  # 起動直後に終了した場合など
+    _, stderr = process.communicate()
+    return process.returncode, stderr
+
+
+def convert_to_mp4(input_path, output_path):
+    """ブラウザ互換の MP4 に変換。成功時は 'remux' または 'reencode'、失敗時は None"""
+    try:
+        streams = probe_streams(input_path)
+    except Exception as e:
+        print(f"[TRANSCODE] ストリーム情報の取得に失敗（再エンコードします）: {input_path}, {e}")
+        streams = []
+
+    if can_remux(streams):
+        returncode, stderr = run_ffmpeg(remux_command(input_path, output_path))
+        if returncode == 0:
+            return 'remux'
+        print(f"[TRANSCODE] 詰め替えに失敗（再エンコードします）: {input_path}, {stderr[-500:]}")
+
+    returncode, stderr = run_ffmpeg(reencode_command(input_path, output_path))
+    if returncode == 0:
+        return 'reencode'
+    print(f"[TRANSCODE] 変換エラー: {input_path}, {stderr[-500:]}")
+    return None
+
+
+class TranscodeQueue:
+    """同時実行数を制限した変換キュー"""
+
+    def __init__(self, max_workers=TRANSCODE_CONCURRENCY):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transcode')
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+
+    def submit(self, func, *args):
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._run, func, *args)
+
+    def _run(self, func, *args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args)
+        except Exception as e:
+            print(f"[TRANSCODE] 変換タスクのエラー: {e}")
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"max_workers": self.max_workers, "queued": self.queued, "running": self.running}
@@ -0,0 +1,8 @@
+"""WSGIエントリポイント
+
+本番環境では gunicorn から起動する:
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+
+app = create_app()
@@ -0,0 +1,261 @@
+"""無圧縮（store）ZIPのストリーミング生成
+
+一時ファイルを作らず、一定のメモリ使用量でZIPを生成しながら送信する。
+無圧縮なのでアーカイブ全体のサイズとレイアウトは事前に確定し、
+Content-Length の提示と任意の位置からの再開（Rangeリクエスト）ができる。
+
+CRC32 はファイル本体を送信しながら計算し、各エントリ直後のデータディスクリプタと
+末尾のセントラルディレクトリに書き込む。途中から再開した場合は、送信しない部分の
+CRC32 を必要になった時点でファイルを読み直して求める。
+"""
+import os
+import struct
+import time
+import zlib
+
+CHUNK_SIZE = 256 * 1024
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP16_LIMIT = 0xFFFF
+
+# 汎用フラグ: bit3 = データディスクリプタあり, bit11 = ファイル名がUTF-8
+FLAGS = 0x0808
+METHOD_STORED = 0
+
+
+def _dos_datetime(timestamp):
+    """UNIX時刻をZIPのDOS形式（time, date）に変換"""
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def unique_names(names):
+    """ZIP内のファイル名の重複を 'name (1).jpg' の形式で解消"""
+    seen = set()
+    result = []
+    for name in names:
+        name = name.replace('\\', '/').lstrip('/') or 'file'
+        candidate = name
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while candidate in seen:
+            candidate = f"{stem} ({n}){ext}"
+            n += 1
+        seen.add(candidate)
+        result.append(candidate)
+    return result
+
+
+class ZipEntry:
+    """アーカイブ内の1ファイル"""
+    __slots__ = ('name', 'path', 'size', 'mtime', 'offset', 'crc')
+
+    def __init__(self, name, path, size, mtime):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.offset = 0     # ローカルヘッダーの開始位置
+        self.crc = None     # 未計算の間は None
+
+    @property
+    def zip64(self):
+        return self.size >= ZIP32_LIMIT
+
+    @property
+    def encoded_name(self):
+        return self.name.encode('utf-8')
+
+    def local_header(self):
+        dos_time, dos_date = _dos_datetime(self.mtime)
+        name = self.encoded_name
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, self.size, self.size)
+            size_field = ZIP32_LIMIT
+            version = 45
+        else:
+            extra = b''
+            size_field = self.size
+            version = 20
+        # CRC32 はデータディスクリプタに書くためローカルヘッダーでは 0
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, version, FLAGS, METHOD_STORED,
+            dos_time, dos_date, 0, size_field, size_field, len(name), len(extra)
+        ) + name + extra
+
+    def local_header_size(self):
+        return 30 + len(self.encoded_name) + (20 if self.zip64 else 0)
+
+    def data_descriptor(self):
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+
+    def data_descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def central_header(self):
+        dos_time, dos_date = _dos_datetime(self.mtime)
+        name = self.encoded_name
+        extra_values = []
+        size_field = self.size
+        offset_field = self.offset
+        if self.zip64:
+            extra_values += [self.size, self.size]
+            size_field = ZIP32_LIMIT
+        if self.offset >= ZIP32_LIMIT:
+            extra_values.append(self.offset)
+            offset_field = ZIP32_LIMIT
+        extra = b''
+        if extra_values:
+            extra = struct.pack('<HH', 0x0001, 8 * len(extra_values))
+            extra += struct.pack('<' + 'Q' * len(extra_values), *extra_values)
+        version = 45 if extra_values else 20
+        external_attr = (0o100644 << 16)  # 通常ファイル rw-r--r--
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, FLAGS,
+            METHOD_STORED, dos_time, dos_date, self.crc, size_field, size_field,
+            len(name), len(extra), 0, 0, 0, external_attr, offset_field
+        ) + name + extra
+
+    def central_header_size(self):
+        extra_count = (2 if self.zip64 else 0) + (1 if self.offset >= ZIP32_LIMIT else 0)
+        extra_size = 4 + 8 * extra_count if extra_count else 0
+        return 46 + len(self.encoded_name) + extra_size
+
+
+def file_crc32(path, size):
+    """ファイル先頭から size バイトのCRC32を計算"""
+    crc = 0
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IOError(f"ファイルサイズが変わりました: {path}")
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+    return crc
+
+
+class StreamingZip:
+    """事前にレイアウトを確定させたストリーミングZIP
+
+    entries は (ZIP内の名前, ファイルパス) のリスト。サイズと更新日時はここで stat して固定する。
+    """
+
+    def __init__(self, entries):
+        self.entries = []
+        offset = 0
+        for name, path in entries:
+            stat = os.stat(path)
+            entry = ZipEntry(name, str(path), stat.st_size, stat.st_mtime)
+            entry.offset = offset
+            offset += entry.local_header_size() + entry.size + entry.data_descriptor_size()
+            self.entries.append(entry)
+
+        self.central_directory_offset = offset
+        self.central_directory_size = sum(e.central_header_size() for e in self.entries)
+        self.zip64 = (
+            len(self.entries) >= ZIP16_LIMIT
+            or self.central_directory_offset >= ZIP32_LIMIT
+            or self.central_directory_size >= ZIP32_LIMIT
+        )
+        end_size = 22 + (56 + 20 if self.zip64 else 0)
+        self.size = self.central_directory_offset + self.central_directory_size + end_size
+
+    def etag(self):
+        """内容が同じなら同じになる識別子（Rangeでの再開時の検証用）"""
+        key = '|'.join(f"{e.name}:{e.size}:{e.mtime}" for e in self.entries)
+        return f"zip-{zlib.crc32(key.encode('utf-8')):08x}-{self.size}"
+
+    def _ensure_crc(self, entry):
+        if entry.crc is None:
+            entry.crc = file_crc32(entry.path, entry.size)
+        return entry.crc
+
+    def _end_records(self):
+        count = len(self.entries)
+        cd_size = self.central_directory_size
+        cd_offset = self.central_directory_offset
+        records = b''
+        if self.zip64:
+            zip64_end_offset = cd_offset + cd_size
+            records += struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                count, count, cd_size, cd_offset
+            )
+            records += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+        records += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0,
+            min(count, ZIP16_LIMIT), min(count, ZIP16_LIMIT),
+            min(cd_size, ZIP32_LIMIT), min(cd_offset, ZIP32_LIMIT), 0
+        )
+        return records
+
+    def _iter_file(self, entry, skip, length):
+        """ファイル本体の skip バイト目から length バイトを読み出す
+
+        先頭から最後まで送る場合はついでにCRC32を計算する。
+        """
+        compute_crc = entry.crc is None and skip == 0 and length == entry.size
+        crc = 0
+        remaining = length
+        with open(entry.path, 'rb') as f:
+            if skip:
+                f.seek(skip)
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"ファイルサイズが変わりました: {entry.path}")
+                if compute_crc:
+                    crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        if compute_crc:
+            entry.crc = crc
+
+    def _segments(self):
+        """(サイズ, 生成関数) のリスト。生成関数は (skip, length) を受け取ってバイト列を返すイテレータ"""
+        def static(data_fn):
+            def generate(skip, length):
+                yield data_fn()[skip:skip + length]
+            return generate
+
+        segments = []
+        for entry in self.entries:
+            segments.append((entry.local_header_size(), static(entry.local_header)))
+            segments.append((entry.size, lambda skip, length, e=entry: self._iter_file(e, skip, length)))
+
+            def descriptor(e=entry):
+                self._ensure_crc(e)
+                return e.data_descriptor()
+            segments.append((entry.data_descriptor_size(), static(descriptor)))
+
+        # セントラルディレクトリはエントリ単位で生成して大きなバイト列を作らない
+        for entry in self.entries:
+            def central(e=entry):
+                self._ensure_crc(e)
+                return e.central_header()
+            segments.append((entry.central_header_size(), static(central)))
+        segments.append((self.size - self.central_directory_offset - self.central_directory_size,
+                         static(self._end_records)))
+        return segments
+
+    def iter_bytes(self, start=0, stop=None):
+        """アーカイブの [start, stop) の範囲を順に生成"""
+        if stop is None:
+            stop = self.size
+        position = 0
+        for size, generate in self._segments():
+            segment_end = position + size
+            if segment_end > start and position < stop and size > 0:
+                skip = max(start - position, 0)
+                length = min(stop, segment_end) - position - skip
+                yield from generate(skip, length)
+            position = segment_end
+            if position >= stop:
+                break